@@ -1,3 +1,50 @@
+from django import forms
 from django.contrib import admin
+from django.core.exceptions import ValidationError
+
+from .models import Job, Promotion, StockThreshold
 
 # Register your models here.
+class VersionedAdminForm(forms.ModelForm):
+    # Carries the version the editor loaded, so saving over someone else's change fails
+    version = forms.IntegerField(widget = forms.HiddenInput, required = False)
+
+    def clean(self):
+        cleaned_data = super().clean()
+        instance = self.instance
+        if instance.pk is not None and cleaned_data.get('version') is not None:
+            if not type(instance).objects.filter(pk = instance.pk, version = cleaned_data['version']).exists():
+                raise ValidationError('This object was changed by someone else, reload the page and try again')
+        return cleaned_data
+
+
+@admin.action(description = 'Retire selected promotions in the background')
+def retire_in_background(modeladmin, request, queryset):
+    # Imported here so the job registry is not loaded on every startup
+    from .jobs import enqueue
+    for promotion_id in queryset.values_list('id', flat = True):
+        enqueue('retire_promotion', promotion_id = promotion_id)
+
+
+@admin.register(Promotion)
+class PromotionAdmin(admin.ModelAdmin):
+    form = VersionedAdminForm
+    list_display = ['name', 'discount']
+    actions = [retire_in_background]
+
+    def save_related(self, request, form, formsets, change):
+        # Members are set shard by shard, the form would write them all to one database
+        if 'products' in form.cleaned_data:
+            form.instance.set_products(form.cleaned_data.pop('products'))
+        super().save_related(request, form, formsets, change)
+
+
+@admin.register(StockThreshold)
+class StockThresholdAdmin(admin.ModelAdmin):
+    list_display = ['category', 'threshold']
+
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ['id', 'name', 'status', 'attempts', 'progress', 'total', 'created_at', 'finished_at']
+    list_filter = ['status', 'name']
@@ -0,0 +1,207 @@
+from django.apps import apps
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import Case, Count, F, IntegerField, Max, Min, Q, Sum, Value, When
+from django.db.models.functions import Least
+from django.utils import timezone
+
+from .sharding import product_databases, relay_on_commit
+
+# Lower edges of the price histogram buckets, the last bucket is open ended
+PRICE_BUCKETS = (0, 10, 25, 50, 100, 250, 500, 1000)
+CATEGORY = 'category'
+PROMOTION = 'promotion'
+# Product fields the summaries are computed from
+SUMMARY_FIELDS = {'price', 'stock', 'category', 'promotion'}
+
+
+def mark_stale(categories = (), promotions = (), using = DEFAULT_DB_ALIAS):
+    # Flags the summaries of the given scopes for the next refresh(), creating them if needed.
+    # Product writes mark on their own database, a shard's marks are relayed to the default one.
+    PriceSummary = apps.get_model('CRUD', 'PriceSummary')
+    summaries = [PriceSummary(scope = scope, scope_id = scope_id, stale = True)
+                 for scope, ids in ((CATEGORY, categories), (PROMOTION, promotions)) for scope_id in set(ids) if scope_id is not None]
+    if summaries:
+        PriceSummary.objects.using(using).bulk_create(summaries, update_conflicts = True, unique_fields = ['scope', 'scope_id'], update_fields = ['stale'], batch_size = 500)
+        relay_on_commit(using)
+
+
+def mark_products(rows, using = DEFAULT_DB_ALIAS):
+    # rows are (category_id, promotion_id) of products before or after a change
+    rows = list(rows)
+    mark_stale([row[0] for row in rows], [row[1] for row in rows], using)
+
+
+def empty():
+    return {'product_count': 0, 'min_price': None, 'max_price': None, 'price_sum': 0.0, 'inventory_value': 0.0,
+            'discount_value': 0.0, 'histogram': [0] * len(PRICE_BUCKETS)}
+
+
+def combine(total, part):
+    # Adds one database's partial aggregates into total, products of a promotion can span shards
+    for field in ('product_count', 'price_sum', 'inventory_value', 'discount_value'):
+        total[field] += part[field] or 0
+    for field, pick in (('min_price', min), ('max_price', max)):
+        if part[field] is not None:
+            total[field] = part[field] if total[field] is None else pick(total[field], part[field])
+    total['histogram'] = [count + other for count, other in zip(total['histogram'], part['histogram'])]
+    return total
+
+
+def bucket_q(index):
+    q = Q(price__gte = PRICE_BUCKETS[index])
+    if index + 1 < len(PRICE_BUCKETS):
+        q &= Q(price__lt = PRICE_BUCKETS[index + 1])
+    return q
+
+
+def discount_value():
+    # Part of price * stock taken off by the promotion, only while its window is open,
+    # over a queryset annotated by with_effective_discount()
+    return F('price') * F('stock') * Least(F('effective_discount'), Value(100.0)) / 100
+
+
+def aggregate(using, scope, scope_id, when):
+    # One query: totals and histogram of one scope on one database
+    Product = apps.get_model('CRUD', 'Product')
+    products = Product.objects.using(using).filter(**{f'{scope}_id': scope_id}).with_effective_discount(when)
+    result = products.aggregate(
+        product_count = Count('id'), min_price = Min('price'), max_price = Max('price'), price_sum = Sum('price'),
+        inventory_value = Sum(F('price') * F('stock')), discount_value = Sum(discount_value()),
+        **{f'bucket_{index}': Count('id', filter = bucket_q(index)) for index in range(len(PRICE_BUCKETS))})
+    result['histogram'] = [result.pop(f'bucket_{index}') for index in range(len(PRICE_BUCKETS))]
+    return result
+
+
+def save_summary(PriceSummary, scope, scope_id, totals, now):
+    return PriceSummary(scope = scope, scope_id = scope_id, product_count = totals['product_count'],
+                        min_price = totals['min_price'], max_price = totals['max_price'],
+                        avg_price = totals['price_sum'] / totals['product_count'] if totals['product_count'] else None,
+                        inventory_value = totals['inventory_value'], discount_value = totals['discount_value'],
+                        histogram = totals['histogram'], stale = False, updated_at = now)
+
+
+def refresh(batch_size = 500):
+    # Recomputes the stale summaries, one aggregate query per scope and database.
+    # The flag is cleared before computing, so a change made meanwhile marks it again.
+    PriceSummary = apps.get_model('CRUD', 'PriceSummary')
+    stale = list(PriceSummary.objects.filter(stale = True).values_list('id', 'scope', 'scope_id')[:batch_size])
+    if not stale:
+        return 0
+    PriceSummary.objects.filter(id__in = [row[0] for row in stale]).update(stale = False)
+    now = timezone.now()
+    summaries = []
+    for _, scope, scope_id in stale:
+        totals = empty()
+        for using in product_databases():
+            combine(totals, aggregate(using, scope, scope_id, now))
+        summaries.append(save_summary(PriceSummary, scope, scope_id, totals, now))
+    # Deleting a category or promotion on the shards can mark it again after its summary was dropped
+    for scope in (CATEGORY, PROMOTION):
+        empty_ids = {summary.scope_id for summary in summaries if summary.scope == scope and not summary.product_count}
+        if empty_ids:
+            gone = empty_ids - set(apps.get_model('CRUD', scope).objects.filter(id__in = empty_ids).values_list('id', flat = True))
+            PriceSummary.objects.filter(scope = scope, scope_id__in = gone).delete()
+            summaries = [summary for summary in summaries if summary.scope != scope or summary.scope_id not in gone]
+    PriceSummary.objects.bulk_create(summaries, update_conflicts = True, unique_fields = ['scope', 'scope_id'], batch_size = 500,
+                                     update_fields = ['product_count', 'min_price', 'max_price', 'avg_price', 'inventory_value', 'discount_value', 'histogram', 'updated_at'])
+    return len(stale)
+
+
+def rebuild_query(using, when):
+    # Groups products by (category, promotion, price bucket) in one scan, then window
+    # functions over those groups give every row its category and promotion totals
+    Product = apps.get_model('CRUD', 'Product')
+    bucket = Case(*[When(price__gte = edge, then = Value(index)) for index, edge in reversed(list(enumerate(PRICE_BUCKETS)))], output_field = IntegerField())
+    rows = Product.objects.using(using).with_effective_discount(when).order_by().values('category_id', 'promotion_id', 'price', 'stock').annotate(
+        bucket = bucket, discount_value = discount_value())
+    sql, params = rows.query.sql_with_params()
+    columns = []
+    for scope in (CATEGORY, PROMOTION):
+        window = f'PARTITION BY {scope}_id'
+        columns += [f'SUM(COUNT(*)) OVER ({window})', f'MIN(MIN(price)) OVER ({window})', f'MAX(MAX(price)) OVER ({window})',
+                    f'SUM(SUM(price)) OVER ({window})', f'SUM(SUM(price * stock)) OVER ({window})', f'SUM(SUM(discount_value)) OVER ({window})',
+                    f'SUM(COUNT(*)) OVER ({window}, bucket)']
+    return f'SELECT category_id, promotion_id, bucket, {", ".join(columns)} FROM ({sql}) GROUP BY category_id, promotion_id, bucket', params
+
+
+def rebuild(report_progress = None):
+    # Recomputes every summary from one window-function pass per database.
+    # report_progress(done, total) is called after every database.
+    PriceSummary = apps.get_model('CRUD', 'PriceSummary')
+    partials = {}
+    now = timezone.now()
+    for done, using in enumerate(product_databases(), 1):
+        with connections[using].cursor() as cursor:
+            cursor.execute(*rebuild_query(using, now))
+            rows = cursor.fetchall()
+        database = {}
+        for category_id, promotion_id, bucket, *values in rows:
+            for offset, (scope, scope_id) in enumerate(((CATEGORY, category_id), (PROMOTION, promotion_id))):
+                if scope_id is None:
+                    continue
+                count, min_price, max_price, price_sum, inventory_value, discount_value, bucket_count = values[offset * 7:offset * 7 + 7]
+                totals = database.setdefault((scope, scope_id), dict(empty(), product_count = count, min_price = min_price, max_price = max_price,
+                                                                      price_sum = price_sum, inventory_value = inventory_value, discount_value = discount_value))
+                totals['histogram'][bucket] = bucket_count
+        for key, part in database.items():
+            combine(partials.setdefault(key, empty()), part)
+        if report_progress is not None:
+            report_progress(done, len(product_databases()))
+
+    with transaction.atomic():
+        PriceSummary.objects.all().delete()
+        PriceSummary.objects.bulk_create([save_summary(PriceSummary, scope, scope_id, totals, now) for (scope, scope_id), totals in partials.items()], batch_size = 500)
+    return len(partials)
+
+
+def product_deleted(sender, instance, using, **kwargs):
+    mark_products([(instance.category_id, instance.promotion_id)], using)
+
+
+def promotion_saved(sender, instance, created, raw = False, **kwargs):
+    # The discount and the window feed discount_value of the promotion and of its products'
+    # categories, nothing else of a promotion does
+    if created or raw or instance.pricing_key() == instance._saved_pricing_key:
+        return
+    Product = apps.get_model('CRUD', 'Product')
+    categories = set()
+    for using in product_databases():
+        categories.update(Product.objects.using(using).filter(promotion = instance).order_by().values_list('category_id', flat = True).distinct())
+    mark_stale(categories, [instance.id])
+
+
+def mark_window_changes(when = None):
+    # Windows open and close with no write to any product. Called by the schedule job,
+    # marks the summaries computed before a promotion boundary that has passed since:
+    # the promotion's own and those of the categories its products are in.
+    Product = apps.get_model('CRUD', 'Product')
+    Promotion = apps.get_model('CRUD', 'Promotion')
+    PriceSummary = apps.get_model('CRUD', 'PriceSummary')
+    when = when or timezone.now()
+    boundaries = {}
+    for field in ('starts_at', 'ends_at'):
+        for promotion_id, boundary in Promotion.objects.filter(**{f'{field}__lte': when}).values_list('id', field):
+            boundaries[promotion_id] = max(boundary, boundaries.get(promotion_id, boundary))
+    if not boundaries:
+        return
+    # Latest boundary that affects each category, through the products in it
+    categories = {}
+    for using in product_databases():
+        for promotion_id, category_id in Product.objects.using(using).filter(promotion_id__in = boundaries).order_by().values_list('promotion_id', 'category_id').distinct():
+            categories[category_id] = max(boundaries[promotion_id], categories.get(category_id, boundaries[promotion_id]))
+    computed = PriceSummary.objects.filter(stale = False).filter(Q(scope = PROMOTION, scope_id__in = boundaries) | Q(scope = CATEGORY, scope_id__in = categories))
+    outdated = {CATEGORY: categories, PROMOTION: boundaries}
+    stale = [(scope, scope_id) for scope, scope_id, updated_at in computed.values_list('scope', 'scope_id', 'updated_at') if updated_at < outdated[scope][scope_id]]
+    mark_stale([scope_id for scope, scope_id in stale if scope == CATEGORY], [scope_id for scope, scope_id in stale if scope == PROMOTION])
+
+
+def promotion_deleting(sender, instance, using, **kwargs):
+    # SET_NULL takes the products off the promotion without signals
+    Product = apps.get_model('CRUD', 'Product')
+    mark_stale(Product.objects.using(using).filter(promotion = instance).order_by().values_list('category_id', flat = True).distinct(), using = using)
+
+
+def scope_deleted(sender, instance, using, **kwargs):
+    PriceSummary = apps.get_model('CRUD', 'PriceSummary')
+    if using == DEFAULT_DB_ALIAS:
+        PriceSummary.objects.filter(scope = sender._meta.model_name, scope_id = instance.id).delete()
@@ -1,6 +1,59 @@
+from importlib import import_module
+
 from django.apps import AppConfig
+from django.conf import settings
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+
+
+def connect(signal, path, sender):
+    # Receiver that imports its module on the first signal, so modules only needed for
+    # writes (analytics, autocomplete, cache, outbox, related) stay off the startup path
+    module_name, name = path.rsplit('.', 1)
+
+    def receive(*args, **kwargs):
+        return getattr(import_module(f'CRUD.{module_name}'), name)(*args, **kwargs)
+
+    signal.connect(receive, sender = sender, weak = False, dispatch_uid = path)
 
 
 class CrudConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'CRUD'
+
+    def ready(self):
+        from . import sharding
+        from .signals import products_bulk_changed
+        Product = self.get_model('Product')
+        Promotion = self.get_model('Promotion')
+        connect(post_save, 'autocomplete.product_saved', Product)
+        connect(post_delete, 'autocomplete.product_deleted', Product)
+        connect(products_bulk_changed, 'autocomplete.products_bulk_changed', Product)
+        if settings.AUTOCOMPLETE_WARM:
+            from . import autocomplete
+            autocomplete.warm()
+
+        for model_name in ('Product', 'Category', 'Promotion'):
+            connect(post_save, 'outbox.saved', self.get_model(model_name))
+            connect(post_delete, 'outbox.deleted', self.get_model(model_name))
+        connect(pre_delete, 'outbox.promotion_deleting', Promotion)
+        connect(m2m_changed, 'outbox.promotion_products_changed', Promotion.products.through)
+
+        for model_name in ('Product', 'Category', 'Promotion'):
+            connect(post_save, 'cache.model_changed', self.get_model(model_name))
+            connect(post_delete, 'cache.model_changed', self.get_model(model_name))
+        connect(products_bulk_changed, 'cache.model_changed', Product)
+        connect(m2m_changed, 'cache.promotion_products_changed', Promotion.products.through)
+
+        connect(products_bulk_changed, 'related.products_bulk_changed', Product)
+        connect(post_delete, 'related.product_deleted', Product)
+
+        connect(post_delete, 'analytics.product_deleted', Product)
+        connect(post_save, 'analytics.promotion_saved', Promotion)
+        connect(pre_delete, 'analytics.promotion_deleting', Promotion)
+        for model_name in ('Category', 'Promotion'):
+            connect(post_delete, 'analytics.scope_deleted', self.get_model(model_name))
+
+        # The router needs sharding on the first query anyway
+        for model_name in sharding.REPLICATED_MODELS:
+            post_save.connect(sharding.replicated_saved, sender = self.get_model(model_name))
+            post_delete.connect(sharding.replicated_deleted, sender = self.get_model(model_name))
@@ -0,0 +1,262 @@
+import heapq
+import threading
+import time
+import unicodedata
+from array import array
+from bisect import bisect_left, insort
+from itertools import chain
+
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections, transaction
+from django.db.models import F, Max, Min
+
+from .sharding import product_databases
+
+# Popular ids tracked at most, past that every count is halved and the least popular are dropped
+MAX_POPULAR = 10000
+# Seconds a worker serves its copy before catching up with the shared change log
+SYNC_INTERVAL = 1
+# Seconds between reloads of the shared popularity counts
+RANK_INTERVAL = 30
+SYNC_BATCH_SIZE = 500
+
+def normalize(name):
+    decomposed = unicodedata.normalize('NFKD', name.casefold())
+    return ''.join(char for char in decomposed if not unicodedata.combining(char)).strip()
+
+
+class AutocompleteIndex:
+    # Product names sorted by normalized form, so every prefix is one contiguous
+    # slice found with two binary searches. keys/names/ids are parallel arrays.
+    # popular holds (key, id) of the ids in popularity, sorted the same way.
+
+    def __init__(self, entries = ()):
+        self.lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+        # Change log position per database and when it was last read, kept by sync()
+        self.cursors = {}
+        self.synced_at = self.ranked_at = time.monotonic()
+        self.popularity = {}
+        self.popular = []
+        self.positions = {}
+        rows = sorted((normalize(name), name, product_id) for product_id, name in entries)
+        self.keys = [row[0] for row in rows]
+        self.names = [row[1] for row in rows]
+        self.ids = array('q', (row[2] for row in rows))
+        self.positions = dict(zip(self.ids, self.keys))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, product_id, name):
+        with self.lock:
+            popular = product_id in self.popularity
+            if popular:
+                self._unrank(product_id)
+            self._remove(product_id)
+            key = normalize(name)
+            position = bisect_left(self.keys, key)
+            self.keys.insert(position, key)
+            self.names.insert(position, name)
+            self.ids.insert(position, product_id)
+            self.positions[product_id] = key
+            if popular:
+                insort(self.popular, (key, product_id))
+
+    def remove(self, product_id):
+        with self.lock:
+            if self.popularity.pop(product_id, None) is not None:
+                self._unrank(product_id)
+            self._remove(product_id)
+
+    def _unrank(self, product_id):
+        del self.popular[bisect_left(self.popular, (self.positions[product_id], product_id))]
+
+    def _find(self, product_id):
+        position = bisect_left(self.keys, self.positions[product_id])
+        while self.ids[position] != product_id:
+            position += 1
+        return position
+
+    def _remove(self, product_id):
+        if product_id not in self.positions:
+            return
+        position = self._find(product_id)
+        del self.positions[product_id]
+        del self.keys[position]
+        del self.names[position]
+        del self.ids[position]
+
+    def bump(self, product_id):
+        with self.lock:
+            if product_id not in self.positions:
+                return
+            if product_id not in self.popularity:
+                insort(self.popular, (self.positions[product_id], product_id))
+            self.popularity[product_id] = self.popularity.get(product_id, 0) + 1
+            if len(self.popularity) > MAX_POPULAR:
+                self._decay()
+
+    def rank(self, counts):
+        # Replaces the counts with the ones shared by every worker
+        with self.lock:
+            self.popularity = {product_id: count for product_id, count in counts if product_id in self.positions}
+            self.popular = sorted((self.positions[product_id], product_id) for product_id in self.popularity)
+
+    def _decay(self):
+        # Old picks count for less over time and the tracked ids stay bounded
+        ranked = heapq.nlargest(MAX_POPULAR // 2, ((count // 2, product_id) for product_id, count in self.popularity.items()))
+        self.popularity = {product_id: count for count, product_id in ranked if count}
+        self.popular = sorted((self.positions[product_id], product_id) for product_id in self.popularity)
+
+    def search(self, prefix, limit = 10):
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        with self.lock:
+            start = bisect_left(self.keys, prefix)
+            end = bisect_left(self.keys, prefix + '\U0010ffff', start)
+            # Most popular first, then alphabetical. Popular ids are usually far fewer
+            # than the matches of a short prefix, so rank those and fill up from the slice.
+            first = bisect_left(self.popular, (prefix,))
+            last = bisect_left(self.popular, (prefix + '\U0010ffff',), first)
+            popular = [(-self.popularity[product_id], self._find(product_id)) for _, product_id in self.popular[first:last]]
+            matches = [position for _, position in heapq.nsmallest(limit, popular)]
+            seen = set(matches)
+            for position in range(start, end):
+                if len(matches) >= limit:
+                    break
+                if position not in seen:
+                    matches.append(position)
+            return [(self.ids[i], self.names[i]) for i in matches]
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def change_databases():
+    # Product change events are written on the product's database and relayed to the default one
+    return list(dict.fromkeys([DEFAULT_DB_ALIAS, *product_databases()]))
+
+
+def build():
+    from .models import ChangeEvent, Product
+    # Cursors are taken first, a change committed while the names stream in is applied
+    # again by the next sync
+    cursors = {using: ChangeEvent.objects.using(using).aggregate(last = Max('id'))['last'] or 0 for using in change_databases()}
+    index = AutocompleteIndex(chain.from_iterable(
+        Product.objects.using(using).values_list('id', 'name').iterator(chunk_size = 10000) for using in product_databases()))
+    index.cursors = cursors
+    rank(index)
+    index.synced_at = time.monotonic()
+    return index
+
+
+def get_index():
+    # Every worker keeps its own copy, built from one streaming query. Signals keep it in
+    # step with the worker's own writes, sync() with the change log shared by all workers.
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = build()
+    index = _index
+    if time.monotonic() - index.synced_at >= SYNC_INTERVAL and index.sync_lock.acquire(blocking = False):
+        # Other requests keep searching the current copy meanwhile
+        try:
+            sync(index)
+        finally:
+            index.sync_lock.release()
+    return _index
+
+
+def sync(index):
+    global _index
+    from .models import ChangeEvent, Product
+    index.synced_at = time.monotonic()
+    oldest = ChangeEvent.objects.using(DEFAULT_DB_ALIAS).aggregate(oldest = Min('id'))['oldest']
+    if oldest is not None and oldest > index.cursors[DEFAULT_DB_ALIAS] + 1:
+        # Events this copy has not seen were compacted away, start over
+        _index = build()
+        return
+    changed = set()
+    for using, cursor in index.cursors.items():
+        events = ChangeEvent.objects.using(using).filter(id__gt = cursor).order_by('id').values_list('id', 'model', 'object_id')
+        for event_id, model, object_id in events.iterator(chunk_size = 10000):
+            index.cursors[using] = event_id
+            if model == 'product':
+                changed.add(object_id)
+    changed = list(changed)
+    for start in range(0, len(changed), SYNC_BATCH_SIZE):
+        batch = set(changed[start:start + SYNC_BATCH_SIZE])
+        for using in product_databases():
+            for product_id, name in Product.objects.using(using).filter(id__in = batch).values_list('id', 'name'):
+                index.add(product_id, name)
+                batch.discard(product_id)
+        for product_id in batch:
+            index.remove(product_id)
+    if index.synced_at - index.ranked_at >= RANK_INTERVAL:
+        rank(index)
+
+
+def rank(index):
+    from .models import ProductPopularity
+    index.rank(ProductPopularity.objects.order_by('-count', 'product_id').values_list('product_id', 'count')[:MAX_POPULAR])
+    index.ranked_at = time.monotonic()
+
+
+def pick(product_id):
+    # A suggestion was picked. Counted in the database for every worker, and in this
+    # worker's copy right away. Ids the index does not know are ignored.
+    from .models import ProductPopularity
+    index = get_index()
+    if product_id not in index.positions:
+        return
+    with transaction.atomic():
+        ProductPopularity.objects.bulk_create([ProductPopularity(product_id = product_id)], ignore_conflicts = True)
+        ProductPopularity.objects.filter(product_id = product_id).update(count = F('count') + 1)
+    index.bump(product_id)
+
+
+def decay():
+    # Old picks count for less over time and the shared counts stay bounded
+    from .models import ProductPopularity
+    ProductPopularity.objects.update(count = F('count') / 2)
+    ProductPopularity.objects.filter(count = 0).delete()
+
+
+def warm():
+    # Builds the index off the startup path, so a worker's first suggestions do not wait for it
+    def run():
+        try:
+            get_index()
+        except DatabaseError:
+            # Not migrated yet, the first request builds it
+            pass
+        finally:
+            connections.close_all()
+    thread = threading.Thread(target = run, name = 'autocomplete-warm', daemon = True)
+    thread.start()
+    return thread
+
+
+def reset_index():
+    global _index
+    _index = None
+
+
+def product_saved(sender, instance, **kwargs):
+    if _index is not None:
+        _index.add(instance.id, instance.name)
+
+
+def product_deleted(sender, instance, **kwargs):
+    if _index is not None:
+        _index.remove(instance.id)
+
+
+def products_bulk_changed(sender, ids, fields, using = DEFAULT_DB_ALIAS, **kwargs):
+    if _index is None or (fields is not None and 'name' not in fields):
+        return
+    for product_id, name in sender.objects.using(using).filter(id__in = ids).values_list('id', 'name'):
+        _index.add(product_id, name)
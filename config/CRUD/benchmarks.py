@@ -0,0 +1,303 @@
+import os
+import random
+import sqlite3
+import string
+import tempfile
+import time
+import zlib
+from contextlib import ExitStack, contextmanager
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+@contextmanager
+def timed(results, label):
+    start = time.perf_counter()
+    yield
+    results[label] = time.perf_counter() - start
+
+
+def random_text(length):
+    words = [''.join(random.choices(string.ascii_lowercase, k = random.randint(3, 10))) for _ in range(200)]
+    text = ''
+    while len(text) < length:
+        text += random.choice(words) + ' '
+    return text[:length]
+
+
+@benchmark('descriptions')
+def descriptions(out, rows):
+    # Compares the old layout (description on the product row, plain SQL since no model
+    # has it any more) with the ProductDetails split as the models write it, packing
+    # included. Both are scratch SQLite files, timed with the same queries.
+    from django.db import connection
+
+    from .models import Category, Product, ProductDetails
+
+    texts = [random_text(random.randint(200, 5000)) for _ in range(100)]
+    products = [(i, f'Product {i}', random.random() * 100, random.randint(0, 100), texts[i % len(texts)]) for i in range(1, rows + 1)]
+    layouts = {
+        'wide': ('product', 'SELECT description FROM product WHERE id = ?'),
+        'split': (Product._meta.db_table, f'SELECT raw, compressed FROM {ProductDetails._meta.db_table} WHERE product_id = ?'),
+    }
+    for layout, (table, detail_query) in layouts.items():
+        results = {}
+        with tempfile.TemporaryDirectory() as directory, ExitStack() as stack:
+            if layout == 'wide':
+                path = os.path.join(directory, 'bench.sqlite3')
+                db = sqlite3.connect(path)
+                db.execute('CREATE TABLE product (id INTEGER PRIMARY KEY, name TEXT, price REAL, stock INTEGER, description TEXT)')
+                db.executemany('INSERT INTO product VALUES (?, ?, ?, ?, ?)', products)
+                db.commit()
+                db.close()
+                size = os.path.getsize(path)
+            else:
+                stack.enter_context(scratch_files(directory, []))
+                path = connection.settings_dict['NAME']
+                empty = os.path.getsize(path)
+                category_id = Category.objects.create(name = 'Category').id
+                for start in range(0, rows, 1000):
+                    chunk = products[start:start + 1000]
+                    Product.objects.bulk_create([Product(id = i, name = name, price = price, stock = stock, category_id = category_id)
+                                                 for i, name, price, stock, _ in chunk])
+                    ProductDetails.store_many({i: text for i, _, _, _, text in chunk})
+                connection.close()
+                size = os.path.getsize(path) - empty
+
+            db = sqlite3.connect(path)
+            with timed(results, 'listing scan'):
+                db.execute(f'SELECT id, name, price, stock FROM {table} ORDER BY price').fetchall()
+            with timed(results, 'stock update'):
+                db.execute(f'UPDATE {table} SET stock = stock - 1')
+                db.commit()
+            with timed(results, 'detail lookup x1000'):
+                for i in range(1, rows + 1, max(rows // 1000, 1)):
+                    db.execute(detail_query, (i,)).fetchone()
+            db.close()
+            if layout == 'split':
+                with timed(results, 'Product.description x1000'):
+                    for i in range(1, rows + 1, max(rows // 1000, 1)):
+                        Product.objects.get(id = i).description
+
+        out.write(f'{layout}: {size / 1024 / 1024:.1f} MiB')
+        for label, seconds in results.items():
+            out.write(f'  {label}: {seconds * 1000:.1f} ms')
+
+
+@benchmark('autocomplete')
+def autocomplete(out, rows):
+    import tracemalloc
+
+    from .autocomplete import AutocompleteIndex
+
+    words = [random_text(8).strip() for _ in range(5000)]
+    entries = [(i, f'{random.choice(words)} {random.choice(words)} {i}') for i in range(rows)]
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    index = AutocompleteIndex(entries)
+    built = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    out.write(f'{len(index)} names, built in {built:.2f} s, {memory / 1024 / 1024:.1f} MiB')
+
+    for i in range(0, rows, max(rows // 100, 1)):
+        index.bump(i)
+    for length in (1, 2, 4):
+        prefixes = [random.choice(words)[:length] for _ in range(1000)]
+        start = time.perf_counter()
+        for prefix in prefixes:
+            index.search(prefix)
+        out.write(f'  prefix length {length}: {(time.perf_counter() - start) * 1000:.3f} ms per 1000 lookups')
+
+
+@benchmark('migrations')
+def migrations(out, rows):
+    # What a fresh database pays before its first query: loading the CRUD migration graph,
+    # building the model state of its plan and applying it to an empty database
+    from django.db import connection
+    from django.db.migrations.loader import MigrationLoader
+
+    results = {}
+    with timed(results, 'load graph and state'):
+        loader = MigrationLoader(None)
+        plan = [node for node in loader.graph.forwards_plan(max(loader.graph.leaf_nodes('CRUD'))) if node[0] == 'CRUD']
+        loader.project_state().apps
+    old_name = connection.settings_dict['NAME']
+    with timed(results, 'migrate empty database'):
+        connection.creation.create_test_db(verbosity = 0, autoclobber = True)
+    connection.creation.destroy_test_db(old_name, verbosity = 0)
+    operations = sum(len(loader.graph.nodes[node].operations) for node in plan)
+    out.write(f'{len(plan)} migrations, {operations} operations')
+    for label, seconds in results.items():
+        out.write(f'  {label}: {seconds * 1000:.1f} ms')
+
+
+@contextmanager
+def scratch_database():
+    # A throwaway copy of the schema, the real database is never touched
+    from django.db import connection
+
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity = 0, autoclobber = True)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity = 0)
+
+
+def create_catalog(rows, categories = 20):
+    from .models import Category, ImageUrl, Product, Promotion
+
+    category_ids = [Category.objects.create(name = f'Category {i}').id for i in range(categories)]
+    promotion_ids = [Promotion.objects.create(name = f'Promotion {i}', discount = i * 5.0).id for i in range(5)] + [None] * 5
+    image_ids = list(ImageUrl.intern_many([f'https://example.pl/img={i}' for i in range(10)]).values())
+    Product.objects.bulk_create([
+        Product(name = f'Product {i}', price = round(random.random() * 1000, 2), stock = random.randint(0, 100),
+                image_id = random.choice(image_ids), category_id = random.choice(category_ids),
+                promotion_id = random.choice(promotion_ids))
+        for i in range(rows)
+    ], batch_size = 1000)
+    return category_ids
+
+
+@benchmark('serialization')
+def serialization(out, rows):
+    from .models import Product
+    from .serializers import serialize_product_rows, serialize_products
+
+    with scratch_database():
+        create_catalog(rows)
+        page = Product.objects.with_image().order_by('id')[:10000]
+        for fields in (None, ['id', 'name', 'price']):
+            results = {}
+            with timed(results, 'model instances'):
+                slow = serialize_products(page.all(), fields)
+            with timed(results, 'values_list'):
+                fast = serialize_product_rows(page.all(), fields)
+            assert slow == fast
+            out.write(f'fields={",".join(fields) if fields else "all"}, {min(rows, 10000)} rows')
+            for label, seconds in results.items():
+                out.write(f'  {label}: {seconds * 1000:.1f} ms')
+
+
+@benchmark('upsert')
+def upsert(out, rows):
+    from .models import Category, Product
+
+    with scratch_database():
+        Category.objects.create(name = 'Category', slug = 'category')
+        feed = [{'sku': f'SKU-{i}', 'name': f'Product {i}', 'price': float(i % 1000), 'stock': i % 50,
+                 'category': 'category', 'image_url': f'https://example.pl/img={i % 10}'} for i in range(rows)]
+        results = {}
+        with timed(results, 'plain bulk_create'):
+            Product.objects.bulk_create([Product(name = row['name'], price = row['price'], stock = row['stock'],
+                                                 category_id = 1) for row in feed], batch_size = 500)
+        Product.objects.all().delete()
+        with timed(results, 'first import (inserts)'):
+            Product.objects.upsert(feed)
+        with timed(results, 're-import (unchanged)'):
+            Product.objects.upsert(feed)
+        for row in feed:
+            row['price'] += 1
+        with timed(results, 're-import (every price changed)'):
+            Product.objects.upsert(feed)
+        assert Product.objects.count() == rows
+        out.write(f'{rows} rows')
+        for label, seconds in results.items():
+            out.write(f'  {label}: {seconds * 1000:.1f} ms')
+
+
+@contextmanager
+def scratch_files(directory, aliases):
+    # Like scratch_database(), but the default database and the shards are files in
+    # directory, so writer threads share them the way worker processes would
+    from django.core.management import call_command
+    from django.db import connection, connections
+
+    old_name = connection.settings_dict['NAME']
+    old_test = connection.settings_dict['TEST']
+    connection.settings_dict['TEST'] = {**old_test, 'NAME': os.path.join(directory, 'default.sqlite3')}
+    connection.creation.create_test_db(verbosity = 0, autoclobber = True)
+    try:
+        for alias in aliases:
+            connections.settings[alias] = {**connections.settings['default'], 'NAME': os.path.join(directory, f'{alias}.sqlite3')}
+            call_command('migrate', database = alias, verbosity = 0)
+        yield
+    finally:
+        for alias in aliases:
+            connections[alias].close()
+            del connections[alias]
+            del connections.settings[alias]
+        connection.creation.destroy_test_db(old_name, verbosity = 0)
+        connection.settings_dict['TEST'] = old_test
+
+
+@benchmark('shards')
+def shards(out, rows):
+    # Writer threads saving and batch updating products of their own category through
+    # the ShardRouter, with every category in the default database and then with one
+    # shard per writer. Product.save() commits one row at a time, so rows is capped.
+    from concurrent.futures import ThreadPoolExecutor
+
+    from django.db import OperationalError, connections
+    from django.test import override_settings
+
+    from . import sharding
+    from .models import Category, CategoryShard, Product
+
+    writers = 4
+    rows = min(rows, 4000)
+
+    def save(category_id, count):
+        try:
+            products = [Product(name = f'Product {i}', price = float(i % 100), stock = i % 50, category_id = category_id) for i in range(count)]
+            for product in products:
+                product.save()
+            return [product.id for product in products]
+        finally:
+            connections.close_all()
+
+    def update(ids):
+        # batch_update reads before it writes, two writers upgrading their locks on one
+        # file make SQLite fail one of them at once. Retried like a client would, and counted.
+        retries = 0
+        try:
+            for start in range(0, len(ids), 50):
+                changes = [{'id': product_id, 'stock': random.randint(0, 100)} for product_id in ids[start:start + 50]]
+                while True:
+                    try:
+                        Product.objects.batch_update(changes)
+                        break
+                    except OperationalError:
+                        retries += 1
+            return retries
+        finally:
+            connections.close_all()
+
+    for aliases in ([], [f'shard_{writer}' for writer in range(writers)]):
+        results = {}
+        with tempfile.TemporaryDirectory() as directory, override_settings(CATALOG_SHARD_ALIASES = aliases), scratch_files(directory, aliases):
+            category_ids = [Category.objects.create(name = f'Category {writer}').id for writer in range(writers)]
+            for category_id, alias in zip(category_ids, aliases):
+                CategoryShard.objects.create(category_id = category_id, alias = alias)
+            with ThreadPoolExecutor(max_workers = writers) as pool:
+                with timed(results, 'Product.save'):
+                    ids = list(pool.map(save, category_ids, [rows // writers] * writers))
+                with timed(results, 'batch_update'):
+                    retries = sum(pool.map(update, ids))
+            if aliases:
+                # The side rows left on the shards, moved by the queued relay jobs
+                with timed(results, 'relay jobs'):
+                    for alias in aliases:
+                        sharding.relay(alias)
+        out.write(f'{len(aliases) or 1} database(s), {writers} writers, {rows // writers * writers} rows, {retries} batches retried on a lock')
+        for label, seconds in results.items():
+            out.write(f'  {label}: {seconds * 1000:.1f} ms, {rows / seconds:.0f} rows/s')
@@ -0,0 +1,132 @@
+import hashlib
+import secrets
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+
+GENERATION_MODELS = ('product', 'category', 'promotion')
+RESULT_TTL = 300
+LOCK_TTL = 30
+WAIT_FOR_RECOMPUTE = 2.0
+STAT_NAMES = ('hits', 'misses', 'stale')
+
+
+def generation_key(model_name):
+    return f'catalog:generation:{model_name}'
+
+
+def bump_generation(model_name):
+    # Every cached result embeds the generations it was built from, so bumping one
+    # makes all of them unreachable without scanning or deleting anything. Generations
+    # are random tokens, not counters: a token never comes back, even after its key was
+    # evicted, so results built under an old one can never be served again.
+    cache.set(generation_key(model_name), secrets.token_hex(8), timeout = None)
+
+
+def bump_on_commit(model_names, using = None):
+    # Bumping before the writer commits would let a reader cache the old rows under the
+    # new generation, where they would stay until the next write
+    transaction.on_commit(lambda: [bump_generation(model_name) for model_name in model_names], using = using)
+
+
+def generations():
+    keys = [generation_key(name) for name in GENERATION_MODELS]
+    values = cache.get_many(keys)
+    for key in keys:
+        if key not in values:
+            # First use or evicted. Any new token works, nothing is cached under it yet.
+            cache.add(key, secrets.token_hex(8), timeout = None)
+            values[key] = cache.get(key)
+    return [values[key] for key in keys]
+
+
+def result_key(namespace, params):
+    # The generations are not part of the key but of the entry, so the last value stays
+    # reachable after a write and can be served while it is recomputed
+    normalized = '&'.join(f'{name}={params[name]}' for name in sorted(params))
+    digest = hashlib.sha1(f'{namespace}?{normalized}'.encode('utf-8')).hexdigest()
+    return f'catalog:result:{namespace}:{digest}'
+
+
+def count(stat):
+    # Not cache.incr(), which file and database caches implement as get() and set() with
+    # the default timeout, so the counters would expire. Increments from concurrent
+    # workers can be lost, the stats are approximate.
+    key = f'catalog:stats:{stat}'
+    cache.set(key, cache.get(key, 0) + 1, timeout = None)
+
+
+def stats():
+    values = cache.get_many([f'catalog:stats:{stat}' for stat in STAT_NAMES])
+    result = {stat: values.get(f'catalog:stats:{stat}', 0) for stat in STAT_NAMES}
+    lookups = result['hits'] + result['misses'] + result['stale']
+    result['hit_rate'] = (result['hits'] + result['stale']) / lookups if lookups else 0.0
+    return result
+
+
+def cached_result(namespace, params, compute, ttl = RESULT_TTL):
+    # Entries are stored as (value, fresh_until, generation) and live twice as long as
+    # their ttl. An entry is fresh until its ttl runs out or a write bumps a generation it
+    # was built from. Then one caller takes the lock and recomputes while the others keep
+    # serving the stale value, so a hot key never has a thundering herd.
+    key = result_key(namespace, params)
+    generation = '.'.join(str(value) for value in generations())
+    entry = cache.get(key)
+    if is_fresh(entry, generation):
+        count('hits')
+        return entry[0]
+
+    # add() must be atomic across processes for this to be a lock, see filecache.py. The
+    # token tells the holder's lock apart from one taken over after it expired.
+    lock = key + ':lock'
+    token = secrets.token_hex(8)
+    if cache.add(lock, token, timeout = LOCK_TTL):
+        # The previous holder may have stored a fresh value after our get()
+        entry = cache.get(key)
+        if is_fresh(entry, generation):
+            release(lock, token)
+            count('hits')
+            return entry[0]
+    else:
+        if entry is not None:
+            count('stale')
+            return entry[0]
+        # Nothing to serve yet, give the worker holding the lock a moment
+        token = None
+        deadline = time.time() + WAIT_FOR_RECOMPUTE
+        while time.time() < deadline:
+            time.sleep(0.05)
+            entry = cache.get(key)
+            if is_fresh(entry, generation):
+                count('hits')
+                return entry[0]
+
+    count('misses')
+    try:
+        value = compute()
+        cache.set(key, (value, time.time() + ttl, generation), timeout = ttl * 2)
+    finally:
+        if token is not None:
+            release(lock, token)
+    return value
+
+
+def is_fresh(entry, generation):
+    return entry is not None and entry[1] > time.time() and entry[2] == generation
+
+
+def release(lock, token):
+    # Only the holder deletes the lock. get() and delete() are two calls, the lock can
+    # still expire in between, LOCK_TTL is long enough for that to be rare.
+    if cache.get(lock) == token:
+        cache.delete(lock)
+
+
+def model_changed(sender, using = None, **kwargs):
+    bump_on_commit([sender._meta.model_name], using)
+
+
+def promotion_products_changed(sender, action, using, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        bump_on_commit(['product', 'promotion'], using)
@@ -0,0 +1,39 @@
+import os
+import tempfile
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.cache.backends.filebased import FileBasedCache as DjangoFileBasedCache
+
+
+class FileBasedCache(DjangoFileBasedCache):
+    # Django's file cache implements add() as has_key() followed by set(), so two worker
+    # processes can both "add" the same key. Here the entry is written to a temporary file
+    # and hard linked into place, which fails for everyone but the first process, so add()
+    # can serve as a cross-process lock like it does on memcached or redis.
+
+    def add(self, key, value, timeout = DEFAULT_TIMEOUT, version = None):
+        self._createdir()
+        fname = self._key_to_file(key, version)
+        self._cull()
+        fd, tmp_path = tempfile.mkstemp(dir = self._dir)
+        try:
+            with open(fd, 'wb') as f:
+                self._write_content(f, timeout, value)
+            for _ in range(2):
+                try:
+                    os.link(tmp_path, fname)
+                    return True
+                except FileExistsError:
+                    # An expired entry, like a lock whose holder died, is deleted by the check
+                    if not self._expired(fname):
+                        return False
+            return False
+        finally:
+            os.remove(tmp_path)
+
+    def _expired(self, fname):
+        try:
+            with open(fname, 'rb') as f:
+                return self._is_expired(f)
+        except FileNotFoundError:
+            return True
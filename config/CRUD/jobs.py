@@ -0,0 +1,141 @@
+import traceback
+from datetime import timedelta
+
+from django.db.models import F
+from django.utils import timezone
+
+from . import analytics, autocomplete, related, sharding
+from .models import ChangeEvent, Job, LeaseLost, Promotion
+
+TASKS = {}
+# A running job whose worker has not claimed or reported progress for this long is
+# taken to be abandoned (the worker died) and goes back to the queue
+LEASE = timedelta(minutes = 10)
+
+
+def task(name):
+    # Registers a function as a job that workers can run by name
+    def register(func):
+        TASKS[name] = func
+        return func
+    return register
+
+
+def enqueue(name, max_attempts = 3, delay = 0, **kwargs):
+    if name not in TASKS:
+        raise KeyError(f'Unknown job {name}')
+    return Job.objects.create(name = name, kwargs = kwargs, max_attempts = max_attempts,
+                              run_after = timezone.now() + timedelta(seconds = delay))
+
+
+def requeue_expired(now):
+    # Jobs out of attempts fail instead, like a job that raised
+    expired = Job.objects.filter(status = Job.RUNNING, claimed_at__lt = now - LEASE)
+    requeued = expired.filter(attempts__lt = F('max_attempts')).update(status = Job.PENDING, run_after = now)
+    expired.update(status = Job.FAILED, error = 'Worker lease expired', finished_at = now)
+    return requeued
+
+
+def claim_next():
+    # The conditional UPDATE only succeeds for one worker, so two workers
+    # picking the same candidate row cannot both run it
+    now = timezone.now()
+    requeue_expired(now)
+    candidates = Job.objects.filter(status = Job.PENDING, run_after__lte = now).order_by('run_after', 'id').values_list('id', flat = True)[:10]
+    for job_id in candidates:
+        claimed = Job.objects.filter(id = job_id, status = Job.PENDING).update(status = Job.RUNNING, attempts = F('attempts') + 1, claimed_at = now)
+        if claimed:
+            return Job.objects.get(id = job_id)
+    return None
+
+
+def run_job(job):
+    # The outcome is only written while this worker still holds its claim. A worker
+    # that outlived its lease leaves the job to the one that took it over.
+    try:
+        # Tasks manage their own transactions, long ones commit in batches
+        TASKS[job.name](job, **job.kwargs)
+    except LeaseLost:
+        return False
+    except Exception:
+        job.error = traceback.format_exc()
+        if job.attempts < job.max_attempts:
+            # Back off a little more on every retry
+            job.status = Job.PENDING
+            job.run_after = timezone.now() + timedelta(seconds = 2 ** job.attempts)
+        else:
+            job.status = Job.FAILED
+            job.finished_at = timezone.now()
+        job.claimed().update(status = job.status, error = job.error, run_after = job.run_after, finished_at = job.finished_at)
+        return False
+    job.status = Job.DONE
+    job.error = None
+    job.finished_at = timezone.now()
+    return bool(job.claimed().update(status = job.status, error = job.error, finished_at = job.finished_at))
+
+
+def run_pending(limit = None):
+    count = 0
+    while limit is None or count < limit:
+        job = claim_next()
+        if job is None:
+            break
+        run_job(job)
+        count += 1
+    return count
+
+
+@task('retire_promotion')
+def retire_promotion(job, promotion_id, chunk_size = 1000):
+    Promotion.objects.get(id = promotion_id).retire(chunk_size = chunk_size, report_progress = job.report_progress)
+
+
+@task('apply_promotion_schedule')
+def apply_promotion_schedule(job, chunk_size = 1000):
+    Promotion.objects.apply_schedule(chunk_size = chunk_size)
+
+
+@task('refresh_related_products')
+def refresh_related_products(job, full = False, batch_size = 1000):
+    if full:
+        related.rebuild(report_progress = job.report_progress)
+        return
+    done = 0
+    while True:
+        refreshed = related.refresh(batch_size)
+        if not refreshed:
+            break
+        done += refreshed
+        job.report_progress(done)
+
+
+@task('refresh_price_summaries')
+def refresh_price_summaries(job, full = False, batch_size = 500):
+    if full:
+        analytics.rebuild(report_progress = job.report_progress)
+        return
+    done = 0
+    while True:
+        refreshed = analytics.refresh(batch_size)
+        if not refreshed:
+            break
+        done += refreshed
+        job.report_progress(done)
+
+
+@task('relay_shard_rows')
+def relay_shard_rows(job, shards = None, batch_size = 1000):
+    # Queued by shard writes, see sharding.queue_relay(). Without shards it relays every
+    # shard, a backstop for writes whose job could not be queued.
+    for using in shards or sharding.shard_aliases():
+        sharding.relay(using, batch_size)
+
+
+@task('decay_autocomplete_popularity')
+def decay_autocomplete_popularity(job):
+    autocomplete.decay()
+
+
+@task('compact_changes')
+def compact_changes(job, retention_days = 7):
+    ChangeEvent.compact(timezone.now() - timedelta(days = retention_days))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from CRUD.models import Promotion
+
+
+class Command(BaseCommand):
+    help = 'Switches products onto and off promotions whose window has started or ended'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type = int, default = 1000)
+
+    def handle(self, *args, **options):
+        attached, detached = Promotion.objects.apply_schedule(chunk_size = options['chunk_size'])
+        self.stdout.write(f'Attached {attached} products, detached {detached} products')
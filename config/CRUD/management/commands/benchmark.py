@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from CRUD.benchmarks import BENCHMARKS
+
+
+class Command(BaseCommand):
+    help = 'Runs a performance benchmark on scratch data'
+
+    def add_arguments(self, parser):
+        parser.add_argument('name', choices = sorted(BENCHMARKS))
+        parser.add_argument('--rows', type = int, default = 100000)
+
+    def handle(self, *args, **options):
+        if options['rows'] <= 0:
+            raise CommandError('--rows must be positive')
+        BENCHMARKS[options['name']](self.stdout, options['rows'])
@@ -0,0 +1,18 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from CRUD.models import ChangeEvent
+
+
+class Command(BaseCommand):
+    help = 'Drops superseded change feed events and events past the retention period'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--retention-days', type = int, default = 7)
+
+    def handle(self, *args, **options):
+        older_than = timezone.now() - timedelta(days = options['retention_days'])
+        superseded, expired = ChangeEvent.compact(older_than)
+        self.stdout.write(f'Removed {superseded} superseded and {expired} expired events')
@@ -0,0 +1,48 @@
+import os
+import subprocess
+import sys
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+TARGETS = {
+    'wsgi': 'import config.wsgi',
+    'manage': 'import django; django.setup(); import django.core.management',
+}
+
+
+class Command(BaseCommand):
+    help = 'Profiles import time of a fresh interpreter starting the project'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--target', choices = sorted(TARGETS), default = 'wsgi')
+        parser.add_argument('--top', type = int, default = 15)
+
+    def handle(self, *args, **options):
+        environment = dict(os.environ, DJANGO_SETTINGS_MODULE = os.environ.get('DJANGO_SETTINGS_MODULE', 'config.settings'))
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', TARGETS[options['target']]],
+                                cwd = settings.BASE_DIR, env = environment, capture_output = True, text = True)
+        if result.returncode != 0:
+            self.stderr.write(result.stderr)
+            return
+
+        modules = []
+        for line in result.stderr.splitlines():
+            if not line.startswith('import time:') or 'self [us]' in line:
+                continue
+            own, cumulative, name = line[len('import time:'):].split('|')
+            modules.append((int(own), int(cumulative), name.strip()))
+
+        packages = defaultdict(int)
+        for own, _, name in modules:
+            packages[name.split('.')[0]] += own
+        total = sum(own for own, _, _ in modules)
+
+        self.stdout.write(f'{options["target"]}: {len(modules)} modules, {total / 1000:.1f} ms')
+        self.stdout.write('Slowest packages:')
+        for package, own in sorted(packages.items(), key = lambda item: -item[1])[:options['top']]:
+            self.stdout.write(f'  {own / 1000:8.1f} ms  {package}')
+        self.stdout.write('Slowest modules (self time):')
+        for own, cumulative, name in sorted(modules, reverse = True)[:options['top']]:
+            self.stdout.write(f'  {own / 1000:8.1f} ms  {name}')
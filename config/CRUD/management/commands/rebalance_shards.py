@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from CRUD import sharding
+from CRUD.models import Category
+
+
+class Command(BaseCommand):
+    help = 'Moves a category to another product shard, or every category to its hashed shard'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--category', type = int, help = 'Id of the category to move')
+        parser.add_argument('--to', help = 'Alias of the shard to move it to')
+        parser.add_argument('--all', action = 'store_true', help = 'Copy shared tables to every shard and place every category, after shards were added')
+        parser.add_argument('--chunk-size', type = int, default = 1000)
+
+    def handle(self, *args, **options):
+        if not sharding.enabled():
+            raise CommandError('Sharding is off, set CATALOG_SHARDS first')
+        if options['all']:
+            sharding.sync_replicas()
+            moves = [(category_id, sharding.shard_for_category(category_id), False) for category_id in Category.objects.values_list('id', flat = True)]
+        elif options['category'] is not None and options['to']:
+            moves = [(options['category'], options['to'], True)]
+        else:
+            raise CommandError('Give --category and --to, or --all')
+        for category_id, target, pin in moves:
+            try:
+                moved = sharding.rebalance_category(category_id, target, options['chunk_size'], pin)
+            except ValueError as error:
+                raise CommandError(str(error))
+            if moved:
+                self.stdout.write(f'Moved {moved} products of category {category_id} to {target}')
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from CRUD import stockwatch
+
+
+class Command(BaseCommand):
+    help = 'Re-evaluates the low stock flag after LOW_STOCK_THRESHOLD changed, or for one category'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--category', type = int, help = 'Only recheck this category')
+        parser.add_argument('--chunk-size', type = int, default = 1000)
+
+    def handle(self, *args, **options):
+        crossed = stockwatch.recheck(options['category'], options['chunk_size'])
+        self.stdout.write(f'{crossed} products crossed their threshold')
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from CRUD import analytics
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the price summaries of categories and promotions whose products changed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action = 'store_true', help = 'Rebuild every summary in one pass instead of only the stale ones')
+        parser.add_argument('--batch-size', type = int, default = 500)
+
+    def handle(self, *args, **options):
+        if options['full']:
+            self.stdout.write(f'Rebuilt {analytics.rebuild()} price summaries')
+            return
+        refreshed = 0
+        while True:
+            count = analytics.refresh(options['batch_size'])
+            if not count:
+                break
+            refreshed += count
+        self.stdout.write(f'Refreshed {refreshed} price summaries')
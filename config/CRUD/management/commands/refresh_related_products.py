@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from CRUD import related
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the related products of products whose price, category or promotion changed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action = 'store_true', help = 'Rebuild every list instead of only the stale ones')
+        parser.add_argument('--batch-size', type = int, default = 1000)
+
+    def handle(self, *args, **options):
+        if options['full']:
+            self.stdout.write(f'Rebuilt the related products of {related.rebuild()} products')
+            return
+        written = 0
+        while True:
+            refreshed = related.refresh(options['batch_size'])
+            if not refreshed and not related.RelatedRefresh.objects.exists():
+                break
+            written += refreshed
+        self.stdout.write(f'Refreshed the related products of {written} products')
@@ -0,0 +1,38 @@
+import time
+from multiprocessing import Process
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from CRUD.jobs import run_pending
+
+
+def work(poll_interval, once):
+    while True:
+        ran = run_pending()
+        if once:
+            break
+        if not ran:
+            time.sleep(poll_interval)
+
+
+class Command(BaseCommand):
+    help = 'Runs background jobs stored in the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type = int, default = 1)
+        parser.add_argument('--poll-interval', type = float, default = 1.0)
+        parser.add_argument('--once', action = 'store_true', help = 'Exit once the queue is empty')
+
+    def handle(self, *args, **options):
+        if options['workers'] == 1:
+            work(options['poll_interval'], options['once'])
+            return
+
+        # Forked workers must not share the parent's database connection
+        connections.close_all()
+        workers = [Process(target = work, args = (options['poll_interval'], options['once'])) for _ in range(options['workers'])]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
@@ -0,0 +1,120 @@
+# Generated by Django 4.2.6 on 2026-10-18 22:55
+
+import django.core.validators
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    replaces = [('CRUD', '0001_initial'), ('CRUD', '0002_alter_product_image_url_alter_product_price_and_more'), ('CRUD', '0003_product_description'), ('CRUD', '0004_category_promotion_product_category'), ('CRUD', '0005_product_promotion_alter_product_category_and_more'), ('CRUD', '0006_alter_product_description_alter_product_image_url_and_more'), ('CRUD', '0007_alter_product_price'), ('CRUD', '0008_alter_product_price'), ('CRUD', '0009_alter_category_description'), ('CRUD', '0010_job'), ('CRUD', '0011_imageurl'), ('CRUD', '0012_productdetails'), ('CRUD', '0013_category_tree'), ('CRUD', '0014_promotion_schedule'), ('CRUD', '0015_changeevent')]
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Category',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+                ('description', models.CharField(blank=True, max_length=5000, null=True)),
+                ('parent', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='children', to='CRUD.category')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ImageUrl',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hash', models.CharField(max_length=64, unique=True)),
+                ('url', models.CharField(max_length=2083)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Promotion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+                ('description', models.CharField(blank=True, max_length=5000, null=True)),
+                ('discount', models.FloatField(blank=True, null=True, validators=[django.core.validators.MinValueValidator(0.0)])),
+                ('starts_at', models.DateTimeField(blank=True, null=True)),
+                ('ends_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['starts_at', 'ends_at'], name='CRUD_promot_starts__2359b6_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='Product',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+                ('price', models.FloatField(validators=[django.core.validators.MinValueValidator(0.0)])),
+                ('stock', models.IntegerField()),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='CRUD.category')),
+                ('image', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, to='CRUD.imageurl')),
+                ('promotion', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='CRUD.promotion')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='promotion',
+            name='products',
+            field=models.ManyToManyField(blank=True, related_name='promotions', to='CRUD.product'),
+        ),
+        migrations.CreateModel(
+            name='ProductDetails',
+            fields=[
+                ('product', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='details', serialize=False, to='CRUD.product')),
+                ('raw', models.CharField(blank=True, max_length=5000, null=True)),
+                ('compressed', models.BinaryField(blank=True, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='CategoryClosure',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.IntegerField()),
+                ('ancestor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='descendant_links', to='CRUD.category')),
+                ('descendant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ancestor_links', to='CRUD.category')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('ancestor', 'descendant'), name='unique_category_closure')],
+            },
+        ),
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+                ('kwargs', models.JSONField(blank=True, default=dict)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='pending', max_length=16)),
+                ('attempts', models.IntegerField(default=0)),
+                ('max_attempts', models.IntegerField(default=3)),
+                ('progress', models.IntegerField(default=0)),
+                ('total', models.IntegerField(blank=True, null=True)),
+                ('error', models.TextField(blank=True, null=True)),
+                ('run_after', models.DateTimeField(default=django.utils.timezone.now)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'run_after'], name='CRUD_job_status_9c8003_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='ChangeEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(max_length=32)),
+                ('object_id', models.BigIntegerField()),
+                ('action', models.CharField(choices=[('create', 'Create'), ('update', 'Update'), ('delete', 'Delete')], max_length=16)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['model', 'object_id'], name='CRUD_change_model_e71f3b_idx')],
+            },
+        ),
+    ]
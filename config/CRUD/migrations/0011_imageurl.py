@@ -0,0 +1,54 @@
+# Generated by Django 4.2.6 on 2026-10-18 22:48
+
+import hashlib
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def hash_url(url):
+    return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+
+def intern_image_urls(apps, schema_editor):
+    Product = apps.get_model('CRUD', 'Product')
+    ImageUrl = apps.get_model('CRUD', 'ImageUrl')
+    urls = list(Product.objects.exclude(image_url__isnull=True).values_list('image_url', flat=True).distinct())
+    ImageUrl.objects.bulk_create([ImageUrl(hash=hash_url(url), url=url) for url in urls], batch_size=500)
+    for url, image_id in ImageUrl.objects.values_list('url', 'id'):
+        Product.objects.filter(image_url=url).update(image_id=image_id)
+
+
+def restore_image_urls(apps, schema_editor):
+    Product = apps.get_model('CRUD', 'Product')
+    ImageUrl = apps.get_model('CRUD', 'ImageUrl')
+    for url, image_id in ImageUrl.objects.values_list('url', 'id'):
+        Product.objects.filter(image_id=image_id).update(image_url=url)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('CRUD', '0010_job'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImageUrl',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hash', models.CharField(max_length=64, unique=True)),
+                ('url', models.CharField(max_length=2083)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='image',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, to='CRUD.imageurl'),
+        ),
+        migrations.RunPython(intern_image_urls, restore_image_urls, elidable=True),
+        migrations.RemoveField(
+            model_name='product',
+            name='image_url',
+        ),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 4.2.6 on 2026-10-18 22:49
+
+import zlib
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+COMPRESS_MIN_LENGTH = 512
+
+
+def move_descriptions(apps, schema_editor):
+    Product = apps.get_model('CRUD', 'Product')
+    ProductDetails = apps.get_model('CRUD', 'ProductDetails')
+    details = []
+    for product_id, text in Product.objects.exclude(description__isnull=True).values_list('id', 'description').iterator():
+        compressed = None
+        if len(text) >= COMPRESS_MIN_LENGTH:
+            packed = zlib.compress(text.encode('utf-8'))
+            if len(packed) < len(text.encode('utf-8')):
+                compressed, text = packed, None
+        details.append(ProductDetails(product_id=product_id, raw=text, compressed=compressed))
+    ProductDetails.objects.bulk_create(details, batch_size=500)
+
+
+def restore_descriptions(apps, schema_editor):
+    Product = apps.get_model('CRUD', 'Product')
+    ProductDetails = apps.get_model('CRUD', 'ProductDetails')
+    for details in ProductDetails.objects.iterator():
+        text = zlib.decompress(details.compressed).decode('utf-8') if details.compressed is not None else details.raw
+        Product.objects.filter(id=details.product_id).update(description=text)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('CRUD', '0011_imageurl'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductDetails',
+            fields=[
+                ('product', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='details', serialize=False, to='CRUD.product')),
+                ('raw', models.CharField(blank=True, max_length=5000, null=True)),
+                ('compressed', models.BinaryField(blank=True, null=True)),
+            ],
+        ),
+        migrations.RunPython(move_descriptions, restore_descriptions, elidable=True),
+        migrations.RemoveField(
+            model_name='product',
+            name='description',
+        ),
+    ]
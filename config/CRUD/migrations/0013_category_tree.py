@@ -0,0 +1,41 @@
+# Generated by Django 4.2.6 on 2026-10-18 22:50
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def add_self_links(apps, schema_editor):
+    Category = apps.get_model('CRUD', 'Category')
+    CategoryClosure = apps.get_model('CRUD', 'CategoryClosure')
+    CategoryClosure.objects.bulk_create(
+        [CategoryClosure(ancestor_id=category_id, descendant_id=category_id, depth=0) for category_id in Category.objects.values_list('id', flat=True)],
+        batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('CRUD', '0012_productdetails'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='parent',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='children', to='CRUD.category'),
+        ),
+        migrations.CreateModel(
+            name='CategoryClosure',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.IntegerField()),
+                ('ancestor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='descendant_links', to='CRUD.category')),
+                ('descendant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ancestor_links', to='CRUD.category')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='categoryclosure',
+            constraint=models.UniqueConstraint(fields=('ancestor', 'descendant'), name='unique_category_closure'),
+        ),
+        migrations.RunPython(add_self_links, migrations.RunPython.noop, elidable=True),
+    ]
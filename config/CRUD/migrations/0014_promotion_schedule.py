@@ -0,0 +1,27 @@
+# Generated by Django 4.2.6 on 2026-10-18 22:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('CRUD', '0013_category_tree'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='promotion',
+            name='ends_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='promotion',
+            name='starts_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='promotion',
+            index=models.Index(fields=['starts_at', 'ends_at'], name='CRUD_promot_starts__2359b6_idx'),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 4.2.6 on 2026-10-18 22:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('CRUD', '0001_squashed_0015_changeevent'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='category',
+            constraint=models.CheckConstraint(check=models.Q(('name', ''), _negated=True), name='category_name_not_empty'),
+        ),
+        migrations.AddConstraint(
+            model_name='product',
+            constraint=models.CheckConstraint(check=models.Q(('name', ''), _negated=True), name='product_name_not_empty'),
+        ),
+        migrations.AddConstraint(
+            model_name='product',
+            constraint=models.CheckConstraint(check=models.Q(('price__gte', 0)), name='product_price_non_negative'),
+        ),
+        migrations.AddConstraint(
+            model_name='promotion',
+            constraint=models.CheckConstraint(check=models.Q(('name', ''), _negated=True), name='promotion_name_not_empty'),
+        ),
+        migrations.AddConstraint(
+            model_name='promotion',
+            constraint=models.CheckConstraint(check=models.Q(('discount__isnull', False)), name='promotion_discount_not_null'),
+        ),
+        migrations.AddConstraint(
+            model_name='promotion',
+            constraint=models.CheckConstraint(check=models.Q(('discount__gte', 0)), name='promotion_discount_non_negative'),
+        ),
+        migrations.AddConstraint(
+            model_name='promotion',
+            constraint=models.CheckConstraint(check=models.Q(('starts_at__isnull', True), ('ends_at__isnull', True), ('ends_at__gt', models.F('starts_at')), _connector='OR'), name='promotion_window_ordered'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.6 on 2026-10-18 23:07
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('CRUD', '0018_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CategoryShard',
+            fields=[
+                ('category', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='shard', serialize=False, to='CRUD.category')),
+                ('alias', models.CharField(max_length=64)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ProductIdSequence',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('next_id', models.BigIntegerField()),
+            ],
+        ),
+    ]
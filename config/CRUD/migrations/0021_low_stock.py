@@ -0,0 +1,43 @@
+# Generated by Django 4.2.6 on 2026-10-18 23:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('CRUD', '0020_related_products'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockAlert',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('product_id', models.BigIntegerField()),
+                ('category_id', models.BigIntegerField()),
+                ('stock', models.IntegerField()),
+                ('threshold', models.IntegerField()),
+                ('low', models.BooleanField()),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='StockThreshold',
+            fields=[
+                ('category', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stock_threshold', serialize=False, to='CRUD.category')),
+                ('threshold', models.PositiveIntegerField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='low_stock',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(condition=models.Q(('low_stock', True)), fields=['stock', 'id'], name='product_low_stock_idx'),
+        ),
+    ]
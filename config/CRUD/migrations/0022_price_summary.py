@@ -0,0 +1,34 @@
+# Generated by Django 4.2.6 on 2026-10-18 23:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('CRUD', '0021_low_stock'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PriceSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('scope', models.CharField(choices=[('category', 'Category'), ('promotion', 'Promotion')], max_length=16)),
+                ('scope_id', models.BigIntegerField()),
+                ('product_count', models.IntegerField(default=0)),
+                ('min_price', models.FloatField(blank=True, null=True)),
+                ('max_price', models.FloatField(blank=True, null=True)),
+                ('avg_price', models.FloatField(blank=True, null=True)),
+                ('inventory_value', models.FloatField(default=0)),
+                ('discount_value', models.FloatField(default=0)),
+                ('histogram', models.JSONField(default=list)),
+                ('stale', models.BooleanField(default=False)),
+                ('updated_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'indexes': [models.Index(condition=models.Q(('stale', True)), fields=['id'], name='price_summary_stale_idx')],
+                'constraints': [models.UniqueConstraint(fields=('scope', 'scope_id'), name='unique_price_summary_scope')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.6 on 2026-10-18 23:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('CRUD', '0022_price_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='claimed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 4.2.6 on 2026-10-18 23:40
+
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, migrations, models
+
+
+def set_low_stock(apps, schema_editor):
+    # 0021 added low_stock as False on every existing product. Thresholds are read
+    # from the default database, where they live, products on the database migrated.
+    Product = apps.get_model('CRUD', 'Product')
+    StockThreshold = apps.get_model('CRUD', 'StockThreshold')
+    using = schema_editor.connection.alias
+    overrides = defaultdict(list)
+    for category_id, threshold in StockThreshold.objects.using(DEFAULT_DB_ALIAS).values_list('category_id', 'threshold'):
+        overrides[threshold].append(category_id)
+
+    def low_below(threshold):
+        return models.Case(models.When(stock__lt=threshold, then=models.Value(True)), default=models.Value(False))
+
+    categories = [category_id for category_ids in overrides.values() for category_id in category_ids]
+    Product.objects.using(using).exclude(category_id__in=categories).update(low_stock=low_below(settings.LOW_STOCK_THRESHOLD))
+    for threshold, category_ids in overrides.items():
+        Product.objects.using(using).filter(category_id__in=category_ids).update(low_stock=low_below(threshold))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('CRUD', '0023_job_lease'),
+    ]
+
+    operations = [
+        migrations.RunPython(set_low_stock, migrations.RunPython.noop, elidable=True),
+    ]
@@ -1,53 +1,992 @@
-from django.db import models
+import hashlib
+import math
+import zlib
+from collections import Counter
+from contextlib import contextmanager
+
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, connection, connections, models, transaction
+from django.db.models import Case, Count, F, Max, Q, Value, When
 from django.core.validators import MinValueValidator
 from django.forms import ValidationError
+from django.utils import timezone
+
+# analytics, stockwatch and cache are imported where used, they are only needed for
+# writes and stay off the startup path
+from . import sharding
+from .signals import products_bulk_changed
+
+class ConflictError(Exception):
+    # Raised when a save() finds the row was changed since the instance was loaded
+    pass
+
+
+class LeaseLost(Exception):
+    # Raised to a worker whose job was taken over by another one after its lease expired
+    pass
+
+
+class VersionedModel(models.Model):
+    # Optimistic locking: every write bumps version, and save() only updates the row
+    # if it still has the version this instance was loaded with
+    version = models.PositiveIntegerField(default = 0)
+
+    class Meta:
+        abstract = True
+
+    def _do_update(self, base_qs, using, pk_val, values, update_fields, forced_update):
+        version_field = self._meta.get_field('version')
+        values = [value for value in values if value[0] is not version_field]
+        values.append((version_field, None, self.version + 1))
+        updated = super(VersionedModel, self)._do_update(base_qs.filter(version = self.version), using, pk_val, values, update_fields, forced_update)
+        if updated:
+            self.version += 1
+        elif base_qs.filter(pk = pk_val).exists():
+            raise ConflictError(f'{self._meta.verbose_name} {pk_val} was changed by someone else, reload it and try again')
+        return updated
+
+
+def update_in_chunks(queryset, chunk_size, on_chunk = None, **values):
+    # Applies queryset.update() a batch of rows at a time, each batch in its own
+    # transaction, so no single statement locks the whole table. Product querysets
+    # are run on every shard. on_chunk(count) is called after every committed batch.
+    from . import analytics, stockwatch
+    updated = 0
+    for using in sharding.product_databases() if queryset.model is Product else [queryset.db]:
+        while True:
+            with transaction.atomic(using = using):
+                ids = list(queryset.using(using).values_list('id', flat = True)[:chunk_size])
+                if not ids:
+                    break
+                if queryset.model is Product and analytics.SUMMARY_FIELDS.intersection(values):
+                    # Before the update, so the scopes the products leave are marked too
+                    analytics.mark_products(Product.objects.using(using).filter(id__in = ids).values_list('category_id', 'promotion_id'), using)
+                updated += queryset.model.objects.using(using).filter(id__in = ids).update(version = F('version') + 1, **values)
+                if queryset.model is Product and 'stock' in values:
+                    stockwatch.watch(using, ids)
+                if queryset.model is Product and analytics.SUMMARY_FIELDS.intersection(values):
+                    analytics.mark_products(Product.objects.using(using).filter(id__in = ids).values_list('category_id', 'promotion_id'), using)
+                ChangeEvent.record(queryset.model, ids, ChangeEvent.UPDATE, using)
+                if queryset.model is Product:
+                    products_bulk_changed.send(sender = Product, ids = ids, fields = list(values), using = using)
+            if on_chunk is not None:
+                on_chunk(len(ids))
+    return updated
+
+
+@contextmanager
+def constraint_errors(messages, using = None):
+    # Validation is done by CHECK/NOT NULL constraints in the database, this maps
+    # their failures back to the ValidationError messages save() has always raised
+    try:
+        with transaction.atomic(using = using):
+            yield
+    except IntegrityError as error:
+        for marker, message in messages.items():
+            if marker in str(error):
+                raise ValidationError(message) from error
+        raise
+
+
+def active_at_q(prefix, when):
+    return (Q(**{f'{prefix}starts_at__isnull': True}) | Q(**{f'{prefix}starts_at__lte': when})) & \
+           (Q(**{f'{prefix}ends_at__isnull': True}) | Q(**{f'{prefix}ends_at__gt': when}))
+
 
 # Create your models here.
-class Category(models.Model):
+class CategoryManager(models.Manager):
+    def with_subtree_product_counts(self):
+        if not sharding.enabled():
+            return self.annotate(subtree_product_count = Count('descendant_links__descendant__product'))
+        # The closure is not copied to the shards: count products per category there,
+        # add the counts up the closure here and annotate the totals as constants
+        counts = Counter()
+        for using in sharding.product_databases():
+            counts.update(dict(Product.objects.using(using).order_by().values_list('category_id').annotate(count = Count('id'))))
+        totals = Counter()
+        for ancestor_id, descendant_id in CategoryClosure.objects.values_list('ancestor_id', 'descendant_id'):
+            totals[ancestor_id] += counts[descendant_id]
+        return self.annotate(subtree_product_count = Case(*[When(id = category_id, then = Value(total)) for category_id, total in totals.items() if total],
+                                                          default = Value(0), output_field = models.IntegerField()))
+
+    def reparent(self, categories, parent):
+        # Moves every category (with its whole subtree) below parent, None makes them roots.
+        # The closure rows of all the subtrees are rewritten by one DELETE and one INSERT.
+        from . import cache as catalog_cache
+        categories = list(categories)
+        # A category listed twice would get its closure rows inserted twice
+        ids = list(dict.fromkeys(category.id for category in categories))
+        parent_id = parent.id if parent is not None else None
+        if not ids:
+            return
+        table = CategoryClosure._meta.db_table
+        marks = ', '.join(['%s'] * len(ids))
+        with transaction.atomic():
+            if parent_id is not None and CategoryClosure.objects.filter(ancestor_id__in = ids, descendant_id = parent_id).exists():
+                raise ValidationError('Category cannot be moved below itself')
+            with connection.cursor() as cursor:
+                # A path is cut when a moved category lies on it below its top end. This also
+                # separates a moved category from a moved ancestor, both end up below parent.
+                cursor.execute(
+                    f'DELETE FROM {table} WHERE id IN (SELECT link.id FROM {table} link '
+                    f'JOIN {table} down ON down.descendant_id = link.descendant_id '
+                    f'JOIN {table} up ON up.descendant_id = down.ancestor_id AND up.ancestor_id = link.ancestor_id '
+                    f'WHERE down.ancestor_id IN ({marks}) AND up.depth > 0)',
+                    ids)
+                if parent_id is not None:
+                    cursor.execute(
+                        f'INSERT INTO {table} (ancestor_id, descendant_id, depth) '
+                        f'SELECT sup.ancestor_id, sub.descendant_id, sup.depth + sub.depth + 1 '
+                        f'FROM {table} sup, {table} sub WHERE sup.descendant_id = %s AND sub.ancestor_id IN ({marks})',
+                        [parent_id, *ids])
+            self.filter(id__in = ids).update(parent_id = parent_id, version = F('version') + 1)
+            # The UPDATE skips post_save, do what its handlers would have done
+            ChangeEvent.record(Category, ids, ChangeEvent.UPDATE)
+            sharding.replicate(Category, ids)
+            catalog_cache.bump_on_commit(['category'])
+        for category in {id(category): category for category in categories}.values():
+            category.parent = parent
+            category._saved_parent_id = parent_id
+            category.version += 1
+
+
+class Category(VersionedModel):
+    objects = CategoryManager()
+
+    def __init__(self, *args, **kwargs):
+        super(Category, self).__init__(*args, **kwargs)
+        self._saved_parent_id = self.__dict__.get('parent_id', models.DEFERRED)
+
+    CONSTRAINT_MESSAGES = {
+        'CRUD_category.name': 'Name cannot be empty or none',
+        'category_name_not_empty': 'Name cannot be empty or none',
+    }
+
     def save(self, *args, **kwargs):
-        if self.name is None or self.name == '':
-            raise ValidationError('Name cannot be empty or none')
-        super(Category, self).save(*args, **kwargs)
-        
+        created = self._state.adding
+        update_fields = kwargs.get('update_fields')
+        # The subtree only moves when the parent is one of the saved fields
+        moves = not created and (update_fields is None or 'parent' in update_fields or 'parent_id' in update_fields)
+        saved_parent_id = self._saved_parent_id
+        if moves and saved_parent_id is models.DEFERRED:
+            saved_parent_id = Category.objects.filter(id = self.id).values_list('parent_id', flat = True).first()
+        with constraint_errors(self.CONSTRAINT_MESSAGES):
+            if moves and self.parent_id != saved_parent_id:
+                self._move_subtree()
+            super(Category, self).save(*args, **kwargs)
+            if created:
+                self._insert_closure()
+        if created or moves:
+            self._saved_parent_id = self.parent_id
+
+    def _insert_closure(self):
+        table = CategoryClosure._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {table} (ancestor_id, descendant_id, depth) '
+                f'SELECT ancestor_id, %s, depth + 1 FROM {table} WHERE descendant_id = %s '
+                f'UNION ALL SELECT %s, %s, 0',
+                [self.id, self.parent_id, self.id, self.id])
+
+    def _move_subtree(self):
+        if self.parent_id is not None and CategoryClosure.objects.filter(ancestor_id = self.id, descendant_id = self.parent_id).exists():
+            raise ValidationError('Category cannot be moved below itself')
+        table = CategoryClosure._meta.db_table
+        with connection.cursor() as cursor:
+            # Cut every path from outside the subtree into it, then graft the subtree below the new parent
+            cursor.execute(
+                f'DELETE FROM {table} WHERE descendant_id IN (SELECT descendant_id FROM {table} WHERE ancestor_id = %s) '
+                f'AND ancestor_id NOT IN (SELECT descendant_id FROM {table} WHERE ancestor_id = %s)',
+                [self.id, self.id])
+            if self.parent_id is not None:
+                cursor.execute(
+                    f'INSERT INTO {table} (ancestor_id, descendant_id, depth) '
+                    f'SELECT sup.ancestor_id, sub.descendant_id, sup.depth + sub.depth + 1 '
+                    f'FROM {table} sup, {table} sub WHERE sup.descendant_id = %s AND sub.ancestor_id = %s',
+                    [self.parent_id, self.id])
+
+    def subtree_products(self):
+        if sharding.enabled():
+            # The closure is only in the default database, the query fans out by category id
+            return Product.objects.filter(category_id__in = list(self.descendant_links.values_list('descendant_id', flat = True)))
+        return Product.objects.filter(category__ancestor_links__ancestor = self)
+
     name = models.CharField(max_length = 255, null = False, blank = False)
+    slug = models.SlugField(max_length = 255, unique = True, blank = True, null = True) # Natural key for imports
     description = models.CharField(max_length = 5000, blank=True, null = True)
+    parent = models.ForeignKey('self', on_delete = models.CASCADE, blank = True, null = True, related_name = 'children') # If parent is deleted, delete the whole subtree
+
+    class Meta:
+        constraints = [models.CheckConstraint(check = ~Q(name = ''), name = 'category_name_not_empty')]
+
+
+class CategoryClosure(models.Model):
+    # One row for every (ancestor, descendant) pair, including each category with itself at depth 0
+    ancestor = models.ForeignKey(Category, on_delete = models.CASCADE, related_name = 'descendant_links')
+    descendant = models.ForeignKey(Category, on_delete = models.CASCADE, related_name = 'ancestor_links')
+    depth = models.IntegerField()
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields = ['ancestor', 'descendant'], name = 'unique_category_closure')]
     
     
-class Promotion(models.Model):
+class PromotionQuerySet(models.QuerySet):
+    def active_at(self, when = None):
+        return self.filter(active_at_q('', when or timezone.now()))
+
+    def apply_schedule(self, when = None, chunk_size = 1000):
+        # Detaches products from promotions whose window has ended, then attaches the
+        # members of active promotions that have no promotion yet. A product assigned to
+        # a promotion that has not started keeps it, its discount applies once it starts.
+        from . import analytics
+        when = when or timezone.now()
+        active = self.active_at(when)
+        ended = Product.objects.filter(promotion__isnull = False).exclude(promotion__in = active).exclude(promotion__starts_at__gt = when)
+        detached = update_in_chunks(ended, chunk_size, promotion = None)
+        attached = 0
+        through = Promotion.products.through
+        # Membership rows live next to their products, so look for members on every shard
+        members = set()
+        for using in sharding.product_databases():
+            members.update(through.objects.using(using).filter(promotion__in = active).values_list('promotion_id', flat = True).distinct())
+        for promotion_id in sorted(members):
+            attached += update_in_chunks(Product.objects.filter(promotions = promotion_id, promotion__isnull = True), chunk_size, promotion = promotion_id)
+        # Products assigned ahead of a start get their discount without any write
+        analytics.mark_window_changes(when)
+        return attached, detached
+
+
+class Promotion(VersionedModel):
+    objects = PromotionQuerySet.as_manager()
+
+    CONSTRAINT_MESSAGES = {
+        'CRUD_promotion.name': 'Name cannot be empty or none',
+        'promotion_name_not_empty': 'Name cannot be empty or none',
+        'promotion_discount_not_null': 'Discount cannot be none',
+        'promotion_discount_non_negative': 'Discount cannot be negative',
+        'promotion_window_ordered': 'Promotion must end after it starts',
+    }
+
+    def __init__(self, *args, **kwargs):
+        super(Promotion, self).__init__(*args, **kwargs)
+        self._saved_pricing_key = self.pricing_key()
+
+    def pricing_key(self):
+        # What price analytics depend on, see analytics.promotion_saved
+        return tuple(self.__dict__.get(field, models.DEFERRED) for field in ('discount', 'starts_at', 'ends_at'))
+
     def save(self, *args, **kwargs):
-        if self.name is None or self.name == '':
-            raise ValidationError('Name cannot be empty or none')
-        if self.discount is None:
-            raise ValidationError('Discount cannot be none')
-        if self.discount < 0:
-            raise ValidationError('Discount cannot be negative')
-        super(Promotion, self).save(*args, **kwargs)
+        with constraint_errors(self.CONSTRAINT_MESSAGES):
+            super(Promotion, self).save(*args, **kwargs)
+        self._saved_pricing_key = self.pricing_key()
+
+    def set_products(self, products):
+        # products.set() for a sharded catalog, where membership rows live next to their
+        # products: each shard's members are set on that shard
+        if not sharding.enabled():
+            return self.products.set(products)
+        by_shard = {using: [] for using in sharding.product_databases()}
+        for product in products:
+            by_shard[sharding.shard_of(product)].append(product)
+        for using, members in by_shard.items():
+            with sharding.pinned(using):
+                self.products.set(members)
+
+    def retire(self, chunk_size = 1000, report_progress = None):
+        # Same end state as delete(), but products are detached in batches.
+        # report_progress(done, total) is called as rows are detached.
+        through = Promotion.products.through
+        done = 0
+
+        def advance(count):
+            nonlocal done
+            done += count
+            if report_progress is not None:
+                report_progress(done)
+
+        if report_progress is not None:
+            report_progress(0, sum(Product.objects.using(using).filter(promotion = self).count() + through.objects.using(using).filter(promotion = self).count()
+                                   for using in sharding.product_databases()))
+        update_in_chunks(Product.objects.filter(promotion = self), chunk_size, on_chunk = advance, promotion = None)
+
+        for using in sharding.product_databases():
+            while True:
+                with transaction.atomic(using = using):
+                    rows = list(through.objects.using(using).filter(promotion = self).values_list('id', 'product_id')[:chunk_size])
+                    if not rows:
+                        break
+                    through.objects.using(using).filter(id__in = [row[0] for row in rows]).delete()
+                    ChangeEvent.record(Product, [row[1] for row in rows], ChangeEvent.UPDATE, using)
+                    products_bulk_changed.send(sender = Product, ids = [row[1] for row in rows], fields = ['promotions'], using = using)
+                advance(len(rows))
+
+        self.delete()
         
     name = models.CharField(max_length = 255, null = False, blank = False)
+    slug = models.SlugField(max_length = 255, unique = True, blank = True, null = True) # Natural key for imports
     description = models.CharField(max_length = 5000, blank=True, null = True)
     discount = models.FloatField(blank = True, null = True, validators=[MinValueValidator(0.0)])
     products = models.ManyToManyField('Product', blank = True, symmetrical=False, related_name='promotions')
+    starts_at = models.DateTimeField(blank = True, null = True) # No bounds means always active
+    ends_at = models.DateTimeField(blank = True, null = True)
+
+    class Meta:
+        indexes = [models.Index(fields = ['starts_at', 'ends_at'])]
+        constraints = [
+            models.CheckConstraint(check = ~Q(name = ''), name = 'promotion_name_not_empty'),
+            # discount stays a nullable column, the constraint is what forbids null
+            models.CheckConstraint(check = Q(discount__isnull = False), name = 'promotion_discount_not_null'),
+            models.CheckConstraint(check = Q(discount__gte = 0), name = 'promotion_discount_non_negative'),
+            models.CheckConstraint(check = Q(starts_at__isnull = True) | Q(ends_at__isnull = True) | Q(ends_at__gt = F('starts_at')),
+                                   name = 'promotion_window_ordered'),
+        ]
+
+
+class ImageUrl(models.Model):
+    @staticmethod
+    def hash_url(url):
+        return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def intern(cls, url):
+        if url is None:
+            return None
+        image, _ = cls.objects.get_or_create(hash = cls.hash_url(url), defaults = {'url': url})
+        return image
+
+    @classmethod
+    def intern_many(cls, urls):
+        # Returns {url: id} for all given urls, inserting the missing ones in one statement
+        urls = {url for url in urls if url is not None}
+        cls.objects.bulk_create([cls(hash = cls.hash_url(url), url = url) for url in urls], ignore_conflicts = True)
+        ids = dict(cls.objects.filter(hash__in = [cls.hash_url(url) for url in urls]).values_list('url', 'id'))
+        sharding.replicate(cls, list(ids.values()))
+        return ids
+
+    hash = models.CharField(max_length = 64, unique = True)
+    url = models.CharField(max_length = 2083)
+
+
+class ProductQuerySet(models.QuerySet):
+    def with_image(self):
+        # For code that reads image_url on many instances, joins the url in the same query
+        return self.select_related('image')
+
+    def _filter_or_exclude(self, negate, args, kwargs):
+        # image_url is stored in ImageUrl, filters on it go through the foreign key
+        kwargs = {('image__url' + name[len('image_url'):] if name == 'image_url' or name.startswith('image_url__') else name): value
+                  for name, value in kwargs.items()}
+        return super()._filter_or_exclude(negate, args, kwargs)
+
+    def with_effective_discount(self, when = None):
+        # Discount of the product's promotion if it is running at `when`, otherwise 0
+        return self.annotate(effective_discount = Case(
+            When(active_at_q('promotion__', when or timezone.now()) & Q(promotion__isnull = False), then = F('promotion__discount')),
+            default = 0.0,
+            output_field = models.FloatField()))
+
+    # With shards, a query no shard can answer alone (see sharding.fans_out()) is run on
+    # every shard: rows are merged on the order_by, counts and updates added up
+
+    def _fetch_all(self):
+        if self._result_cache is None and sharding.fans_out(self):
+            self._result_cache = sharding.fanout(self)
+        super()._fetch_all()
+
+    def iterator(self, chunk_size = None):
+        if sharding.fans_out(self):
+            return iter(sharding.fanout(self))
+        return super().iterator(chunk_size)
+
+    def count(self):
+        if self._result_cache is not None or not sharding.fans_out(self):
+            return super().count()
+        if self.query.is_sliced:
+            return len(self)
+        return sum(self.using(using).count() for using in sharding.product_databases())
+
+    def exists(self):
+        if self._result_cache is None and sharding.fans_out(self):
+            return any(self.using(using).exists() for using in sharding.product_databases())
+        return super().exists()
+
+    def update(self, **kwargs):
+        if sharding.fans_out(self):
+            return sum(self.using(using).update(**kwargs) for using in sharding.product_databases())
+        return super().update(**kwargs)
+
+    def delete(self):
+        if sharding.fans_out(self):
+            deleted, counts = 0, Counter()
+            for using in sharding.product_databases():
+                shard_deleted, shard_counts = self.using(using).delete()
+                deleted += shard_deleted
+                counts.update(shard_counts)
+            return deleted, dict(counts)
+        return super().delete()
+
+
+class ProductManager(models.Manager.from_queryset(ProductQuerySet)):
+    @staticmethod
+    def check_change(change):
+        # Same rules as Product.save() for the two fields a batch may touch
+        if not isinstance(change, dict) or not isinstance(change.get('id'), int) or isinstance(change.get('id'), bool):
+            return 'Change must have an integer id'
+        if 'price' not in change and 'stock' not in change:
+            return 'Change must set price or stock'
+        if 'price' in change:
+            price = change['price']
+            if price is None:
+                return 'Price cannot be none'
+            if isinstance(price, bool) or not isinstance(price, (int, float)) or not math.isfinite(price):
+                return 'Price must be a number'
+            if price < 0:
+                return 'Price cannot be negative'
+        if 'stock' in change:
+            stock = change['stock']
+            if stock is None:
+                return 'Stock cannot be none'
+            if isinstance(stock, bool) or not isinstance(stock, int):
+                return 'Stock must be an integer'
+        return None
+
+    def batch_update(self, changes, chunk_size = 500):
+        # Applies [{id, price?, stock?}, ...] with one CASE-based UPDATE per chunk, all in
+        # one transaction per shard. Invalid items are skipped and reported, the rest still apply.
+        from . import analytics, stockwatch
+        results = []
+        valid = {}
+        for change in changes:
+            error = self.check_change(change)
+            if error is None and change['id'] in valid:
+                error = 'Duplicate id in batch'
+            results.append({'id': change.get('id') if isinstance(change, dict) else None, 'ok': error is None, 'error': error})
+            if error is None:
+                valid[change['id']] = change
+
+        ids = list(valid)
+        existing = set()
+        for using in sharding.product_databases():
+            with transaction.atomic(using = using):
+                for start in range(0, len(ids), chunk_size):
+                    chunk = [valid[product_id] for product_id in ids[start:start + chunk_size]]
+                    rows = list(self.using(using).filter(id__in = [change['id'] for change in chunk]).values_list('id', 'category_id', 'low_stock', 'promotion_id'))
+                    found = [row[0] for row in rows]
+                    if not found:
+                        continue
+                    values = {}
+                    for field, output_field in (('price', models.FloatField()), ('stock', models.IntegerField())):
+                        whens = [When(id = change['id'], then = Value(change[field])) for change in chunk if field in change and change['id'] in found]
+                        if whens:
+                            values[field] = Case(*whens, default = F(field), output_field = output_field)
+                    # The low stock flag is known from the new stock values, set it in the same UPDATE
+                    crossed = stockwatch.crossings([(product_id, category_id, valid[product_id]['stock'], low_stock)
+                                                    for product_id, category_id, low_stock, _ in rows if 'stock' in valid[product_id]])
+                    if crossed:
+                        values['low_stock'] = Case(*[When(id = crossing[0], then = Value(crossing[4])) for crossing in crossed],
+                                                   default = F('low_stock'), output_field = models.BooleanField())
+                    existing.update(found)
+                    self.using(using).filter(id__in = found).update(version = F('version') + 1, **values)
+                    stockwatch.alert(crossed, using)
+                    analytics.mark_products(((category_id, promotion_id) for _, category_id, _, promotion_id in rows), using)
+                    ChangeEvent.record(Product, found, ChangeEvent.UPDATE, using)
+                    products_bulk_changed.send(sender = Product, ids = found, fields = [field for field in values if field != 'low_stock'], using = using)
 
+        for result in results:
+            if result['ok'] and result['id'] not in existing:
+                result['ok'], result['error'] = False, 'Product does not exist'
+        return results
+
+    def upsert(self, rows, chunk_size = 500):
+        # Inserts or updates products by sku, so re-importing the same feed is idempotent and
+        # rows that did not change are not written at all. Rows hold sku, name, price, stock and
+        # category (slug), optionally promotion (slug), image_url and description, and
+        # every row must carry the same keys. Partial changes go through batch_update().
+        # Returns (created, updated) counts, unchanged rows count as neither.
+        rows = list(rows)
+        if any(not row.get('sku') for row in rows):
+            # NULL never conflicts, such a row would be inserted again on every import
+            raise ValueError('Every row must have a sku')
+        rows = list({row['sku']: row for row in rows}.values())
+        if not rows:
+            return 0, 0
+        keys = set(rows[0])
+        if any(set(row) != keys for row in rows):
+            raise ValueError('All rows must have the same keys')
+        missing = {'name', 'price', 'stock', 'category'} - keys
+        if missing:
+            raise ValueError(f'Rows are missing {", ".join(sorted(missing))}')
+        columns = {'name': 'name', 'price': 'price', 'stock': 'stock', 'category': 'category_id', 'promotion': 'promotion_id', 'image_url': 'image_id'}
+        update_fields = [columns[key] for key in columns if key in keys]
+
+        categories = dict(Category.objects.filter(slug__in = {row['category'] for row in rows}).values_list('slug', 'id'))
+        promotions = dict(Promotion.objects.filter(slug__in = {row['promotion'] for row in rows}).values_list('slug', 'id')) if 'promotion' in keys else {}
+        for row in rows:
+            if row['category'] not in categories:
+                raise Category.DoesNotExist(f'Unknown category {row["category"]}')
+        shards = {category_id: sharding.shard_for_category(category_id) for category_id in categories.values()}
+        created = updated = 0
+        for start in range(0, len(rows), chunk_size):
+            by_shard = {}
+            for row in rows[start:start + chunk_size]:
+                by_shard.setdefault(shards[categories[row['category']]], []).append(row)
+            for using, chunk in by_shard.items():
+                chunk_created, chunk_updated = self._upsert_chunk(chunk, using, keys, update_fields, categories, promotions)
+                created += chunk_created
+                updated += chunk_updated
+        return created, updated
+
+    def _upsert_chunk(self, chunk, using, keys, update_fields, categories, promotions):
+        from . import analytics, stockwatch
+        skus = [row['sku'] for row in chunk]
+        # Image urls are written to the default database, in the same transaction as the
+        # chunk so a failing chunk leaves no unused ones behind
+        with transaction.atomic(using = DEFAULT_DB_ALIAS), constraint_errors(Product.CONSTRAINT_MESSAGES, using = using):
+            images = ImageUrl.intern_many(row['image_url'] for row in chunk) if 'image_url' in keys else {}
+            for source in sharding.product_databases():
+                # A row whose category now lives on another shard moves there first
+                if source != using:
+                    sharding.move_products(self.using(source).filter(sku__in = skus).values_list('id', flat = True), source, using)
+            # Rows equal to what is stored are left alone: no write, version bump, change
+            # event or stale mark, so re-importing an unchanged feed only reads
+            fields = list(dict.fromkeys(['id', 'low_stock', 'category_id', 'promotion_id', *update_fields]))
+            previous = {row['sku']: row for row in self.using(using).filter(sku__in = skus).values('sku', *fields)}
+            texts = ProductDetails.texts([row['id'] for row in previous.values()], using) if 'description' in keys else {}
+
+            inserted = []
+            updated = []
+            scopes = []
+            for row in chunk:
+                values = {'name': row['name'], 'price': row['price'], 'stock': row['stock'], 'category_id': categories[row['category']]}
+                if 'promotion' in keys:
+                    if row['promotion'] is not None and row['promotion'] not in promotions:
+                        raise Promotion.DoesNotExist(f'Unknown promotion {row["promotion"]}')
+                    values['promotion_id'] = promotions.get(row['promotion'])
+                if 'image_url' in keys:
+                    values['image_id'] = images.get(row['image_url'])
+                stored = previous.get(row['sku'])
+                if stored is not None and all(stored[field] == values[field] for field in update_fields) and texts.get(stored['id']) == row.get('description'):
+                    continue
+                # Price summaries of the old and the new category and promotion go stale
+                scopes.append((values['category_id'], values.get('promotion_id', stored and stored['promotion_id'])))
+                if stored is None:
+                    if sharding.enabled():
+                        values['id'] = sharding.next_product_id()
+                    inserted.append((row, values))
+                else:
+                    scopes.append((stored['category_id'], stored['promotion_id']))
+                    updated.append((row, values))
+            if not inserted and not updated:
+                return 0, 0
+
+            # Plain statements run once per row: building a model instance per row for
+            # bulk_create() cost more than the writes. A row another import inserted
+            # meanwhile is updated by ON CONFLICT, with the version bumped like any update.
+            connection = connections[using]
+            table = connection.ops.quote_name(Product._meta.db_table)
+            quote = connection.ops.quote_name
+            with connection.cursor() as cursor:
+                if inserted:
+                    columns = ['sku', 'version', 'low_stock', *update_fields] + (['id'] if sharding.enabled() else [])
+                    cursor.executemany(
+                        f'INSERT INTO {table} ({", ".join(quote(column) for column in columns)}) VALUES ({", ".join(["%s"] * len(columns))}) '
+                        f'ON CONFLICT ({quote("sku")}) DO UPDATE SET {", ".join(f"{quote(field)} = excluded.{quote(field)}" for field in update_fields)}, '
+                        f'{quote("version")} = {table}.{quote("version")} + 1',
+                        [(row['sku'], 0, False, *(values[field] for field in update_fields), *([values['id']] if sharding.enabled() else [])) for row, values in inserted])
+                if updated:
+                    cursor.executemany(
+                        f'UPDATE {table} SET {", ".join(f"{quote(field)} = %s" for field in update_fields)}, {quote("version")} = {quote("version")} + 1 WHERE {quote("id")} = %s',
+                        [(*(values[field] for field in update_fields), previous[row['sku']]['id']) for row, values in updated])
+
+            ids = {sku: stored['id'] for sku, stored in previous.items()}
+            if inserted and not sharding.enabled():
+                ids.update(self.using(using).filter(sku__in = [row['sku'] for row, _ in inserted]).values_list('sku', 'id'))
+            else:
+                ids.update((row['sku'], values['id']) for row, values in inserted)
+            new_ids = [ids[row['sku']] for row, _ in inserted]
+            old_ids = [ids[row['sku']] for row, _ in updated]
+            # Stock, category and the stored flag are all known here, nothing to read back
+            stockwatch.flip(using, stockwatch.crossings([(ids[row['sku']], values['category_id'], values['stock'], previous[row['sku']]['low_stock'] if row['sku'] in previous else False)
+                                                         for row, values in inserted + updated]))
+            analytics.mark_products(scopes, using)
+            if 'description' in keys:
+                ProductDetails.store_many({ids[row['sku']]: row['description'] for row, _ in inserted + updated if texts.get(ids[row['sku']]) != row['description']}, using = using)
+            ChangeEvent.record(Product, new_ids, ChangeEvent.CREATE, using)
+            ChangeEvent.record(Product, old_ids, ChangeEvent.UPDATE, using)
+            products_bulk_changed.send(sender = Product, ids = new_ids + old_ids, fields = None, using = using)
+        return len(new_ids), len(old_ids)
+
+
+class Product(VersionedModel):
+    objects = ProductManager()
+
+    # Fields the related products ranking depends on, see related.py
+    RELATED_FIELDS = ('category_id', 'price', 'promotion_id')
+
+    def __init__(self, *args, **kwargs):
+        super(Product, self).__init__(*args, **kwargs)
+        self._saved_related_key = tuple(self.__dict__.get(field, models.DEFERRED) for field in self.RELATED_FIELDS)
+        self._saved_stock_key = (self.__dict__.get('category_id', models.DEFERRED), self.__dict__.get('stock', models.DEFERRED))
+
+    @property
+    def image_url(self):
+        if hasattr(self, '_image_url'):
+            return self._image_url
+        return self.image.url if self.image_id is not None else None
+
+    @image_url.setter
+    def image_url(self, value):
+        self._image_url = value
+
+    @property
+    def description(self):
+        if not hasattr(self, '_description'):
+            try:
+                self._description = self.details.text
+            except ProductDetails.DoesNotExist:
+                self._description = None
+        return self._description
+
+    @description.setter
+    def description(self, value):
+        self._description = value
+        self._description_changed = True
+
+    def refresh_from_db(self, *args, **kwargs):
+        # Unsaved image and description values are dropped like any other field's
+        for name in ('_image_url', '_description', '_description_changed'):
+            self.__dict__.pop(name, None)
+        super(Product, self).refresh_from_db(*args, **kwargs)
+
+    CONSTRAINT_MESSAGES = {
+        'CRUD_product.name': 'Name cannot be empty or none',
+        'product_name_not_empty': 'Name cannot be empty or none',
+        'CRUD_product.price': 'Price cannot be none',
+        'CRUD_product.stock': 'Stock cannot be none',
+        'product_price_non_negative': 'Price cannot be negative',
+    }
 
-class Product(models.Model):
     def save(self, *args, **kwargs):
-        if self.name is None or self.name == '':
-            raise ValidationError('Name cannot be empty or none')
-        if self.category is None:
-            raise ValidationError('Category cannot be none')
-        if self.price is None:
-            raise ValidationError('Price cannot be none')
-        if self.stock is None:
-            raise ValidationError('Stock cannot be none')
-        if self.price < 0:
-            raise ValidationError('Price cannot be negative')
-        super(Product, self).save(*args, **kwargs)
+        if self.category_id is None:
+            # Checked by id, loading the category just to compare it with None costs a query
+            raise Product.category.RelatedObjectDoesNotExist('Product has no category.')
+        if not sharding.enabled():
+            return self.save_on(None, *args, **kwargs)
+        if self._state.adding and self.id is None:
+            # No shard has a row with a new id, skip the UPDATE save() tries first
+            self.id = sharding.next_product_id()
+            kwargs['force_insert'] = True
+        # The cached placement is checked on the shard, a save that raced a rebalance is
+        # rolled back and done again on the shard read from the default database
+        adding, version = self._state.adding, self.version
+        try:
+            return self.save_on(sharding.shard_for_category(self.category_id, cached = True), *args, **kwargs)
+        except sharding.PlacementChanged:
+            self._state.adding, self.version = adding, version
+        return self.save_on(sharding.shard_for_category(self.category_id), *args, **kwargs)
+
+    def save_on(self, shard, *args, **kwargs):
+        from . import analytics, stockwatch
+        if shard is not None:
+            # The row lives on its category's shard, follow the category when it moves
+            if not self._state.adding and self._state.db != shard:
+                sharding.move_products([self.id], self._state.db, shard)
+                self._state.db = shard
+            kwargs['using'] = shard
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None:
+            store_description = self.__dict__.get('_description_changed', False)
+        else:
+            # The url is saved through the image foreign key and the description in
+            # ProductDetails. Saving only the description still saves the version, so
+            # it is recorded like any other change.
+            store_description = 'description' in update_fields
+            fields = ['image' if field == 'image_url' else field for field in update_fields if field != 'description']
+            kwargs['update_fields'] = fields or (['version'] if update_fields else [])
+        created = self._state.adding
+        crossed = False
+        saves_stock = update_fields is None or not {'stock', 'category', 'category_id'}.isdisjoint(update_fields)
+        if saves_stock and (created or (self.category_id, self.stock) != self._saved_stock_key) and self.stock is not None:
+            # The flag is written by this same save, only a crossing costs an extra insert
+            threshold = stockwatch.thresholds([self.category_id])[self.category_id]
+            crossed = (self.stock < threshold) != self.low_stock
+            self.low_stock = self.stock < threshold
+            if crossed and update_fields is not None:
+                kwargs['update_fields'] = [*kwargs['update_fields'], 'low_stock']
+        related_key = tuple(getattr(self, field) for field in self.RELATED_FIELDS)
+        stock_key = (self.category_id, self.stock)
+        with constraint_errors(self.CONSTRAINT_MESSAGES, using = kwargs.get('using')):
+            if hasattr(self, '_image_url'):
+                self.image = ImageUrl.intern(self._image_url)
+            super(Product, self).save(*args, **kwargs)
+            if shard is not None:
+                sharding.check_placement(self.category_id, shard)
+            if store_description:
+                self.__dict__.pop('_description_changed', None)
+                ProductDetails.store(self, self.description)
+            # Side rows go to the product's database in the same transaction, see sharding.RELAYED_MODELS
+            using = self._state.db
+            if crossed:
+                stockwatch.alert([(self.id, self.category_id, self.stock, threshold, self.low_stock)], using)
+            if created or related_key != self._saved_related_key or stock_key != self._saved_stock_key:
+                # Price summaries of the category and promotion it left and the ones it is in now
+                saved_category_id, _, saved_promotion_id = self._saved_related_key
+                analytics.mark_stale({saved_category_id, self.category_id} - {models.DEFERRED}, {saved_promotion_id, self.promotion_id} - {models.DEFERRED}, using)
+            if created or related_key != self._saved_related_key:
+                RelatedRefresh.objects.using(using).create(product_id = self.id)
+        if saves_stock:
+            self._saved_stock_key = stock_key
+        self._saved_related_key = related_key
     
+    sku = models.CharField(max_length = 64, unique = True, blank = True, null = True) # Business key from the feed, unique when set
     name = models.CharField(max_length = 255, null = False, blank = False)
     price = models.FloatField(blank = False, null = False, validators=[MinValueValidator(0.0)])
     stock = models.IntegerField(blank = False, null = False)
-    image_url = models.CharField(max_length = 2083, blank = True, null = True)
-    description = models.CharField(max_length = 5000, blank=True, null = True)
+    image = models.ForeignKey(ImageUrl, on_delete = models.PROTECT, blank = True, null = True) # Shared by all products with the same url, read through image_url
     category = models.ForeignKey(Category, on_delete = models.CASCADE) # If category is deleted, delete the product
     promotion = models.ForeignKey(Promotion, on_delete = models.SET_NULL, blank = True, null = True) # If promotion is deleted, set promotion to null
+    low_stock = models.BooleanField(default = False, editable = False) # stock below the threshold, kept by the stock update paths
+
+    class Meta:
+        # Only low stock rows are indexed, so the low stock dashboard never touches the rest
+        indexes = [models.Index(fields = ['stock', 'id'], condition = Q(low_stock = True), name = 'product_low_stock_idx')]
+        constraints = [
+            models.CheckConstraint(check = ~Q(name = ''), name = 'product_name_not_empty'),
+            models.CheckConstraint(check = Q(price__gte = 0), name = 'product_price_non_negative'),
+        ]
     
+
+
+class ProductDetails(models.Model):
+    # Cold columns of Product, kept off the product row so listings and stock updates stay narrow
+    COMPRESS_MIN_LENGTH = 512
+
+    @classmethod
+    def pack(cls, text):
+        # Returns (raw, compressed), only one of them is set
+        if len(text) >= cls.COMPRESS_MIN_LENGTH:
+            packed = zlib.compress(text.encode('utf-8'))
+            if len(packed) < len(text.encode('utf-8')):
+                return None, packed
+        return text, None
+
+    @classmethod
+    def store(cls, product, text):
+        # Details live in the same database as their product
+        if text is None:
+            cls.objects.using(product._state.db).filter(product = product).delete()
+            return
+        raw, compressed = cls.pack(text)
+        cls.objects.using(product._state.db).update_or_create(product = product, defaults = {'raw': raw, 'compressed': compressed})
+
+    @classmethod
+    def store_many(cls, texts, using = None):
+        # texts is {product_id: text or None}, all products in the using database
+        cls.objects.db_manager(using).filter(product_id__in = [product_id for product_id, text in texts.items() if text is None]).delete()
+        details = [cls(product_id = product_id, raw = raw, compressed = compressed)
+                   for product_id, (raw, compressed) in ((product_id, cls.pack(text)) for product_id, text in texts.items() if text is not None)]
+        cls.objects.db_manager(using).bulk_create(details, update_conflicts = True, unique_fields = ['product'], update_fields = ['raw', 'compressed'])
+
+    @classmethod
+    def texts(cls, ids, using = None):
+        # {product_id: text} of the given products that have one
+        return {details.product_id: details.text for details in cls.objects.db_manager(using).filter(product_id__in = ids)}
+
+    @property
+    def text(self):
+        if self.compressed is not None:
+            return zlib.decompress(self.compressed).decode('utf-8')
+        return self.raw
+
+    product = models.OneToOneField(Product, on_delete = models.CASCADE, primary_key = True, related_name = 'details')
+    raw = models.CharField(max_length = 5000, blank = True, null = True)
+    compressed = models.BinaryField(blank = True, null = True)
+
+
+class ChangeEvent(models.Model):
+    # Ordered outbox of catalog changes, consumers pull everything with id > their cursor
+    CREATE = 'create'
+    UPDATE = 'update'
+    DELETE = 'delete'
+    ACTION_CHOICES = [(CREATE, 'Create'), (UPDATE, 'Update'), (DELETE, 'Delete')]
+    TRACKED_MODELS = ('product', 'category', 'promotion')
+
+    @classmethod
+    def record(cls, model, ids, action, using = None):
+        # Events are written on the database of the change, in its transaction. A shard's
+        # events are relayed to the default database after it commits.
+        model_name = model._meta.model_name
+        if model_name not in cls.TRACKED_MODELS:
+            return
+        ids = list(ids)
+        if not ids:
+            return
+        using = using or DEFAULT_DB_ALIAS
+        connection = connections[using]
+        now = connection.ops.adapt_datetimefield_value(timezone.now())
+        # One prepared INSERT run per id, bulk imports log tens of thousands of events and
+        # building a model instance for each costs more than the write
+        with connection.cursor() as cursor:
+            cursor.executemany(f'INSERT INTO {cls._meta.db_table} (model, object_id, action, created_at) VALUES (%s, %s, %s, %s)',
+                               [(model_name, object_id, action, now) for object_id in ids])
+        sharding.relay_on_commit(using)
+
+    @classmethod
+    def record_queryset(cls, queryset, action):
+        # Set-based variant for side effects the ORM applies without signals (SET_NULL, M2M cleanup)
+        connection = connections[queryset.db]
+        sql, params = queryset.values('id').distinct().query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {cls._meta.db_table} (model, object_id, action, created_at) '
+                f'SELECT %s, id, %s, %s FROM ({sql}) AS changed',
+                [queryset.model._meta.model_name, action, connection.ops.adapt_datetimefield_value(timezone.now()), *params])
+        sharding.relay_on_commit(queryset.db)
+
+    @classmethod
+    def compact(cls, older_than = None):
+        # Only the newest event per object matters to a consumer, since it re-reads the object.
+        # Returns (superseded, expired) counts. The newest event overall is always kept so
+        # ids keep growing and cursors stay valid.
+        latest = cls.objects.values('model', 'object_id').annotate(latest = Max('id')).values('latest')
+        superseded, _ = cls.objects.exclude(id__in = latest).delete()
+        expired = 0
+        if older_than is not None:
+            newest = cls.objects.aggregate(newest = Max('id'))['newest']
+            expired, _ = cls.objects.filter(created_at__lt = older_than).exclude(id = newest).delete()
+        return superseded, expired
+
+    model = models.CharField(max_length = 32)
+    object_id = models.BigIntegerField()
+    action = models.CharField(max_length = 16, choices = ACTION_CHOICES)
+    created_at = models.DateTimeField(default = timezone.now)
+
+    class Meta:
+        indexes = [models.Index(fields = ['model', 'object_id'])]
+
+
+class Job(models.Model):
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(PENDING, 'Pending'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed')]
+
+    def claimed(self):
+        # Every claim increments attempts, so it identifies the claim this instance holds
+        return Job.objects.filter(id = self.id, status = Job.RUNNING, attempts = self.attempts)
+
+    def report_progress(self, done, total = None):
+        # Also renews the worker's lease, long tasks should report at least once per lease
+        self.progress = done
+        if total is not None:
+            self.total = total
+        self.claimed_at = timezone.now()
+        if not self.claimed().update(progress = self.progress, total = self.total, claimed_at = self.claimed_at):
+            raise LeaseLost(f'Job {self.id} was taken over by another worker')
+
+    name = models.CharField(max_length = 255, null = False, blank = False)
+    kwargs = models.JSONField(default = dict, blank = True)
+    status = models.CharField(max_length = 16, choices = STATUS_CHOICES, default = PENDING)
+    attempts = models.IntegerField(default = 0)
+    max_attempts = models.IntegerField(default = 3)
+    progress = models.IntegerField(default = 0)
+    total = models.IntegerField(blank = True, null = True)
+    error = models.TextField(blank = True, null = True)
+    run_after = models.DateTimeField(default = timezone.now)
+    claimed_at = models.DateTimeField(blank = True, null = True) # Start of the running worker's lease, see jobs.LEASE
+    created_at = models.DateTimeField(auto_now_add = True)
+    finished_at = models.DateTimeField(blank = True, null = True)
+
+    class Meta:
+        indexes = [models.Index(fields = ['status', 'run_after'])]
+
+
+class CategoryShard(models.Model):
+    # Placement overrides written by rebalance_shards, categories without one are placed by hash
+    category = models.OneToOneField(Category, on_delete = models.CASCADE, primary_key = True, related_name = 'shard')
+    alias = models.CharField(max_length = 64)
+
+
+class ProductIdSequence(models.Model):
+    # Single row handing out product ids, shards cannot each use their own autoincrement
+    next_id = models.BigIntegerField()
+
+
+class RelatedProduct(models.Model):
+    # Precomputed "similar products", rank 0 is the closest. Rows live in the same
+    # database as both products, which always share a category.
+    product = models.ForeignKey(Product, on_delete = models.CASCADE, related_name = 'related_links')
+    related = models.ForeignKey(Product, on_delete = models.CASCADE, related_name = 'recommended_by')
+    rank = models.PositiveSmallIntegerField()
+    score = models.FloatField()
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields = ['product', 'rank'], name = 'unique_related_product_rank')]
+
+
+class RelatedRefresh(models.Model):
+    # Products whose related list needs recomputing. category_id alone asks for the
+    # whole category, used when a product is deleted. Plain ids, the rows may be gone.
+    product_id = models.BigIntegerField(blank = True, null = True)
+    category_id = models.BigIntegerField(blank = True, null = True)
+
+
+class StockThreshold(models.Model):
+    # Per category override of settings.LOW_STOCK_THRESHOLD
+    category = models.OneToOneField(Category, on_delete = models.CASCADE, primary_key = True, related_name = 'stock_threshold')
+    threshold = models.PositiveIntegerField()
+
+    def save(self, *args, **kwargs):
+        from . import stockwatch
+        super(StockThreshold, self).save(*args, **kwargs)
+        stockwatch.recheck(self.category_id)
+
+    def delete(self, *args, **kwargs):
+        from . import stockwatch
+        result = super(StockThreshold, self).delete(*args, **kwargs)
+        stockwatch.recheck(self.category_id)
+        return result
+
+
+class StockAlert(models.Model):
+    # A product crossing its low stock threshold, low=False when it was restocked.
+    # Plain ids, the product may be on a shard or gone.
+    product_id = models.BigIntegerField()
+    category_id = models.BigIntegerField()
+    stock = models.IntegerField()
+    threshold = models.IntegerField()
+    low = models.BooleanField()
+    created_at = models.DateTimeField(default = timezone.now)
+
+
+class PriceSummary(models.Model):
+    # Materialized price analytics of one category or promotion, kept by analytics.py.
+    # histogram holds product counts per analytics.PRICE_BUCKETS bucket.
+    SCOPE_CHOICES = [('category', 'Category'), ('promotion', 'Promotion')]
+
+    scope = models.CharField(max_length = 16, choices = SCOPE_CHOICES)
+    scope_id = models.BigIntegerField()
+    product_count = models.IntegerField(default = 0)
+    min_price = models.FloatField(blank = True, null = True)
+    max_price = models.FloatField(blank = True, null = True)
+    avg_price = models.FloatField(blank = True, null = True)
+    inventory_value = models.FloatField(default = 0) # Sum of price * stock
+    discount_value = models.FloatField(default = 0) # Part of inventory_value taken off by promotion discounts
+    histogram = models.JSONField(default = list)
+    stale = models.BooleanField(default = False)
+    updated_at = models.DateTimeField(blank = True, null = True)
+
+    class Meta:
+        indexes = [models.Index(fields = ['id'], condition = Q(stale = True), name = 'price_summary_stale_idx')]
+        constraints = [models.UniqueConstraint(fields = ['scope', 'scope_id'], name = 'unique_price_summary_scope')]
+
+
+
+class ProductPopularity(models.Model):
+    # How often a product was picked from autocomplete suggestions, shared by every
+    # worker. Plain ids, the product may be on a shard or gone.
+    product_id = models.BigIntegerField(primary_key = True)
+    count = models.PositiveIntegerField(default = 0)
+
+    class Meta:
+        indexes = [models.Index(fields = ['-count'], name = 'product_popularity_count_idx')]
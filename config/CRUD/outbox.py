@@ -0,0 +1,40 @@
+from django.db.models import Q
+
+from .models import ChangeEvent, Product
+from .sharding import is_replica_write
+
+
+def saved(sender, instance, created, using, raw = False, **kwargs):
+    if not raw and not is_replica_write(sender, using):
+        ChangeEvent.record(sender, [instance.id], ChangeEvent.CREATE if created else ChangeEvent.UPDATE, using)
+
+
+def deleted(sender, instance, using, **kwargs):
+    # Also fires for every row a CASCADE takes with it
+    if not is_replica_write(sender, using):
+        ChangeEvent.record(sender, [instance.id], ChangeEvent.DELETE, using)
+
+
+def promotion_deleting(sender, instance, using, **kwargs):
+    # SET_NULL on Product.promotion and the Promotion.products cleanup run as plain
+    # UPDATE/DELETE statements without signals, so log the affected products up front.
+    # With shards this runs once per shard, as the promotion is deleted from each.
+    ChangeEvent.record_queryset(Product.objects.using(using).filter(Q(promotion = instance) | Q(promotions = instance)), ChangeEvent.UPDATE)
+
+
+def promotion_products_changed(sender, instance, action, reverse, model, pk_set, using, **kwargs):
+    if action == 'pre_clear':
+        # pk_set is not given for clear(), remember who is about to lose the link
+        if reverse:
+            instance._cleared_promotion_ids = list(instance.promotions.using(using).values_list('id', flat = True))
+        else:
+            instance._cleared_product_ids = list(instance.products.using(using).values_list('id', flat = True))
+        return
+    if action == 'post_clear':
+        pk_set = instance.__dict__.pop('_cleared_promotion_ids' if reverse else '_cleared_product_ids', [])
+    elif action not in ('post_add', 'post_remove'):
+        return
+    if not pk_set:
+        return
+    ChangeEvent.record(type(instance), [instance.id], ChangeEvent.UPDATE, using)
+    ChangeEvent.record(model, pk_set, ChangeEvent.UPDATE, using)
@@ -0,0 +1,113 @@
+import heapq
+
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import Max
+
+from .models import Product, RelatedProduct, RelatedRefresh
+from .sharding import product_databases
+
+RELATED_COUNT = 10
+# Candidates are the WINDOW nearest products by price on each side, the best
+# RELATED_COUNT of them by score are kept
+WINDOW = 2 * RELATED_COUNT
+# Sharing a promotion counts like being this much closer in relative price
+PROMOTION_BONUS = 0.1
+RELATED_CHANGES = {'price', 'category', 'promotion'}
+
+
+def score(product, candidate):
+    # Relative price difference, lower is more similar
+    (_, price, promotion_id), (_, other_price, other_promotion_id) = product, candidate
+    distance = abs(price - other_price) / max(price, other_price, 0.01)
+    if promotion_id is not None and promotion_id == other_promotion_id:
+        distance -= PROMOTION_BONUS
+    return distance
+
+
+def rank(rows, positions):
+    # rows are (id, price, promotion_id) sorted by price, so a product's candidates are
+    # its neighbours in the list and one pass over it ranks the whole category
+    for position in positions:
+        product = rows[position]
+        candidates = rows[max(position - WINDOW, 0):position] + rows[position + 1:position + 1 + WINDOW]
+        best = heapq.nsmallest(RELATED_COUNT, ((score(product, candidate), candidate[0]) for candidate in candidates))
+        yield product[0], best
+
+
+def category_rows(using, category_id):
+    return list(Product.objects.using(using).filter(category_id = category_id).order_by('price', 'id').values_list('id', 'price', 'promotion_id'))
+
+
+def write(using, rows, positions):
+    # Replaces the related lists of the products at positions, returns how many were written
+    links = []
+    product_ids = []
+    for product_id, best in rank(rows, positions):
+        product_ids.append(product_id)
+        links.extend(RelatedProduct(product_id = product_id, related_id = related_id, rank = position, score = related_score)
+                     for position, (related_score, related_id) in enumerate(best))
+    with transaction.atomic(using = using):
+        for start in range(0, len(product_ids), 500):
+            RelatedProduct.objects.using(using).filter(product_id__in = product_ids[start:start + 500]).delete()
+        RelatedProduct.objects.using(using).bulk_create(links, batch_size = 500)
+    return len(product_ids)
+
+
+def rebuild(report_progress = None):
+    # Recomputes every list, one price-sorted scan per category. report_progress(done)
+    # is called after every category.
+    written = 0
+    done = 0
+    for using in product_databases():
+        started = RelatedRefresh.objects.using(using).aggregate(last = Max('id'))['last']
+        RelatedProduct.objects.using(using).all().delete()
+        for category_id in Product.objects.using(using).order_by().values_list('category_id', flat = True).distinct():
+            rows = category_rows(using, category_id)
+            written += write(using, rows, range(len(rows)))
+            done += 1
+            if report_progress is not None:
+                report_progress(done)
+        if started is not None:
+            RelatedRefresh.objects.using(using).filter(id__lte = started).delete()
+    return written
+
+
+def refresh(batch_size = 1000):
+    # Recomputes only the lists a stale product can be part of: its own, the ones that
+    # list it now and the ones whose price window it has moved into. Marks are written
+    # next to their products, each database is refreshed from its own.
+    written = 0
+    for using in product_databases():
+        stale = list(RelatedRefresh.objects.using(using).order_by('id').values_list('id', 'product_id', 'category_id')[:batch_size])
+        if not stale:
+            continue
+        product_ids = {product_id for _, product_id, _ in stale if product_id is not None}
+        whole = {category_id for _, _, category_id in stale if category_id is not None}
+        owners = dict(RelatedProduct.objects.using(using).filter(related_id__in = product_ids).values_list('product_id', 'product__category_id'))
+        current = dict(Product.objects.using(using).filter(id__in = product_ids).values_list('id', 'category_id'))
+        for category_id in set(owners.values()) | set(current.values()) | whole:
+            rows = category_rows(using, category_id)
+            if category_id in whole:
+                positions = set(range(len(rows)))
+            else:
+                positions = set()
+                for position, (product_id, _, _) in enumerate(rows):
+                    if product_id in current:
+                        positions.update(range(max(position - WINDOW, 0), min(position + WINDOW + 1, len(rows))))
+                    elif product_id in owners:
+                        positions.add(position)
+            written += write(using, rows, sorted(positions))
+        RelatedRefresh.objects.using(using).filter(id__lte = stale[-1][0]).delete()
+    return written
+
+
+def products_bulk_changed(sender, ids, fields, using = DEFAULT_DB_ALIAS, **kwargs):
+    if fields is None or RELATED_CHANGES.intersection(fields):
+        # Plain INSERTs, bulk imports mark tens of thousands of products at once
+        with connections[using].cursor() as cursor:
+            cursor.executemany(f'INSERT INTO {RelatedRefresh._meta.db_table} (product_id) VALUES (%s)', [(product_id,) for product_id in ids])
+
+
+def product_deleted(sender, instance, using, **kwargs):
+    # The lists that named it went with it through CASCADE, refill the category
+    RelatedRefresh.objects.using(using).create(category_id = instance.category_id)
@@ -0,0 +1,62 @@
+import json
+import math
+from json.encoder import encode_basestring_ascii
+
+from .sharding import fanout_values_list
+
+def encode_float(value):
+    # float.__repr__ is what json.dumps uses for finite floats
+    return float.__repr__(value) if math.isfinite(value) else json.dumps(value)
+
+
+def nullable(encode):
+    return lambda value: 'null' if value is None else encode(value)
+
+
+# Listing field -> (model attribute, values_list column, JSON encoder). description is
+# left out on purpose, it lives in ProductDetails and listings never load it.
+PRODUCT_FIELDS = {
+    'id': ('id', 'id', int.__repr__),
+    'name': ('name', 'name', encode_basestring_ascii),
+    'price': ('price', 'price', encode_float),
+    'stock': ('stock', 'stock', int.__repr__),
+    'image_url': ('image_url', 'image__url', nullable(encode_basestring_ascii)),
+    'category': ('category_id', 'category_id', nullable(int.__repr__)),
+    'promotion': ('promotion_id', 'promotion_id', nullable(int.__repr__)),
+}
+
+
+def parse_fields(value):
+    if not value:
+        return list(PRODUCT_FIELDS)
+    fields = [field.strip() for field in value.split(',') if field.strip()]
+    unknown = [field for field in fields if field not in PRODUCT_FIELDS]
+    if unknown or not fields:
+        raise ValueError(f'Unknown fields: {", ".join(unknown)}')
+    return fields
+
+
+def serialize_products(products, fields = None):
+    # Reference serializer working on model instances
+    fields = fields or list(PRODUCT_FIELDS)
+    rows = [{field: getattr(product, PRODUCT_FIELDS[field][0]) for field in fields} for product in products]
+    return json.dumps(rows, separators = (',', ':'))
+
+
+def compile_row_encoder(fields):
+    # Builds one format string and encoder list per fieldset instead of
+    # looking up fields and types for every value
+    template = '{' + ','.join(encode_basestring_ascii(field) + ':%s' for field in fields) + '}'
+    encoders = [PRODUCT_FIELDS[field][2] for field in fields]
+
+    def encode_row(row):
+        return template % tuple([encode(value) for encode, value in zip(encoders, row)])
+    return encode_row
+
+
+def serialize_product_rows(queryset, fields = None):
+    # Fast path: selects only the requested columns and never builds model instances
+    fields = fields or list(PRODUCT_FIELDS)
+    encode_row = compile_row_encoder(fields)
+    rows = fanout_values_list(queryset, [PRODUCT_FIELDS[field][1] for field in fields])
+    return '[' + ','.join([encode_row(row) for row in rows]) + ']'
@@ -0,0 +1,445 @@
+import heapq
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import partial
+from itertools import islice
+
+from django.apps import apps
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import F, Q
+from django.db.models.query import ModelIterable, ValuesIterable
+
+# Product rows, their details and their Promotion.products rows live on the shard of
+# their category. Categories, promotions, image urls and category placements are written
+# to the default database and copied to every shard, so foreign keys hold inside each
+# shard file and a shard can tell which categories it holds.
+SHARDED_MODELS = ('product', 'productdetails', 'promotion_products', 'relatedproduct')
+REPLICATED_MODELS = ('category', 'promotion', 'imageurl', 'categoryshard')
+# Rows a product write leaves for the default database (change events, stock alerts and
+# price summary marks). They are written on the product's shard in the same transaction,
+# so they exist exactly when the write committed, and are moved over by relay() in the
+# relay_shard_rows job, not on the write path. Related product marks (RelatedRefresh)
+# stay on the shard, related.py reads them there.
+RELAYED_MODELS = ('changeevent', 'stockalert', 'pricesummary')
+ID_BLOCK_SIZE = 100
+# A process queues at most one relay job per shard this often (seconds), the job relays
+# everything committed until it runs
+RELAY_DELAY = 1
+
+
+class ShardRoutingError(Exception):
+    # Raised for a read of sharded rows that does not say which shard to read
+    pass
+
+
+class PlacementChanged(ShardRoutingError):
+    # Raised inside a write whose cached placement is out of date, see check_placement()
+    pass
+
+
+def shard_aliases():
+    return list(settings.CATALOG_SHARD_ALIASES)
+
+
+def enabled():
+    return bool(settings.CATALOG_SHARD_ALIASES)
+
+
+def product_databases():
+    # Every database that can hold products
+    return shard_aliases() or [DEFAULT_DB_ALIAS]
+
+
+def is_replica_write(model, using):
+    # True for the copies replication writes to the shards, which are not changes of their own
+    return model._meta.model_name in REPLICATED_MODELS and using != DEFAULT_DB_ALIAS
+
+
+def place(category_id, pinned):
+    aliases = shard_aliases()
+    if pinned in aliases:
+        return pinned
+    return aliases[zlib.crc32(str(category_id).encode('ascii')) % len(aliases)]
+
+
+# {category_id: pinned alias or None}, only used by cached lookups
+_placements = {}
+
+
+def shard_for_category(category_id, cached = False):
+    # cached skips the read of the default database, for writes that call check_placement()
+    if not enabled():
+        return DEFAULT_DB_ALIAS
+    if cached and category_id in _placements:
+        return place(category_id, _placements[category_id])
+    CategoryShard = apps.get_model('CRUD', 'CategoryShard')
+    pinned = CategoryShard.objects.using(DEFAULT_DB_ALIAS).filter(category_id = category_id).values_list('alias', flat = True).first()
+    _placements[category_id] = pinned
+    return place(category_id, pinned)
+
+
+def check_placement(category_id, using):
+    # Run in a write's transaction on the shard it chose. The shard's copy of the
+    # placement is current once rebalance_category() pins, and pinning has to wait for
+    # this transaction, so a row written here is either swept by the rebalance or the
+    # write fails with PlacementChanged and is redone where the category went.
+    CategoryShard = apps.get_model('CRUD', 'CategoryShard')
+    # Plain SQL, it runs on every save and building the query would cost more than running it
+    with connections[using].cursor() as cursor:
+        cursor.execute(f'SELECT alias FROM {CategoryShard._meta.db_table} WHERE category_id = %s', [category_id])
+        pinned = next(iter(cursor.fetchone() or ()), None)
+    if place(category_id, pinned) != using:
+        _placements.pop(category_id, None)
+        raise PlacementChanged(f'Category {category_id} moved off {using}')
+
+
+_reserved_ids = []
+_reserved_lock = threading.Lock()
+
+
+def next_product_id():
+    # Shards cannot share an autoincrement, so product ids come from a counter in the
+    # default database, reserved a block at a time with a conditional UPDATE
+    with _reserved_lock:
+        if not _reserved_ids:
+            start = reserve_product_ids(ID_BLOCK_SIZE)
+            _reserved_ids.extend(range(start + ID_BLOCK_SIZE - 1, start - 1, -1))
+        return _reserved_ids.pop()
+
+
+def reserve_product_ids(count):
+    ProductIdSequence = apps.get_model('CRUD', 'ProductIdSequence')
+    Product = apps.get_model('CRUD', 'Product')
+    while True:
+        current = ProductIdSequence.objects.filter(id = 1).values_list('next_id', flat = True).first()
+        if current is None:
+            highest = [Product.objects.using(alias).order_by('-id').values_list('id', flat = True).first() or 0
+                       for alias in [DEFAULT_DB_ALIAS, *shard_aliases()]]
+            ProductIdSequence.objects.bulk_create([ProductIdSequence(id = 1, next_id = max(highest) + 1)], ignore_conflicts = True)
+            continue
+        if ProductIdSequence.objects.filter(id = 1, next_id = current).update(next_id = F('next_id') + count):
+            return current
+
+
+def replicate(model, ids):
+    # Copies rows of a replicated model from the default database to every shard
+    if not enabled() or not ids:
+        return
+    rows = list(model.objects.using(DEFAULT_DB_ALIAS).filter(pk__in = ids))
+    fields = [field.name for field in model._meta.concrete_fields if not field.primary_key]
+    for alias in shard_aliases():
+        model.objects.using(alias).bulk_create(rows, update_conflicts = True, unique_fields = [model._meta.pk.name], update_fields = fields)
+
+
+def replicated_saved(sender, instance, using, raw = False, **kwargs):
+    if using == DEFAULT_DB_ALIAS and not raw:
+        replicate(sender, [instance.pk])
+
+
+def replicated_deleted(sender, instance, using, **kwargs):
+    # Deleting on every shard lets each shard run its own CASCADE / SET_NULL
+    if using == DEFAULT_DB_ALIAS and enabled():
+        for alias in shard_aliases():
+            sender.objects.using(alias).filter(pk = instance.pk).delete()
+
+
+def relay_on_commit(using):
+    # Once per transaction, however many side rows it writes. Failing to queue the relay
+    # leaves the rows on the shard for the next one, it must not fail the write.
+    if using == DEFAULT_DB_ALIAS:
+        return
+    connection = transaction.get_connection(using)
+    if any(isinstance(func, partial) and func.func is queue_relay for _, func, _ in connection.run_on_commit):
+        return
+    transaction.on_commit(partial(queue_relay, using), using = using, robust = True)
+
+
+# {alias: time.monotonic() of the last relay job this process queued}
+_relays_queued = {}
+
+
+def queue_relay(using):
+    # The default database is written once per RELAY_DELAY by each process instead of
+    # once per shard commit. The job runs after every commit that skipped queueing one.
+    from .jobs import enqueue
+    now = time.monotonic()
+    if now - _relays_queued.get(using, -RELAY_DELAY) < RELAY_DELAY:
+        return
+    _relays_queued[using] = now
+    enqueue('relay_shard_rows', delay = RELAY_DELAY, shards = [using])
+
+
+def relay(using, batch_size = 1000):
+    # Moves the relayed rows of one shard to the default database in id order, every
+    # table in one transaction on each side. Claiming them with DELETE ... RETURNING takes
+    # the shard's write lock first, so concurrent relays queue up instead of copying the
+    # same rows. The default database commits first, so a crash in between repeats rows
+    # rather than losing them.
+    from . import analytics
+    if using == DEFAULT_DB_ALIAS:
+        return 0
+    moved = 0
+    while True:
+        full = False
+        with transaction.atomic(using = using), transaction.atomic(using = DEFAULT_DB_ALIAS):
+            for model_name in RELAYED_MODELS:
+                model = apps.get_model('CRUD', model_name)
+                table = connections[using].ops.quote_name(model._meta.db_table)
+                rows = sorted(model.objects.using(using).raw(
+                    f'DELETE FROM {table} WHERE id IN (SELECT id FROM {table} ORDER BY id LIMIT %s) RETURNING *', [batch_size]),
+                    key = lambda row: row.id)
+                if model_name == 'pricesummary':
+                    # On a shard the table only holds stale marks
+                    analytics.mark_stale([row.scope_id for row in rows if row.scope == analytics.CATEGORY],
+                                         [row.scope_id for row in rows if row.scope == analytics.PROMOTION])
+                elif rows:
+                    for row in rows:
+                        row.pk = None
+                    model.objects.using(DEFAULT_DB_ALIAS).bulk_create(rows, batch_size = 500)
+                moved += len(rows)
+                full = full or len(rows) == batch_size
+        if not full:
+            return moved
+
+
+def sync_replicas():
+    # Copies every replicated row to the shards, for shards added to an existing catalog
+    for model_name in REPLICATED_MODELS:
+        model = apps.get_model('CRUD', model_name)
+        ids = list(model.objects.using(DEFAULT_DB_ALIAS).values_list('pk', flat = True))
+        for start in range(0, len(ids), 1000):
+            replicate(model, ids[start:start + 1000])
+
+
+def copy_products(ids, source, target):
+    # Writes products with their details and promotion links from source over their rows
+    # on target, leaving source as it is. A target row with the same or a newer version
+    # is kept. Returns {id: version} of the products found on source.
+    Product = apps.get_model('CRUD', 'Product')
+    ProductDetails = apps.get_model('CRUD', 'ProductDetails')
+    through = apps.get_model('CRUD', 'Promotion').products.through
+    with transaction.atomic(using = target), transaction.atomic(using = source):
+        products = list(Product.objects.using(source).filter(id__in = ids))
+        copied = dict(Product.objects.using(target).filter(id__in = [product.id for product in products]).values_list('id', 'version'))
+        products = [product for product in products if copied.get(product.id, -1) < product.version]
+        stale = [product.id for product in products]
+        details = list(ProductDetails.objects.using(source).filter(product_id__in = stale))
+        links = [through(promotion_id = promotion_id, product_id = product_id)
+                 for promotion_id, product_id in through.objects.using(source).filter(product_id__in = stale).values_list('promotion_id', 'product_id')]
+        through.objects.using(target).filter(product_id__in = stale)._raw_delete(target)
+        ProductDetails.objects.using(target).filter(product_id__in = stale)._raw_delete(target)
+        Product.objects.using(target).filter(id__in = stale)._raw_delete(target)
+        Product.objects.using(target).bulk_create(products)
+        ProductDetails.objects.using(target).bulk_create(details)
+        through.objects.using(target).bulk_create(links)
+    return {**copied, **{product.id: product.version for product in products}}
+
+
+def move_products(ids, source, target):
+    # Moves products with their details and promotion links between databases. The
+    # rows keep their ids and versions, and no delete signals fire because nothing is deleted.
+    Product = apps.get_model('CRUD', 'Product')
+    ProductDetails = apps.get_model('CRUD', 'ProductDetails')
+    RelatedProduct = apps.get_model('CRUD', 'RelatedProduct')
+    RelatedRefresh = apps.get_model('CRUD', 'RelatedRefresh')
+    through = apps.get_model('CRUD', 'Promotion').products.through
+    ids = list(ids)
+    if source == target or not ids:
+        return 0
+    with transaction.atomic(using = target), transaction.atomic(using = source):
+        moved = copy_products(ids, source, target)
+        # Related lists do not cross shards, drop the moved products' lists and mentions
+        # and have them recomputed on both sides
+        links = RelatedProduct.objects.using(source).filter(Q(product_id__in = moved) | Q(related_id__in = moved))
+        owners = set(links.values_list('product_id', flat = True)) - set(moved)
+        links._raw_delete(source)
+        RelatedRefresh.objects.using(target).bulk_create([RelatedRefresh(product_id = product_id) for product_id in moved])
+        RelatedRefresh.objects.using(source).bulk_create([RelatedRefresh(product_id = product_id) for product_id in owners])
+        through.objects.using(source).filter(product_id__in = moved)._raw_delete(source)
+        ProductDetails.objects.using(source).filter(product_id__in = moved)._raw_delete(source)
+        Product.objects.using(source).filter(id__in = moved)._raw_delete(source)
+    return len(moved)
+
+
+def rebalance_category(category_id, target, chunk_size = 1000, pin = True):
+    # Moves a category's products to target, from any shard or from the default database
+    # they lived in before sharding. They are copied a chunk at a time first, while reads
+    # and writes still go to where they are. Then the placement changes (pin keeps the
+    # category on target, without it target is where the hash puts it), the rows written
+    # at the old place meanwhile are moved over and the old copies dropped.
+    CategoryShard = apps.get_model('CRUD', 'CategoryShard')
+    Product = apps.get_model('CRUD', 'Product')
+    ProductDetails = apps.get_model('CRUD', 'ProductDetails')
+    through = apps.get_model('CRUD', 'Promotion').products.through
+    if target not in shard_aliases():
+        raise ValueError(f'Unknown shard {target}')
+    sources = [alias for alias in [DEFAULT_DB_ALIAS, *shard_aliases()] if alias != target]
+    copied = {}
+    for source in sources:
+        last = 0
+        while True:
+            ids = list(Product.objects.using(source).filter(category_id = category_id, id__gt = last).order_by('id').values_list('id', flat = True)[:chunk_size])
+            if not ids:
+                break
+            copied.update(copy_products(ids, source, target))
+            last = ids[-1]
+    # Replicated to every shard, a save still headed for a source fails its placement
+    # check from here on, or has committed before this write and is swept below
+    if pin:
+        CategoryShard.objects.update_or_create(category_id = category_id, defaults = {'alias': target})
+    moved = 0
+    for source in sources:
+        while True:
+            ids = list(Product.objects.using(source).filter(category_id = category_id).values_list('id', flat = True)[:chunk_size])
+            if not ids:
+                break
+            moved += move_products(ids, source, target)
+            for product_id in ids:
+                copied.pop(product_id, None)
+    # Copies of products deleted at their source during the copy, unless written since
+    gone = [product_id for product_id, version in Product.objects.using(target).filter(
+        id__in = list(copied), category_id = category_id).values_list('id', 'version') if version == copied[product_id]]
+    with transaction.atomic(using = target):
+        through.objects.using(target).filter(product_id__in = gone)._raw_delete(target)
+        ProductDetails.objects.using(target).filter(product_id__in = gone)._raw_delete(target)
+        Product.objects.using(target).filter(id__in = gone)._raw_delete(target)
+    return moved
+
+
+def row_key(queryset, names):
+    # Reads the order_by columns off the rows the queryset yields: instances, dicts or tuples
+    opts = queryset.model._meta
+    try:
+        attnames = [opts.pk.attname if name == 'pk' else opts.get_field(name).attname for name in names]
+    except FieldDoesNotExist:
+        raise ValueError('Cross-shard queries can only be ordered by fields of the model')
+    if issubclass(queryset._iterable_class, ModelIterable):
+        return lambda row: tuple(getattr(row, attname) for attname in attnames)
+    if issubclass(queryset._iterable_class, ValuesIterable):
+        return lambda row: tuple(row[name] if name in row else row[attname] for name, attname in zip(names, attnames))
+    fields = list(queryset._fields)
+    if not set(names) <= set(fields):
+        raise ValueError('Cross-shard values_list() needs the order_by columns among its fields')
+    if len(fields) == 1:
+        return lambda row: (row,)
+    positions = [fields.index(name) for name in names]
+    return lambda row: tuple(row[position] for position in positions)
+
+
+def fanout(queryset):
+    # Runs an unpinned query on every product database and k-way merges the per-shard
+    # results on its order_by, so the rows come back in the same order and with the
+    # same slice one database would give. In parallel, unless this thread has a
+    # transaction open on a shard, which the other threads would not see.
+    aliases = product_databases()
+    query = queryset.query
+    if query.group_by is not None or query.combinator or query.distinct_fields:
+        raise ShardRoutingError('Grouped and combined queries cannot be merged across shards, pick a shard with using()')
+    ordering = list(query.order_by)
+    if not all(isinstance(name, str) for name in ordering) or len({name.startswith('-') for name in ordering}) > 1:
+        raise ValueError('Cross-shard queries need an order_by on fields in one direction')
+    key = row_key(queryset, [name.lstrip('-') for name in ordering])
+    low, high = query.low_mark, query.high_mark
+
+    def run(alias, close = False):
+        shard = queryset.using(alias)
+        shard.query.clear_limits()
+        shard.query.set_limits(high = high)
+        try:
+            return list(shard)
+        finally:
+            if close:
+                connections[alias].close()
+
+    if any(connections[alias].in_atomic_block for alias in aliases):
+        results = [run(alias) for alias in aliases]
+    else:
+        with ThreadPoolExecutor(max_workers = len(aliases)) as pool:
+            results = list(pool.map(partial(run, close = True), aliases))
+    merged = heapq.merge(*results, key = key, reverse = bool(ordering) and ordering[0].startswith('-'))
+    return list(islice(merged, low, high))
+
+
+def fanout_values_list(queryset, columns):
+    # values_list() rows of a queryset from every product database, see fanout(). The
+    # order_by columns are selected too for the merge and left out of the rows.
+    if not fans_out(queryset):
+        return list(queryset.values_list(*columns))
+    keys = [name.lstrip('-') for name in queryset.query.order_by if isinstance(name, str)]
+    return [row[len(keys):] for row in fanout(queryset.values_list(*keys, *columns))]
+
+
+_pinned = ContextVar('pinned_shard', default = None)
+
+
+@contextmanager
+def pinned(using):
+    # Sends the queries of sharded models that no instance places to one shard, for
+    # related managers of a replicated row like promotion.products
+    token = _pinned.set(using)
+    try:
+        yield
+    finally:
+        _pinned.reset(token)
+
+
+def shard_of(instance):
+    # The shard a product row, a row next to a product or a category's products are on,
+    # None for any other instance
+    if instance is None:
+        return None
+    if instance._meta.model_name == 'category':
+        return shard_for_category(instance.id)
+    if instance._meta.model_name == 'product':
+        return instance._state.db or shard_for_category(instance.category_id)
+    if instance._meta.model_name in SHARDED_MODELS:
+        return instance._state.db
+    return None
+
+
+def fans_out(queryset):
+    # A query of sharded rows that no shard can answer alone: not pinned with using()
+    # or pinned(), and not made through an instance that places it
+    return (enabled() and queryset._db is None and _pinned.get() is None
+            and queryset.model._meta.model_name in SHARDED_MODELS and shard_of(queryset._hints.get('instance')) is None)
+
+
+class ShardRouter:
+    # Queries made through an instance (product.save(), product.details, category.product_set)
+    # go to that instance's shard, and inside pinned() to the pinned one. Other Product
+    # queries are fanned out by ProductQuerySet, any other read of a sharded model has no
+    # shard to go to and raises, pin it with using() or loop over product_databases().
+    # Writes without an instance are left to the default database, Product.save() picks
+    # its shard itself. Many-to-many writes through a replicated instance,
+    # promotion.products.add(), would put rows that belong to every shard on one and raise.
+    def _sharded(self, model):
+        return enabled() and model._meta.app_label == 'CRUD' and model._meta.model_name in SHARDED_MODELS
+
+    def db_for_read(self, model, **hints):
+        if not self._sharded(model):
+            return None
+        using = shard_of(hints.get('instance')) or _pinned.get()
+        if using is None:
+            raise ShardRoutingError(f'{model._meta.object_name} rows live on the shards, pick one with using()')
+        return using
+
+    def db_for_write(self, model, **hints):
+        if not self._sharded(model):
+            return None
+        instance = hints.get('instance')
+        using = shard_of(instance) or _pinned.get()
+        if using is None and instance is not None and model._meta.auto_created:
+            raise ShardRoutingError(f'{model._meta.object_name} rows of a {instance._meta.object_name} live on every shard, '
+                                    f'write them per shard in pinned() or through the products')
+        return using
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if enabled() and (obj1._meta.model_name in REPLICATED_MODELS or obj2._meta.model_name in REPLICATED_MODELS):
+            return True
+        return None
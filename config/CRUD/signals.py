@@ -0,0 +1,6 @@
+from django.dispatch import Signal
+
+# Sent with ids=[...] after set-based writes to Product (chunked updates, batch
+# updates, upserts) that skip post_save. fields names what may have changed,
+# None means any field. using is the database written to, still inside its transaction.
+products_bulk_changed = Signal()
@@ -0,0 +1,85 @@
+from django.apps import apps
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .sharding import product_databases, relay_on_commit
+from .signals import products_bulk_changed
+
+
+def thresholds(category_ids):
+    # {category_id: threshold}, the global LOW_STOCK_THRESHOLD where a category sets none
+    StockThreshold = apps.get_model('CRUD', 'StockThreshold')
+    if not category_ids:
+        return {}
+    found = dict(StockThreshold.objects.filter(category_id__in = set(category_ids)).values_list('category_id', 'threshold'))
+    return {category_id: found.get(category_id, settings.LOW_STOCK_THRESHOLD) for category_id in category_ids}
+
+
+def crossings(rows):
+    # rows are (product_id, category_id, stock, low_stock) with the new stock, returns
+    # (product_id, category_id, stock, threshold, low) for the rows whose flag must flip
+    limits = thresholds({row[1] for row in rows})
+    return [(product_id, category_id, stock, limits[category_id], stock < limits[category_id])
+            for product_id, category_id, stock, low_stock in rows if (stock < limits[category_id]) != low_stock]
+
+
+def alert(crossings, using = DEFAULT_DB_ALIAS):
+    # Written next to the products, in their transaction, see sharding.RELAYED_MODELS
+    StockAlert = apps.get_model('CRUD', 'StockAlert')
+    if not crossings:
+        return
+    now = timezone.now()
+    StockAlert.objects.using(using).bulk_create([StockAlert(product_id = product_id, category_id = category_id, stock = stock, threshold = threshold, low = low, created_at = now)
+                                                 for product_id, category_id, stock, threshold, low in crossings], batch_size = 500)
+    relay_on_commit(using)
+
+
+def watch(using, ids, record = False):
+    # Re-evaluates low_stock for the given products after their stock or threshold changed,
+    # flips the flag and raises an alert only where it crossed. Returns the crossings.
+    Product = apps.get_model('CRUD', 'Product')
+    ids = list(ids)
+    crossed = []
+    for start in range(0, len(ids), 500):
+        crossed.extend(crossings(Product.objects.using(using).filter(id__in = ids[start:start + 500]).values_list('id', 'category_id', 'stock', 'low_stock')))
+    return flip(using, crossed, record)
+
+
+def flip(using, crossed, record = False):
+    # Writes the flag of every crossing and raises its alerts. Returns the crossings.
+    # Callers that write the products anyway record the change themselves, record=True
+    # makes a flip on its own a change like any other: version, change event, caches.
+    Product = apps.get_model('CRUD', 'Product')
+    ChangeEvent = apps.get_model('CRUD', 'ChangeEvent')
+    for low in (True, False):
+        flipped = [crossing[0] for crossing in crossed if crossing[4] is low]
+        values = {'low_stock': low, 'version': F('version') + 1} if record else {'low_stock': low}
+        for start in range(0, len(flipped), 500):
+            Product.objects.using(using).filter(id__in = flipped[start:start + 500]).update(**values)
+    alert(crossed, using)
+    if record and crossed:
+        ids = [crossing[0] for crossing in crossed]
+        ChangeEvent.record(Product, ids, ChangeEvent.UPDATE, using)
+        products_bulk_changed.send(sender = Product, ids = ids, fields = ['low_stock'], using = using)
+    return crossed
+
+
+def recheck(category_id = None, chunk_size = 1000):
+    # After a threshold change, re-evaluates one category or, for the global threshold, every product
+    Product = apps.get_model('CRUD', 'Product')
+    crossed = 0
+    for using in product_databases():
+        products = Product.objects.using(using).order_by('id')
+        if category_id is not None:
+            products = products.filter(category_id = category_id)
+        last = 0
+        while True:
+            ids = list(products.filter(id__gt = last).values_list('id', flat = True)[:chunk_size])
+            if not ids:
+                break
+            with transaction.atomic(using = using):
+                crossed += len(watch(using, ids, record = True))
+            last = ids[-1]
+    return crossed
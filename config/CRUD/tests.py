@@ -1,9 +1,55 @@
+import json
+import os
+import pickle
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
 import unittest
-
-from django.db.utils import IntegrityError
+from importlib import import_module
+from unittest import mock
+from datetime import timedelta
+
+from django.apps import apps as django_apps
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import DEFAULT_DB_ALIAS, connection, connections, transaction
+from django.db.migrations.loader import MigrationLoader
+from django.db.utils import IntegrityError, OperationalError
 from django.forms import ValidationError
-from django.test import TestCase
-from .models import Product, Category, Promotion
+from django.middleware.csrf import _get_new_csrf_string
+from django.test import Client, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from . import cache as catalog_cache
+from . import analytics, autocomplete, related, sharding
+from .autocomplete import AutocompleteIndex, get_index, reset_index
+from .filecache import FileBasedCache
+from .jobs import LEASE, TASKS, claim_next, enqueue, run_job, run_pending, task
+from .serializers import serialize_product_rows, serialize_products
+from .signals import products_bulk_changed
+from . import views
+from .models import (ChangeEvent, ConflictError, LeaseLost, CategoryClosure, CategoryShard, ImageUrl, Job, Product, ProductDetails, Category, Promotion,
+                     PriceSummary, ProductPopularity, RelatedProduct, RelatedRefresh, StockAlert, StockThreshold)
+
+# Results, generations and stats are written to a throwaway cache directory, never to
+# the one the development server uses
+_cache_settings = None
+
+
+def setUpModule():
+    global _cache_settings
+    _cache_settings = override_settings(CACHES={'default': {'BACKEND': 'CRUD.filecache.FileBasedCache', 'LOCATION': tempfile.mkdtemp()}})
+    _cache_settings.enable()
+
+
+def tearDownModule():
+    shutil.rmtree(settings.CACHES['default']['LOCATION'])
+    _cache_settings.disable()
+
 
 class CreateProductTests(TestCase):
     @classmethod
@@ -335,6 +381,48 @@ class ReadProductTests(TestCase):
         ]
         
         self.assertQuerysetEqual(allProducts, expectedProducts, transform = str)
+
+    def testReadProductsShareSingleImageUrlRow(self):
+        self.assertEqual(ImageUrl.objects.filter(url = self.product1.image_url).count(), 1)
+        self.assertEqual(self.product1.image_id, self.product2.image_id)
+        self.assertEqual(self.product2.image_id, self.product3.image_id)
+
+    def testReadImageUrlWithoutExtraQuery(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(Product.objects.with_image().get(id = self.product2.id).image_url, self.product1.image_url)
+
+    def testReadWithOrmFieldSelection(self):
+        self.assertEqual(Product.objects.only('name').get(id = self.product1.id).name, "TestProduct1")
+        self.assertEqual(Product.objects.defer('name').get(id = self.product1.id).price, 10.0)
+        self.assertEqual(Product.objects.filter(image_url = self.product1.image_url).count(), 3)
+        self.assertEqual(Product.objects.filter(image_url__isnull = True).count(), 0)
+
+    def testReadProductListingDoesNotLoadDescriptions(self):
+        with self.assertNumQueries(1):
+            names = [product.name for product in Product.objects.order_by('name')]
+        self.assertEqual(names, ["TestProduct1", "TestProduct2", "TestProduct3"])
+
+    def testReadDescriptionInOneExtraQuery(self):
+        product = Product.objects.get(id = self.product1.id)
+        with self.assertNumQueries(1):
+            self.assertEqual(product.description, "TestProduct1Description")
+
+    def testReadLongDescriptionIsCompressed(self):
+        longDescription = "TestDescription " * 100
+        product = Product.objects.create(name = "TestProductLong", price = 1.0, stock = 1, description = longDescription, category = self.category)
+
+        details = ProductDetails.objects.get(product = product)
+        self.assertIsNone(details.raw)
+        self.assertLess(len(details.compressed), len(longDescription))
+        self.assertEqual(Product.objects.get(id = product.id).description, longDescription)
+        product.delete()
+
+    def testInternManyReturnsIdsForExistingAndNewUrls(self):
+        ids = ImageUrl.intern_many([self.product1.image_url, "https://example.pl/img=1", None])
+
+        self.assertEqual(len(ids), 2)
+        self.assertEqual(ids[self.product1.image_url], self.product1.image_id)
+        self.assertEqual(ImageUrl.objects.filter(id__in = ids.values()).count(), 2)
         
 
 class UpdateProductTests(TestCase):
@@ -416,6 +504,30 @@ class UpdateProductTests(TestCase):
         with self.assertRaises(ValidationError):
             self.promotion.save()
             
+    def testUpdateProductDescriptionToNoneRemovesDetails(self):
+        self.product.description = None
+        self.product.save()
+
+        self.assertFalse(ProductDetails.objects.filter(product = self.product).exists())
+        self.assertIsNone(Product.objects.get(id = self.product.id).description)
+
+    def testRefreshDiscardsUnsavedDescription(self):
+        saved = self.product.description
+        self.product.description = "Unsaved"
+        self.product.refresh_from_db()
+        self.product.save()
+
+        self.assertEqual(self.product.description, saved)
+        self.assertEqual(Product.objects.get(id = self.product.id).description, saved)
+
+    def testUpdateProductDescriptionWithUpdateFields(self):
+        version = self.product.version
+        self.product.description = "Only the description"
+        self.product.save(update_fields = ['description'])
+
+        self.assertEqual(Product.objects.get(id = self.product.id).description, "Only the description")
+        self.assertEqual(Product.objects.get(id = self.product.id).version, version + 1)
+
     def testUpdateProductWithoutPromotionIdShouldCorrectlyUpdate(self):
         self.product.promotion = None
         self.product.save()
@@ -431,6 +543,11 @@ class UpdateProductTests(TestCase):
         self.product.save()
         self.assertTrue(self.product.image_url is None)
 
+    def testUpdateProductImageUrlWithUpdateFields(self):
+        self.product.image_url = "https://example.pl/img=1"
+        self.product.save(update_fields = ['image_url'])
+        self.assertEqual(Product.objects.get(id = self.product.id).image_url, "https://example.pl/img=1")
+
     def testUpdateCategoryWithoutDescriptionShouldCorrectlyUpdate(self):
         self.category.description = None
         self.category.save()
@@ -607,3 +724,1510 @@ class DeleteProductTests(TestCase):
         except Product.DoesNotExist:
             self.fail("Product without promotion was deleted.")
 
+
+    def testRetirePromotionSetsProductPromotionToNull(self):
+        self.promotion.products.add(self.product)
+
+        self.promotion.retire(chunk_size = 1)
+
+        self.product.refresh_from_db()
+        self.assertIsNone(self.product.promotion)
+        self.assertEqual(self.product.promotions.count(), 0)
+        with self.assertRaises(Promotion.DoesNotExist):
+            Promotion.objects.get(id=self.promotion.id)
+
+    def testRetirePromotionDetachesProductsInChunks(self):
+        for i in range(5):
+            Product.objects.create(name="Chunked Product", price=1.0, stock=1, category=self.category, promotion=self.promotion)
+
+        self.promotion.retire(chunk_size = 2)
+
+        self.assertEqual(Product.objects.filter(promotion__isnull=False).count(), 0)
+        self.assertEqual(Product.objects.count(), 6)
+
+
+class JobQueueTests(TestCase):
+    def setUp(self):
+        self.category = Category.objects.create(name="Test Category", description="This is a test category.")
+        self.promotion = Promotion.objects.create(name="Test Promotion", description="This is a test promotion.", discount=10.0)
+        self.product = Product.objects.create(name="Test Product", price=100.0, stock=10, category=self.category, promotion=self.promotion)
+
+    def tearDown(self):
+        TASKS.pop('test_failing', None)
+
+    def testEnqueuedRetirePromotionRunsInWorker(self):
+        job = enqueue('retire_promotion', promotion_id = self.promotion.id)
+
+        self.assertEqual(run_pending(), 1)
+
+        job.refresh_from_db()
+        self.product.refresh_from_db()
+        self.assertEqual(job.status, Job.DONE)
+        self.assertEqual(job.attempts, 1)
+        self.assertIsNone(self.product.promotion)
+        self.assertFalse(Promotion.objects.filter(id=self.promotion.id).exists())
+
+    def testFailingJobIsRetriedThenMarkedFailed(self):
+        @task('test_failing')
+        def failing(job):
+            job.report_progress(1, 2)
+            raise RuntimeError('boom')
+
+        job = enqueue('test_failing', max_attempts = 2)
+        run_pending()
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.PENDING)
+        self.assertEqual(job.progress, 1)
+        self.assertEqual(job.total, 2)
+
+        Job.objects.filter(id=job.id).update(run_after=job.created_at)
+        run_pending()
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.FAILED)
+        self.assertEqual(job.attempts, 2)
+        self.assertIn('boom', job.error)
+
+    def testRetirePromotionReportsProgress(self):
+        job = enqueue('retire_promotion', promotion_id = self.promotion.id)
+        run_pending()
+        job.refresh_from_db()
+        self.assertEqual((job.progress, job.total), (1, 1))
+
+    def testAbandonedJobIsReclaimedAfterLease(self):
+        job = enqueue('retire_promotion', promotion_id = self.promotion.id, max_attempts = 2)
+        self.assertEqual(claim_next().id, job.id)
+        # The worker died while running it
+        self.assertIsNone(claim_next())
+
+        Job.objects.filter(id=job.id).update(claimed_at=timezone.now() - LEASE - timedelta(seconds=1))
+        self.assertEqual(run_pending(), 1)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.DONE, 2))
+
+    def testAbandonedJobOutOfAttemptsFails(self):
+        job = enqueue('retire_promotion', promotion_id = self.promotion.id, max_attempts = 1)
+        claim_next()
+        Job.objects.filter(id=job.id).update(claimed_at=timezone.now() - LEASE - timedelta(seconds=1))
+        self.assertEqual(run_pending(), 0)
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.FAILED)
+        self.assertEqual(job.error, 'Worker lease expired')
+
+    def testWorkerThatLostItsLeaseLeavesTheJobAlone(self):
+        job = enqueue('refresh_price_summaries', max_attempts = 2)
+        slow = claim_next()
+        Job.objects.filter(id=job.id).update(claimed_at=timezone.now() - LEASE - timedelta(seconds=1))
+        self.assertEqual(claim_next().id, job.id)
+
+        # The first worker wakes up after the job was taken over
+        with self.assertRaises(LeaseLost):
+            slow.report_progress(1)
+        self.assertFalse(run_job(slow))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.RUNNING, 2))
+
+    def testLongTasksRenewTheirLease(self):
+        job = enqueue('refresh_related_products', full = True)
+        claimed = claim_next()
+        Job.objects.filter(id=job.id).update(claimed_at=timezone.now() - LEASE + timedelta(seconds=1))
+        self.assertTrue(run_job(claimed))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.progress), (Job.DONE, 1))
+
+        analytics.mark_stale([self.category.id])
+        job = enqueue('refresh_price_summaries')
+        self.assertTrue(run_job(claim_next()))
+        job.refresh_from_db()
+        self.assertGreater(job.progress, 0)
+
+    def testEnqueueUnknownJobShouldRaiseException(self):
+        with self.assertRaises(KeyError):
+            enqueue('does_not_exist')
+
+
+class CategoryTreeTests(TestCase):
+    def setUp(self):
+        self.electronics = Category.objects.create(name="Electronics")
+        self.phones = Category.objects.create(name="Phones", parent=self.electronics)
+        self.smartphones = Category.objects.create(name="Smartphones", parent=self.phones)
+        self.books = Category.objects.create(name="Books")
+        self.phone = Product.objects.create(name="Phone", price=10.0, stock=1, category=self.phones)
+        self.smartphone = Product.objects.create(name="Smartphone", price=20.0, stock=1, category=self.smartphones)
+        self.book = Product.objects.create(name="Book", price=5.0, stock=1, category=self.books)
+
+    def testSubtreeProductsIncludeDescendants(self):
+        with self.assertNumQueries(1):
+            products = list(self.electronics.subtree_products().order_by('name'))
+        self.assertEqual(products, [self.phone, self.smartphone])
+
+    def testClosureDepths(self):
+        depth = CategoryClosure.objects.get(ancestor=self.electronics, descendant=self.smartphones).depth
+        self.assertEqual(depth, 2)
+
+    def testSubtreeProductCounts(self):
+        counts = dict(Category.objects.with_subtree_product_counts().values_list('name', 'subtree_product_count'))
+        self.assertEqual(counts, {"Electronics": 2, "Phones": 2, "Smartphones": 1, "Books": 1})
+
+    def testReparentMovesWholeSubtree(self):
+        Category.objects.reparent([self.phones], self.books)
+
+        self.assertEqual(list(self.electronics.subtree_products()), [])
+        self.assertEqual(set(self.books.subtree_products()), {self.book, self.phone, self.smartphone})
+        self.assertEqual(CategoryClosure.objects.get(ancestor=self.books, descendant=self.smartphones).depth, 2)
+        self.assertFalse(CategoryClosure.objects.filter(ancestor=self.electronics, descendant=self.smartphones).exists())
+
+    def testReparentNestedCategoriesInFixedQueries(self):
+        with self.assertNumQueries(7):
+            Category.objects.reparent([self.phones, self.smartphones], self.books)
+
+        closure = set(CategoryClosure.objects.values_list('ancestor__name', 'descendant__name', 'depth'))
+        self.assertEqual(closure, {
+            ("Electronics", "Electronics", 0), ("Books", "Books", 0), ("Phones", "Phones", 0), ("Smartphones", "Smartphones", 0),
+            ("Books", "Phones", 1), ("Books", "Smartphones", 1),
+        })
+        self.assertEqual(Category.objects.get(id=self.smartphones.id).parent, self.books)
+        # The instances stay usable for a later save()
+        self.phones.name = "Mobile phones"
+        self.phones.save()
+
+    def testReparentToRoot(self):
+        Category.objects.reparent([self.phones], None)
+
+        self.assertEqual(CategoryClosure.objects.filter(descendant=self.smartphones).count(), 2)
+        self.assertEqual(list(self.electronics.subtree_products()), [])
+
+    def testReparentWithDuplicateIds(self):
+        Category.objects.reparent([self.phones, self.phones, Category.objects.get(id=self.phones.id)], self.books)
+
+        self.assertEqual(CategoryClosure.objects.get(ancestor=self.books, descendant=self.smartphones).depth, 2)
+        self.assertEqual(self.phones.version, Category.objects.get(id=self.phones.id).version)
+
+    def testSaveWithoutParentFieldKeepsSubtree(self):
+        self.phones.parent = self.books
+        self.phones.name = "Mobile phones"
+        self.phones.save(update_fields=['name'])
+
+        self.assertEqual(Category.objects.get(id=self.phones.id).parent, self.electronics)
+        self.assertTrue(CategoryClosure.objects.filter(ancestor=self.electronics, descendant=self.smartphones).exists())
+        self.assertFalse(CategoryClosure.objects.filter(ancestor=self.books, descendant=self.phones).exists())
+        # Saving the parent later still moves it
+        self.phones.save(update_fields=['parent'])
+        self.assertTrue(CategoryClosure.objects.filter(ancestor=self.books, descendant=self.smartphones).exists())
+
+    def testMoveBelowOwnDescendantShouldRaiseException(self):
+        self.electronics.parent = self.smartphones
+
+        with self.assertRaises(ValidationError):
+            self.electronics.save()
+
+    def testDeleteParentCascadesToSubtree(self):
+        self.electronics.delete()
+
+        self.assertFalse(Category.objects.filter(id=self.smartphones.id).exists())
+        self.assertFalse(Product.objects.filter(id=self.smartphone.id).exists())
+
+
+class PromotionScheduleTests(TestCase):
+    def setUp(self):
+        self.now = timezone.now()
+        self.category = Category.objects.create(name="Test Category")
+        self.running = Promotion.objects.create(name="Running", discount=10.0, starts_at=self.now - timedelta(days=1), ends_at=self.now + timedelta(days=1))
+        self.upcoming = Promotion.objects.create(name="Upcoming", discount=20.0, starts_at=self.now + timedelta(days=1))
+        self.ended = Promotion.objects.create(name="Ended", discount=30.0, ends_at=self.now - timedelta(days=1))
+        self.unbounded = Promotion.objects.create(name="Unbounded", discount=5.0)
+
+    def createProduct(self, promotion=None):
+        return Product.objects.create(name="Test Product", price=100.0, stock=10, category=self.category, promotion=promotion)
+
+    def testActiveAtReturnsPromotionsInsideWindow(self):
+        active = set(Promotion.objects.active_at(self.now).values_list('name', flat=True))
+        self.assertEqual(active, {"Running", "Unbounded"})
+
+    def testPromotionEndingBeforeStartShouldRaiseException(self):
+        with self.assertRaises(ValidationError):
+            Promotion.objects.create(name="Broken", discount=1.0, starts_at=self.now, ends_at=self.now)
+
+    def testApplyScheduleAttachesAndDetachesProducts(self):
+        waiting = self.createProduct()
+        self.running.products.add(waiting)
+        expired = self.createProduct(self.ended)
+        manual = self.createProduct(self.unbounded)
+        scheduled = self.createProduct(self.upcoming)
+
+        attached, detached = Promotion.objects.apply_schedule(self.now, chunk_size=1)
+
+        self.assertEqual((attached, detached), (1, 1))
+        for product in (waiting, expired, manual, scheduled):
+            product.refresh_from_db()
+        self.assertEqual(waiting.promotion, self.running)
+        self.assertIsNone(expired.promotion)
+        self.assertEqual(manual.promotion, self.unbounded)
+        self.assertEqual(scheduled.promotion, self.upcoming)
+
+        # The scheduled assignment takes effect once the window opens
+        later = self.now + timedelta(days=2)
+        Promotion.objects.apply_schedule(later)
+        self.assertEqual(Product.objects.with_effective_discount(later).get(id=scheduled.id).effective_discount, 20.0)
+
+    def testEffectiveDiscountIsSingleQuery(self):
+        running = self.createProduct(self.running)
+        upcoming = self.createProduct(self.upcoming)
+        plain = self.createProduct()
+
+        with self.assertNumQueries(1):
+            discounts = dict(Product.objects.with_effective_discount(self.now).values_list('id', 'effective_discount'))
+        self.assertEqual(discounts, {running.id: 10.0, upcoming.id: 0.0, plain.id: 0.0})
+
+
+class AutocompleteTests(TestCase):
+    def setUp(self):
+        reset_index()
+        self.category = Category.objects.create(name="Test Category")
+        self.laptop = Product.objects.create(name="Laptop", price=10.0, stock=1, category=self.category)
+        self.lamp = Product.objects.create(name="Lampa Łazienkowa", price=10.0, stock=1, category=self.category)
+        self.phone = Product.objects.create(name="Phone", price=10.0, stock=1, category=self.category)
+
+    def tearDown(self):
+        reset_index()
+
+    def testSearchMatchesNormalizedPrefix(self):
+        index = AutocompleteIndex([(1, "Żółw"), (2, "zolty"), (3, "Apple")])
+        self.assertEqual(index.search("zo"), [(2, "zolty"), (1, "Żółw")])
+        self.assertEqual(index.search("zol"), [(2, "zolty")])
+        self.assertEqual(index.search("ŻÓŁ"), [(1, "Żółw")])
+        self.assertEqual(index.search(""), [])
+
+    def testSearchRanksPopularFirst(self):
+        index = AutocompleteIndex([(1, "Lamp"), (2, "Laptop"), (3, "Lava")])
+        index.bump(3)
+        self.assertEqual([product_id for product_id, _ in index.search("la", limit=2)], [3, 1])
+
+    def testIndexFollowsSaveAndDelete(self):
+        index = get_index()
+        self.assertEqual(len(index), 3)
+
+        self.laptop.name = "Notebook"
+        self.laptop.save()
+        self.phone.delete()
+        created = Product.objects.create(name="Lantern", price=1.0, stock=1, category=self.category)
+
+        self.assertEqual(index.search("la"), [(self.lamp.id, "Lampa Łazienkowa"), (created.id, "Lantern")])
+        self.assertEqual(index.search("note"), [(self.laptop.id, "Notebook")])
+        self.assertEqual(index.search("ph"), [])
+
+    def testAutocompleteEndpoint(self):
+        response = self.client.get('/api/products/autocomplete/', {'q': 'la'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'results': [
+            {'id': self.lamp.id, 'name': "Lampa Łazienkowa"},
+            {'id': self.laptop.id, 'name': "Laptop"},
+        ]})
+
+
+    def testSelectionIsReportedByPost(self):
+        self.assertEqual(self.client.get('/api/products/autocomplete/', {'q': 'la', 'selected': self.laptop.id}).json()["results"][0]["id"], self.lamp.id)
+        self.assertEqual(self.client.get('/api/products/autocomplete/select/', {'id': self.laptop.id}).status_code, 405)
+
+        self.assertEqual(self.client.post('/api/products/autocomplete/select/', {'id': self.laptop.id}).status_code, 204)
+        self.assertEqual(self.client.get('/api/products/autocomplete/', {'q': 'la'}).json()["results"][0]["id"], self.laptop.id)
+        self.assertEqual(self.client.post('/api/products/autocomplete/select/', {'id': 'x'}).status_code, 400)
+
+    def testPopularityFollowsRenamesAndIsBounded(self):
+        index = AutocompleteIndex([(1, "Lamp"), (2, "Laptop"), (3, "Lava")])
+        index.bump(3)
+        index.add(3, "Pear")
+        self.assertEqual(index.search("la", limit=1), [(1, "Lamp")])
+        self.assertEqual(index.search("pe"), [(3, "Pear")])
+        index.remove(3)
+        self.assertEqual(index.popular, [])
+
+        with mock.patch('CRUD.autocomplete.MAX_POPULAR', 2):
+            for product_id in (1, 1, 1, 1, 2, 2):
+                index.bump(product_id)
+            index.add(4, "Lantern")
+            index.bump(4)
+        self.assertLessEqual(len(index.popularity), 2)
+        self.assertEqual(index.popular, sorted((index.positions[product_id], product_id) for product_id in index.popularity))
+        self.assertEqual(index.search("la", limit=1), [(1, "Lamp")])
+
+    def testIndexCatchesUpWithOtherWorkers(self):
+        index = get_index()
+        # Another worker's writes reach this one only through the change log
+        Product.objects.filter(id=self.laptop.id).update(name="Notebook")
+        created = Product.objects.bulk_create([Product(name="Lantern", price=1.0, stock=1, category=self.category)])[0]
+        ChangeEvent.record(Product, [self.laptop.id], ChangeEvent.UPDATE)
+        ChangeEvent.record(Product, [created.id], ChangeEvent.CREATE)
+        self.assertEqual(get_index().search("note"), [])
+
+        with mock.patch('CRUD.autocomplete.SYNC_INTERVAL', 0):
+            self.assertIs(get_index(), index)
+        self.assertEqual(index.search("note"), [(self.laptop.id, "Notebook")])
+        self.assertEqual(index.search("la"), [(self.lamp.id, "Lampa Łazienkowa"), (created.id, "Lantern")])
+
+    def testIndexIsRebuiltWhenEventsWereCompactedAway(self):
+        index = get_index()
+        Product.objects.filter(id=self.laptop.id).update(name="Notebook")
+        ChangeEvent.record(Product, [self.laptop.id], ChangeEvent.UPDATE)
+        ChangeEvent.objects.exclude(id=ChangeEvent.objects.latest('id').id).delete()
+        index.cursors[DEFAULT_DB_ALIAS] -= 1
+
+        with mock.patch('CRUD.autocomplete.SYNC_INTERVAL', 0):
+            rebuilt = get_index()
+        self.assertIsNot(rebuilt, index)
+        self.assertEqual(rebuilt.search("note"), [(self.laptop.id, "Notebook")])
+
+    def testPicksAreSharedBetweenWorkers(self):
+        self.client.post('/api/products/autocomplete/select/', {'id': self.laptop.id})
+        self.client.post('/api/products/autocomplete/select/', {'id': 123456})
+        self.assertEqual(list(ProductPopularity.objects.values_list('product_id', 'count')), [(self.laptop.id, 1)])
+
+        # A worker started later ranks by the shared counts
+        other = autocomplete.build()
+        self.assertEqual(other.search("la")[0][0], self.laptop.id)
+        # A running one reloads them
+        ProductPopularity.objects.create(product_id=self.lamp.id, count=5)
+        with mock.patch('CRUD.autocomplete.SYNC_INTERVAL', 0), mock.patch('CRUD.autocomplete.RANK_INTERVAL', 0):
+            self.assertEqual(get_index().search("la")[0][0], self.lamp.id)
+
+    def testDecayHalvesSharedCounts(self):
+        ProductPopularity.objects.create(product_id=self.laptop.id, count=5)
+        ProductPopularity.objects.create(product_id=self.lamp.id, count=1)
+        autocomplete.decay()
+        self.assertEqual(list(ProductPopularity.objects.values_list('product_id', 'count')), [(self.laptop.id, 2)])
+
+    def testIndexIsWarmedAtStartup(self):
+        with override_settings(AUTOCOMPLETE_WARM=True), mock.patch('CRUD.autocomplete.warm') as warm:
+            django_apps.get_app_config('CRUD').ready()
+        warm.assert_called_once_with()
+        with override_settings(AUTOCOMPLETE_WARM=False), mock.patch('CRUD.autocomplete.warm') as warm:
+            django_apps.get_app_config('CRUD').ready()
+        warm.assert_not_called()
+
+        with mock.patch('CRUD.autocomplete.get_index') as build:
+            autocomplete.warm().join()
+        build.assert_called_once_with()
+        # Before migrate there is nothing to build from, the first search builds it
+        with mock.patch('CRUD.autocomplete.get_index', side_effect=OperationalError("no such table")):
+            autocomplete.warm().join()
+
+
+class ProductSerializationTests(TestCase):
+    def setUp(self):
+        # Generations are bumped on commit, which never comes inside a TestCase
+        cache.clear()
+        self.category = Category.objects.create(name="Test Category")
+        self.promotion = Promotion.objects.create(name="Test Promotion", discount=10.0)
+        self.product1 = Product.objects.create(name="Zażółć \"gęślą\"", price=10.1, stock=5, image_url="https://example.pl/img=2137", category=self.category, promotion=self.promotion)
+        self.product2 = Product.objects.create(name="Plain", price=0.0, stock=0, category=self.category)
+
+    def testFastSerializationIsIdenticalToModelSerialization(self):
+        for fields in (None, ['id', 'name', 'price'], ['image_url', 'promotion']):
+            products = Product.objects.order_by('id')
+            self.assertEqual(serialize_product_rows(products, fields), serialize_products(products.with_image(), fields))
+
+    def testProductListSparseFields(self):
+        response = self.client.get('/api/products/', {'fields': 'id,price'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'results': [
+            {'id': self.product1.id, 'price': 10.1},
+            {'id': self.product2.id, 'price': 0.0},
+        ]})
+
+    def testProductListPagesAfterCursor(self):
+        response = self.client.get('/api/products/', {'after': self.product1.id, 'category': self.category.id})
+
+        self.assertEqual([row['id'] for row in response.json()['results']], [self.product2.id])
+
+    def testProductListUnknownFieldShouldReturnBadRequest(self):
+        response = self.client.get('/api/products/', {'fields': 'id,description'})
+
+        self.assertEqual(response.status_code, 400)
+
+    def testProductListLimitBelowOneShouldReturnBadRequest(self):
+        for limit in (0, -5):
+            response = self.client.get('/api/products/', {'limit': limit})
+
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json(), {'error': 'limit must be at least 1'})
+
+    def testProductListNonFinitePriceShouldReturnBadRequest(self):
+        for params in ({'min_price': 'nan'}, {'max_price': 'inf'}, {'max_price': '-Infinity'}, {'sort': 'price', 'after': f'nan:{self.product1.id}'}):
+            response = self.client.get('/api/products/', params)
+
+            self.assertEqual(response.status_code, 400)
+
+
+class BatchUpdateProductTests(TestCase):
+    def setUp(self):
+        self.category = Category.objects.create(name="Test Category")
+        self.product1 = Product.objects.create(name="Product 1", price=10.0, stock=10, category=self.category)
+        self.product2 = Product.objects.create(name="Product 2", price=20.0, stock=20, category=self.category)
+
+    def testBatchUpdateAppliesValidChanges(self):
+        results = Product.objects.batch_update([
+            {"id": self.product1.id, "price": 15.5},
+            {"id": self.product2.id, "stock": 0},
+        ], chunk_size=1)
+
+        self.assertTrue(all(result["ok"] for result in results))
+        self.product1.refresh_from_db()
+        self.product2.refresh_from_db()
+        self.assertEqual((self.product1.price, self.product1.stock), (15.5, 10))
+        self.assertEqual((self.product2.price, self.product2.stock), (20.0, 0))
+
+    def testBatchUpdateReportsInvalidItems(self):
+        results = Product.objects.batch_update([
+            {"id": self.product1.id, "price": -1},
+            {"id": self.product2.id, "stock": None},
+            {"id": 9999, "stock": 1},
+            {"id": self.product1.id, "stock": 3},
+            {"id": self.product2.id, "price": float('nan')},
+            {"id": self.product2.id, "price": float('inf')},
+        ])
+
+        self.assertEqual([result["error"] for result in results],
+                         ["Price cannot be negative", "Stock cannot be none", "Product does not exist", None,
+                          "Price must be a number", "Price must be a number"])
+        self.product1.refresh_from_db()
+        self.assertEqual((self.product1.price, self.product1.stock), (10.0, 3))
+
+    def testBatchUpdateIsFewQueries(self):
+        changes = [{"id": product.id, "price": 1.0, "stock": 1} for product in Product.objects.all()]
+        # Savepoint, existence check, thresholds, one UPDATE, low stock alerts, price summary
+        # mark, outbox insert, related refresh mark, release
+        with self.assertNumQueries(9):
+            Product.objects.batch_update(changes)
+
+    def testBatchEndpointRequiresPermission(self):
+        response = self.client.patch('/api/products/batch/', json.dumps([]), content_type='application/json')
+        self.assertEqual(response.status_code, 403)
+
+    def testBatchEndpoint(self):
+        self.client.force_login(User.objects.create_superuser("admin", "admin@example.pl", "password"))
+
+        response = self.client.patch('/api/products/batch/', json.dumps([{"id": self.product1.id, "price": 1.0}]), content_type='application/json')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"results": [{"id": self.product1.id, "ok": True, "error": None}]})
+
+    def testBatchEndpointRequiresCsrfToken(self):
+        client = Client(enforce_csrf_checks=True)
+        client.force_login(User.objects.create_superuser("admin", "admin@example.pl", "password"))
+        body = json.dumps([{"id": self.product1.id, "price": 1.0}])
+
+        self.assertEqual(client.patch('/api/products/batch/', body, content_type='application/json').status_code, 403)
+
+        token = _get_new_csrf_string()
+        client.cookies['csrftoken'] = token
+        response = client.patch('/api/products/batch/', body, content_type='application/json', HTTP_X_CSRFTOKEN=token)
+        self.assertEqual(response.status_code, 200)
+
+
+class ChangeFeedTests(TestCase):
+    def setUp(self):
+        self.category = Category.objects.create(name="Test Category")
+        self.promotion = Promotion.objects.create(name="Test Promotion", discount=10.0)
+        self.product = Product.objects.create(name="Test Product", price=100.0, stock=10, category=self.category, promotion=self.promotion)
+        self.cursor = ChangeEvent.objects.order_by('id').last().id
+
+    def changes(self):
+        return list(ChangeEvent.objects.filter(id__gt=self.cursor).order_by('id').values_list('model', 'object_id', 'action'))
+
+    def testCreateUpdateAndDeleteAreRecorded(self):
+        self.assertEqual(ChangeEvent.objects.filter(action=ChangeEvent.CREATE).count(), 3)
+        productId = self.product.id
+        self.product.stock = 5
+        self.product.save()
+        self.product.delete()
+
+        self.assertEqual(self.changes(), [("product", productId, "update"), ("product", productId, "delete")])
+
+    def testCategoryCascadeRecordsProductDeletes(self):
+        categoryId = self.category.id
+        self.category.delete()
+
+        self.assertIn(("product", self.product.id, "delete"), self.changes())
+        self.assertIn(("category", categoryId, "delete"), self.changes())
+
+    def testPromotionDeleteRecordsSetNullOnProducts(self):
+        promotionId = self.promotion.id
+        self.promotion.delete()
+
+        self.assertEqual(self.changes(), [("product", self.product.id, "update"), ("promotion", promotionId, "delete")])
+
+    def testPromotionProductsChangesAreRecorded(self):
+        self.promotion.products.add(self.product)
+        self.promotion.products.clear()
+
+        self.assertEqual(self.changes(), [
+            ("promotion", self.promotion.id, "update"), ("product", self.product.id, "update"),
+            ("promotion", self.promotion.id, "update"), ("product", self.product.id, "update"),
+        ])
+
+    def testBulkPathsAreRecorded(self):
+        Product.objects.batch_update([{"id": self.product.id, "stock": 1}])
+        self.promotion.products.add(self.product)
+        self.assertEqual(self.changes()[0], ("product", self.product.id, "update"))
+
+        self.cursor = ChangeEvent.objects.order_by('id').last().id
+        promotionId = self.promotion.id
+        self.promotion.retire()
+
+        self.assertEqual(self.changes(), [
+            ("product", self.product.id, "update"), ("product", self.product.id, "update"),
+            ("promotion", promotionId, "delete"),
+        ])
+
+    def testCompactKeepsNewestEventPerObject(self):
+        self.product.save()
+        self.product.save()
+
+        superseded, expired = ChangeEvent.compact(older_than=timezone.now() + timedelta(days=1))
+
+        self.assertEqual(superseded, 2)
+        self.assertEqual(expired, 2)
+        self.assertEqual(list(ChangeEvent.objects.values_list('model', 'action')), [("product", "update")])
+
+    def testChangeListPagesFromCursor(self):
+        response = self.client.get('/api/changes/', {'since': 0, 'limit': 2})
+        body = response.json()
+
+        self.assertEqual([change['model'] for change in body['results']], ["category", "promotion"])
+        response = self.client.get('/api/changes/', {'since': body['next']})
+        self.assertEqual(response.json()['results'], [{'seq': self.cursor, 'model': "product", 'id': self.product.id, 'action': "create"}])
+
+    def testChangeListLimitBelowOneShouldReturnBadRequest(self):
+        response = self.client.get('/api/changes/', {'limit': -1})
+
+        self.assertEqual(response.status_code, 400)
+
+    def testChangeStreamSendsEventsSinceLastEventId(self):
+        duration = views.STREAM_DURATION
+        views.STREAM_DURATION = 0
+        try:
+            response = self.client.get('/api/changes/stream/', HTTP_LAST_EVENT_ID=str(self.cursor - 1))
+            body = b''.join(response.streaming_content).decode()
+        finally:
+            views.STREAM_DURATION = duration
+
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertIn(f'id: {self.cursor}\n', body)
+        self.assertNotIn(f'id: {self.cursor - 1}\n', body)
+
+    def testChangeStreamEndsOnTimeWhileBusy(self):
+        # A steady flow of changes must not hold the worker, the client resumes from the last id
+        with mock.patch('CRUD.views.STREAM_DURATION', 0), mock.patch('CRUD.views.MAX_CHANGES_PAGE_SIZE', 1):
+            response = self.client.get('/api/changes/stream/', HTTP_LAST_EVENT_ID=str(self.cursor - 2))
+            body = b''.join(response.streaming_content).decode()
+        self.assertIn(f'id: {self.cursor - 1}\n', body)
+        self.assertNotIn(f'id: {self.cursor}\n', body)
+
+        with mock.patch('CRUD.views.STREAM_DURATION', 0):
+            response = self.client.get('/api/changes/stream/', HTTP_LAST_EVENT_ID=str(self.cursor - 1))
+            body = b''.join(response.streaming_content).decode()
+        self.assertIn(f'id: {self.cursor}\n', body)
+
+
+class MigrationTests(TestCase):
+    # Fresh databases (tests, new deploys) should replay the squashed baseline, not the
+    # history. Replay time is measured by "manage.py benchmark migrations", not here.
+    # Past MAX_OPERATIONS it is time to squash again.
+    MAX_OPERATIONS = 40
+
+    def freshInstallPlan(self):
+        loader = MigrationLoader(None)
+        return [loader.graph.nodes[node] for node in loader.graph.forwards_plan(max(loader.graph.leaf_nodes('CRUD'))) if node[0] == 'CRUD']
+
+    def testFreshInstallUsesSquashedMigrations(self):
+        plan = self.freshInstallPlan()
+        replaced = set(plan[0].replaces)
+
+        self.assertIn(('CRUD', '0001_initial'), replaced)
+        self.assertFalse(replaced & {('CRUD', migration.name) for migration in plan})
+
+    def testFreshInstallWithinBudget(self):
+        # Everything a fresh install replays counts, the squash and every migration after it
+        self.assertLessEqual(sum(len(migration.operations) for migration in self.freshInstallPlan()), self.MAX_OPERATIONS)
+
+    def testLowStockBackfill(self):
+        # Products that existed when 0021 added the flag got False whatever their stock
+        category = Category.objects.create(name="Category")
+        strict = Category.objects.create(name="Strict")
+        StockThreshold.objects.create(category=strict, threshold=20)
+        low = Product.objects.create(name="Low", price=1.0, stock=1, category=category)
+        plenty = Product.objects.create(name="Plenty", price=1.0, stock=10, category=category)
+        below = Product.objects.create(name="Below", price=1.0, stock=10, category=strict)
+        Product.objects.update(low_stock=False)
+        Product.objects.filter(id=plenty.id).update(low_stock=True)
+
+        backfill = import_module('CRUD.migrations.0024_backfill_low_stock')
+        backfill.set_low_stock(django_apps, mock.Mock(connection=connection))
+        flags = dict(Product.objects.values_list('id', 'low_stock'))
+        self.assertEqual(flags, {low.id: True, plenty.id: False, below.id: True})
+
+
+class StartupTests(unittest.TestCase):
+    def testWriteOnlyModulesAreNotImportedAtStartup(self):
+        script = "import sys, django; django.setup(); print(' '.join(sorted(name for name in sys.modules if name.startswith('CRUD.'))))"
+        environment = dict(os.environ, DJANGO_SETTINGS_MODULE='config.settings', AUTOCOMPLETE_WARM='False')
+        result = subprocess.run([sys.executable, '-c', script], cwd=settings.BASE_DIR, env=environment, capture_output=True, text=True, check=True)
+        loaded = set(result.stdout.split())
+
+        self.assertIn('CRUD.models', loaded)
+        self.assertFalse(loaded & {'CRUD.analytics', 'CRUD.autocomplete', 'CRUD.cache', 'CRUD.outbox', 'CRUD.related', 'CRUD.stockwatch'})
+
+
+class DatabaseConstraintTests(TestCase):
+    def setUp(self):
+        self.category = Category.objects.create(name="Test Category")
+        self.promotion = Promotion.objects.create(name="Test Promotion", discount=10.0)
+        self.product = Product.objects.create(name="Test Product", price=10.0, stock=10, category=self.category)
+
+    def testSaveMapsConstraintErrorsToValidationMessages(self):
+        cases = [
+            (Product(name="", price=1.0, stock=1, category=self.category), 'Name cannot be empty or none'),
+            (Product(name="Test", price=-1.0, stock=1, category=self.category), 'Price cannot be negative'),
+            (Product(name="Test", price=1.0, stock=None, category=self.category), 'Stock cannot be none'),
+            (Promotion(name="Test", discount=None), 'Discount cannot be none'),
+            (Promotion(name="Test", discount=-0.5), 'Discount cannot be negative'),
+            (Category(name=""), 'Name cannot be empty or none'),
+        ]
+        for instance, message in cases:
+            with self.assertRaisesMessage(ValidationError, message):
+                instance.save()
+
+    def testQuerysetUpdateCannotBypassRules(self):
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                Product.objects.filter(id=self.product.id).update(price=-1.0)
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                Promotion.objects.filter(id=self.promotion.id).update(discount=-1.0)
+
+    def testBulkCreateCannotBypassRules(self):
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                Product.objects.bulk_create([Product(name="", price=1.0, stock=1, category=self.category)])
+
+    def testInvalidProductDoesNotLeaveImageUrlBehind(self):
+        with self.assertRaises(ValidationError):
+            Product.objects.create(name="Test", price=-1.0, stock=1, image_url="https://example.pl/orphan", category=self.category)
+
+        self.assertFalse(ImageUrl.objects.filter(url="https://example.pl/orphan").exists())
+
+
+class ProductUpsertTests(TestCase):
+    def setUp(self):
+        self.category = Category.objects.create(name="Test Category", slug="test-category")
+        self.promotion = Promotion.objects.create(name="Test Promotion", slug="test-promotion", discount=10.0)
+        self.feed = [
+            {"sku": "SKU-1", "name": "Product 1", "price": 10.0, "stock": 1, "category": "test-category", "promotion": "test-promotion",
+             "image_url": "https://example.pl/img=1", "description": "Description 1"},
+            {"sku": "SKU-2", "name": "Product 2", "price": 20.0, "stock": 2, "category": "test-category", "promotion": None,
+             "image_url": None, "description": None},
+        ]
+
+    def testUpsertCreatesThenUpdatesBySku(self):
+        self.assertEqual(Product.objects.upsert(self.feed), (2, 0))
+        self.feed[0]["price"] = 15.0
+        self.feed[1]["description"] = "Description 2"
+        self.assertEqual(Product.objects.upsert(self.feed, chunk_size=1), (0, 2))
+
+        self.assertEqual(Product.objects.count(), 2)
+        product1 = Product.objects.get(sku="SKU-1")
+        product2 = Product.objects.get(sku="SKU-2")
+        self.assertEqual((product1.price, product1.promotion, product1.image_url), (15.0, self.promotion, "https://example.pl/img=1"))
+        self.assertEqual(product1.description, "Description 1")
+        self.assertEqual(product2.description, "Description 2")
+        self.assertIsNone(product2.promotion)
+
+    def testReimportLeavesUnchangedRowsAlone(self):
+        Product.objects.upsert(self.feed)
+        PriceSummary.objects.update(stale=False)
+        versions = dict(Product.objects.values_list('sku', 'version'))
+        events = ChangeEvent.objects.count()
+
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            self.assertEqual(Product.objects.upsert(self.feed), (0, 0))
+        self.assertEqual(callbacks, [])
+        self.assertEqual(dict(Product.objects.values_list('sku', 'version')), versions)
+        self.assertEqual(ChangeEvent.objects.count(), events)
+        self.assertFalse(PriceSummary.objects.filter(stale=True).exists())
+
+        # A changed description alone is a change
+        self.feed[1]["description"] = "Description 2"
+        self.assertEqual(Product.objects.upsert(self.feed), (0, 1))
+        self.assertEqual(Product.objects.get(sku="SKU-2").version, versions["SKU-2"] + 1)
+        self.assertEqual(list(ChangeEvent.objects.filter(id__gt=events).values_list('object_id', 'action')),
+                         [(Product.objects.get(sku="SKU-2").id, ChangeEvent.UPDATE)])
+
+    def testUpsertLeavesOutOptionalFields(self):
+        Product.objects.upsert(self.feed)
+        Product.objects.upsert([{"sku": "SKU-1", "name": "Product 1", "price": 10.0, "stock": 7, "category": "test-category"}])
+
+        product = Product.objects.get(sku="SKU-1")
+        self.assertEqual((product.stock, product.promotion, product.description), (7, self.promotion, "Description 1"))
+
+    def testUpsertRequiresFullRows(self):
+        with self.assertRaises(ValueError):
+            Product.objects.upsert([{"sku": "SKU-1", "stock": 7}])
+
+    def testUpsertRejectsInvalidRows(self):
+        self.feed[1]["price"] = -1.0
+
+        with self.assertRaisesMessage(ValidationError, 'Price cannot be negative'):
+            Product.objects.upsert(self.feed)
+        self.assertFalse(Product.objects.exists())
+        self.assertFalse(ImageUrl.objects.exists())
+
+    def testUpsertRequiresSku(self):
+        for sku in (None, ""):
+            self.feed[1]["sku"] = sku
+
+            with self.assertRaisesMessage(ValueError, 'Every row must have a sku'):
+                Product.objects.upsert(self.feed)
+        self.assertFalse(Product.objects.exists())
+
+    def testUpsertUnknownCategoryShouldRaiseException(self):
+        self.feed[0]["category"] = "missing"
+
+        with self.assertRaises(Category.DoesNotExist):
+            Product.objects.upsert(self.feed)
+
+    def testSkuIsUnique(self):
+        Product.objects.create(sku="SKU-1", name="Product", price=1.0, stock=1, category=self.category)
+
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                Product.objects.create(sku="SKU-1", name="Product", price=1.0, stock=1, category=self.category)
+
+
+class OptimisticLockingTests(TestCase):
+    def setUp(self):
+        self.category = Category.objects.create(name="Test Category")
+        self.promotion = Promotion.objects.create(name="Test Promotion", discount=10.0)
+        self.product = Product.objects.create(name="Test Product", price=10.0, stock=10, category=self.category)
+
+    def testSaveBumpsVersion(self):
+        self.assertEqual(self.product.version, 0)
+        self.product.stock = 5
+        self.product.save()
+
+        self.assertEqual(self.product.version, 1)
+        self.assertEqual(Product.objects.get(id=self.product.id).version, 1)
+
+    def testStaleSaveShouldRaiseConflict(self):
+        for model, instance in ((Product, self.product), (Category, self.category), (Promotion, self.promotion)):
+            other = model.objects.get(id=instance.id)
+            other.name = "Changed"
+            other.save()
+
+            instance.name = "Stale"
+            with self.assertRaises(ConflictError):
+                instance.save()
+            self.assertEqual(model.objects.get(id=instance.id).name, "Changed")
+
+    def testSaveAfterRefreshSucceeds(self):
+        Product.objects.get(id=self.product.id).save()
+
+        self.product.refresh_from_db()
+        self.product.stock = 1
+        self.product.save()
+        self.assertEqual(Product.objects.get(id=self.product.id).stock, 1)
+
+    def testBulkUpdateBumpsVersion(self):
+        Product.objects.batch_update([{"id": self.product.id, "stock": 3}])
+
+        self.product.stock = 4
+        with self.assertRaises(ConflictError):
+            self.product.save()
+
+    def testAdminRejectsStaleForm(self):
+        self.client.force_login(User.objects.create_superuser("admin", "admin@example.pl", "password"))
+        url = f'/admin/CRUD/promotion/{self.promotion.id}/change/'
+        form = {"name": "Edited", "discount": 5.0, "version": 0, "products": []}
+        Promotion.objects.get(id=self.promotion.id).save()
+
+        response = self.client.post(url, form)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "changed by someone else")
+        self.assertEqual(Promotion.objects.get(id=self.promotion.id).name, "Test Promotion")
+
+    def testAdminSavesCurrentForm(self):
+        self.client.force_login(User.objects.create_superuser("admin", "admin@example.pl", "password"))
+        url = f'/admin/CRUD/promotion/{self.promotion.id}/change/'
+
+        response = self.client.post(url, {"name": "Edited", "discount": 5.0, "version": 0, "products": []})
+
+        self.assertEqual(response.status_code, 302)
+        promotion = Promotion.objects.get(id=self.promotion.id)
+        self.assertEqual((promotion.name, promotion.version), ("Edited", 1))
+
+
+class ListingCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name="Test Category")
+        self.cheap = Product.objects.create(name="Cheap", price=5.0, stock=1, category=self.category)
+        self.middle = Product.objects.create(name="Middle", price=20.0, stock=1, category=self.category)
+        self.expensive = Product.objects.create(name="Expensive", price=100.0, stock=1, category=self.category)
+
+    def tearDown(self):
+        cache.clear()
+
+    def getIds(self, **params):
+        return [row['id'] for row in self.client.get('/api/products/', params).json()['results']]
+
+    def testFilteredSortedListingWithCursor(self):
+        params = {'category': self.category.id, 'min_price': 10, 'max_price': 200, 'sort': 'price', 'fields': 'id,price'}
+        self.assertEqual(self.getIds(**params), [self.middle.id, self.expensive.id])
+        self.assertEqual(self.getIds(after=f'20.0:{self.middle.id}', **params), [self.expensive.id])
+
+    def testRepeatedListingIsServedFromCache(self):
+        self.getIds(sort='price')
+        with self.assertNumQueries(0):
+            self.getIds(sort='price')
+
+        self.assertEqual(catalog_cache.stats()['hits'], 1)
+        self.assertEqual(catalog_cache.stats()['misses'], 1)
+
+    def testEquivalentParametersShareOneEntry(self):
+        self.getIds(fields='id,name', limit=100)
+        with self.assertNumQueries(0):
+            self.getIds(limit='100', fields='id, name')
+
+    def testChangesInvalidateListing(self):
+        self.assertEqual(self.getIds(), [self.cheap.id, self.middle.id, self.expensive.id])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.cheap.delete()
+        self.assertEqual(self.getIds(), [self.middle.id, self.expensive.id])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.batch_update([{"id": self.middle.id, "price": 500.0}])
+        self.assertEqual(self.getIds(sort='price'), [self.expensive.id, self.middle.id])
+
+    def testGenerationIsBumpedOnlyOnCommit(self):
+        before = catalog_cache.generations()
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                self.cheap.save()
+                # A reader now would cache the old rows under the generation it sees
+                self.assertEqual(catalog_cache.generations(), before)
+        self.assertNotEqual(catalog_cache.generations(), before)
+
+    def testGenerationsAndStatsDoNotExpire(self):
+        self.getIds()
+        catalog_cache.bump_generation('product')
+        for key in [catalog_cache.generation_key(name) for name in catalog_cache.GENERATION_MODELS] + ['catalog:stats:misses']:
+            with open(cache._key_to_file(key), 'rb') as f:
+                self.assertIsNone(pickle.load(f))
+
+    def testEvictedGenerationIsNeverReused(self):
+        tokens = set()
+        for _ in range(3):
+            cache.delete(catalog_cache.generation_key('product'))
+            tokens.add(catalog_cache.generations()[0])
+        self.assertEqual(len(tokens), 3)
+
+    def testCacheIsKeptOutOfTheProjectDirectory(self):
+        self.assertFalse(cache._dir.startswith(str(settings.BASE_DIR)))
+
+    def testLockIsHeldByOneProcess(self):
+        # Each worker process has its own backend instance over the same directory
+        other = FileBasedCache(cache._dir, {})
+        self.assertTrue(cache.add('lock', 1, timeout=30))
+        self.assertFalse(other.add('lock', 1, timeout=30))
+        cache.delete('lock')
+        self.assertTrue(other.add('lock', 1, timeout=30))
+        other.set('lock', 1, timeout=-1)
+        self.assertTrue(cache.add('lock', 2, timeout=30))
+        self.assertEqual(other.get('lock'), 2)
+
+    def testStaleEntryIsServedWhileAnotherWorkerRecomputes(self):
+        key = catalog_cache.result_key('test', {})
+        generation = '.'.join(catalog_cache.generations())
+        cache.set(key, ("stale", time.time() - 1, generation), 60)
+        cache.add(key + ':lock', "other")
+
+        self.assertEqual(catalog_cache.cached_result('test', {}, lambda: "fresh"), "stale")
+        self.assertEqual(catalog_cache.stats()['stale'], 1)
+
+        cache.delete(key + ':lock')
+        self.assertEqual(catalog_cache.cached_result('test', {}, lambda: "fresh"), "fresh")
+        self.assertEqual(catalog_cache.cached_result('test', {}, lambda: "newer"), "fresh")
+
+    def testLastValueIsServedWhileRecomputingAfterAWrite(self):
+        self.assertEqual(catalog_cache.cached_result('test', {}, lambda: "before"), "before")
+        catalog_cache.bump_generation('product')
+        cache.add(catalog_cache.result_key('test', {}) + ':lock', "other")
+
+        self.assertEqual(catalog_cache.cached_result('test', {}, lambda: "after"), "before")
+        cache.delete(catalog_cache.result_key('test', {}) + ':lock')
+        self.assertEqual(catalog_cache.cached_result('test', {}, lambda: "after"), "after")
+
+    def testOnlyTheHolderReleasesTheLock(self):
+        lock = catalog_cache.result_key('test', {}) + ':lock'
+
+        def takenOver():
+            # The lock expired during a slow compute and another worker took it
+            cache.set(lock, "other", 30)
+            return "value"
+        self.assertEqual(catalog_cache.cached_result('test', {}, takenOver), "value")
+        self.assertEqual(cache.get(lock), "other")
+
+        # A waiter that gave up on the holder computes without touching its lock
+        cache.delete(catalog_cache.result_key('test', {}))
+        with mock.patch('CRUD.cache.WAIT_FOR_RECOMPUTE', 0):
+            self.assertEqual(catalog_cache.cached_result('test', {}, lambda: "waited"), "waited")
+        self.assertEqual(cache.get(lock), "other")
+
+    def testLockHolderRechecksBeforeComputing(self):
+        key = catalog_cache.result_key('test', {})
+        generation = '.'.join(catalog_cache.generations())
+        add = cache.add
+
+        def finishedMeanwhile(*args, **kwargs):
+            # The previous holder stores its value and releases the lock just before our add()
+            cache.set(key, ("stored", time.time() + 60, generation), 60)
+            return add(*args, **kwargs)
+        compute = mock.Mock(return_value="computed")
+        with mock.patch.object(cache, 'add', side_effect=finishedMeanwhile):
+            self.assertEqual(catalog_cache.cached_result('test', {}, compute), "stored")
+        compute.assert_not_called()
+        self.assertIsNone(cache.get(key + ':lock'))
+
+
+class RelatedProductsTests(TestCase):
+    def setUp(self):
+        self.category = Category.objects.create(name="Test Category")
+        self.other = Category.objects.create(name="Other Category")
+        self.promotion = Promotion.objects.create(name="Test Promotion", discount=10.0)
+        self.products = [Product.objects.create(name=f"Product {price}", price=price, stock=1, category=self.category)
+                         for price in (10.0, 11.0, 15.0, 30.0, 100.0)]
+        self.outsider = Product.objects.create(name="Outsider", price=10.5, stock=1, category=self.other)
+        related.rebuild()
+
+    def relatedIds(self, product):
+        return [row["id"] for row in self.client.get(f'/api/products/{product.id}/related/', {'fields': 'id'}).json()["results"]]
+
+    def testListsAreRankedByPriceWithinTheCategory(self):
+        cheap, near, middle, far, expensive = self.products
+        self.assertEqual(self.relatedIds(cheap), [near.id, middle.id, far.id, expensive.id])
+        self.assertEqual(self.relatedIds(far), [middle.id, near.id, cheap.id, expensive.id])
+        self.assertEqual(self.relatedIds(self.outsider), [])
+        self.assertFalse(RelatedRefresh.objects.exists())
+
+    def testSharedPromotionRanksHigher(self):
+        cheap, near, middle, far, _ = self.products
+        Product.objects.filter(id__in=[cheap.id, far.id]).update(promotion=self.promotion)
+        related.rebuild()
+        self.assertEqual(self.relatedIds(far)[:3], [middle.id, cheap.id, near.id])
+
+    def testServedWithOneQuery(self):
+        with self.assertNumQueries(1):
+            self.relatedIds(self.products[0])
+
+    def testOnlyRelevantChangesAreRefreshed(self):
+        cheap, near, middle, far, expensive = self.products
+        near.stock = 5
+        near.save()
+        self.assertFalse(RelatedRefresh.objects.exists())
+
+        expensive.price = 12.0
+        expensive.save()
+        Product.objects.batch_update([{"id": far.id, "stock": 0}])
+        self.assertEqual(list(RelatedRefresh.objects.values_list('product_id', flat=True)), [expensive.id])
+        related.refresh()
+        self.assertEqual(self.relatedIds(cheap)[:3], [near.id, expensive.id, middle.id])
+        self.assertFalse(RelatedRefresh.objects.exists())
+
+    def testCategoryChangeAndDeleteRefreshBothSides(self):
+        cheap, near, middle, far, expensive = self.products
+        near.category = self.other
+        near.save()
+        related.refresh()
+        self.assertEqual(self.relatedIds(cheap), [middle.id, far.id, expensive.id])
+        self.assertEqual(self.relatedIds(self.outsider), [near.id])
+
+        middle.delete()
+        related.refresh()
+        self.assertEqual(self.relatedIds(cheap), [far.id, expensive.id])
+        self.assertEqual(RelatedProduct.objects.filter(product=far).count(), 2)
+
+
+
+@override_settings(LOW_STOCK_THRESHOLD=5)
+class LowStockTests(TestCase):
+    def setUp(self):
+        self.category = Category.objects.create(name="Test Category")
+        self.other = Category.objects.create(name="Other Category")
+        self.product = Product.objects.create(name="Test Product", price=10.0, stock=10, category=self.category)
+        self.other_product = Product.objects.create(name="Other Product", price=10.0, stock=10, category=self.other)
+
+    def alerts(self):
+        return list(StockAlert.objects.order_by('id').values_list('product_id', 'stock', 'low'))
+
+    def lowStockIds(self, **params):
+        return [row["id"] for row in self.client.get('/api/products/low-stock/', {'fields': 'id', **params}).json()["results"]]
+
+    def testAlertsOnlyOnCrossings(self):
+        for stock in (4, 3, 6, 7):
+            self.product.stock = stock
+            self.product.save()
+        self.product.name = "Renamed"
+        self.product.save()
+
+        self.assertEqual(self.alerts(), [(self.product.id, 4, True), (self.product.id, 6, False)])
+        self.assertFalse(Product.objects.get(id=self.product.id).low_stock)
+
+    def testBulkPathsFlagAndAlert(self):
+        Product.objects.batch_update([{"id": self.product.id, "stock": 1}, {"id": self.other_product.id, "price": 1.0}])
+        Product.objects.batch_update([{"id": self.product.id, "stock": 0}])
+        self.assertEqual(self.alerts(), [(self.product.id, 1, True)])
+        self.assertEqual(self.lowStockIds(), [self.product.id])
+
+    def testCategoryThresholdOverridesGlobal(self):
+        StockThreshold.objects.create(category=self.other, threshold=20)
+        self.assertEqual(self.alerts(), [(self.other_product.id, 10, True)])
+        self.assertEqual(self.lowStockIds(), [self.other_product.id])
+        self.assertEqual(self.lowStockIds(category=self.category.id), [])
+
+        self.other_product.refresh_from_db()
+        self.other_product.category = self.category
+        self.other_product.save()
+        self.assertEqual(self.alerts()[-1], (self.other_product.id, 10, False))
+
+    def testSaveWithUpdateFieldsWritesTheFlag(self):
+        self.product.stock = 1
+        self.product.save(update_fields=['stock'])
+        self.assertTrue(Product.objects.get(id=self.product.id).low_stock)
+
+        # An unsaved stock change does not touch the flag
+        self.product.stock = 10
+        self.product.name = "Renamed"
+        self.product.save(update_fields=['name'])
+        self.assertTrue(Product.objects.get(id=self.product.id).low_stock)
+        self.product.save(update_fields=['stock'])
+        self.assertFalse(Product.objects.get(id=self.product.id).low_stock)
+        self.assertEqual(self.alerts(), [(self.product.id, 1, True), (self.product.id, 10, False)])
+
+    def testThresholdChangeIsRecordedLikeOtherStockWrites(self):
+        events = ChangeEvent.objects.count()
+        generations = catalog_cache.generations()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            StockThreshold.objects.create(category=self.other, threshold=20)
+
+        product = Product.objects.get(id=self.other_product.id)
+        self.assertEqual((product.low_stock, product.version), (True, self.other_product.version + 1))
+        self.assertEqual(list(ChangeEvent.objects.filter(id__gt=events).values_list('object_id', 'action')), [(product.id, ChangeEvent.UPDATE)])
+        self.assertNotEqual(catalog_cache.generations()[0], generations[0])
+
+    def testDashboardUsesThePartialIndex(self):
+        self.product.stock = 0
+        self.product.save()
+        plan = Product.objects.filter(low_stock=True).order_by('stock', 'id').explain()
+        self.assertIn('product_low_stock_idx', plan)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.lowStockIds(), [self.product.id])
+
+    def testLimitBelowOneShouldReturnBadRequest(self):
+        for url in ('/api/products/low-stock/', '/api/stock/alerts/'):
+            self.assertEqual(self.client.get(url, {'limit': -1}).status_code, 400)
+
+
+class PriceAnalyticsTests(TestCase):
+    def setUp(self):
+        self.category = Category.objects.create(name="Test Category")
+        self.other = Category.objects.create(name="Other Category")
+        self.promotion = Promotion.objects.create(name="Test Promotion", discount=20.0)
+        self.cheap = Product.objects.create(name="Cheap", price=5.0, stock=10, category=self.category)
+        self.mid = Product.objects.create(name="Mid", price=30.0, stock=2, category=self.category, promotion=self.promotion)
+        self.dear = Product.objects.create(name="Dear", price=2000.0, stock=1, category=self.other, promotion=self.promotion)
+        analytics.refresh()
+
+    def summaries(self):
+        return {(summary.scope, summary.scope_id): (summary.product_count, summary.min_price, summary.max_price, summary.avg_price,
+                                                    summary.inventory_value, summary.discount_value, summary.histogram)
+                for summary in PriceSummary.objects.all()}
+
+    def testRefreshComputesTotalsAndHistogram(self):
+        summaries = self.summaries()
+        self.assertEqual(summaries[('category', self.category.id)], (2, 5.0, 30.0, 17.5, 110.0, 12.0, [1, 0, 1, 0, 0, 0, 0, 0]))
+        self.assertEqual(summaries[('promotion', self.promotion.id)], (2, 30.0, 2000.0, 1015.0, 2060.0, 412.0, [0, 0, 1, 0, 0, 0, 0, 1]))
+        self.assertFalse(PriceSummary.objects.filter(stale=True).exists())
+
+    def testRebuildMatchesIncrementalRefresh(self):
+        Product.objects.create(name="Extra", price=99.0, stock=3, category=self.other)
+        analytics.refresh()
+        refreshed = self.summaries()
+        self.assertEqual(analytics.rebuild(), 3)
+        self.assertEqual(self.summaries(), refreshed)
+
+    def testChangesMarkOnlyAffectedScopes(self):
+        Product.objects.batch_update([{"id": self.cheap.id, "price": 15.0}])
+        self.assertEqual(set(PriceSummary.objects.filter(stale=True).values_list('scope', 'scope_id')), {('category', self.category.id)})
+        self.assertEqual(analytics.refresh(), 1)
+        self.assertEqual(self.summaries()[('category', self.category.id)][6], [0, 1, 1, 0, 0, 0, 0, 0])
+
+        self.dear.delete()
+        self.promotion.discount = 50.0
+        self.promotion.save()
+        analytics.refresh()
+        self.assertEqual(self.summaries()[('promotion', self.promotion.id)], (1, 30.0, 30.0, 30.0, 60.0, 30.0, [0, 0, 1, 0, 0, 0, 0, 0]))
+        self.assertEqual(self.summaries()[('category', self.other.id)][0], 0)
+
+    def testDiscountCountsOnlyInsideTheWindow(self):
+        self.promotion.starts_at = timezone.now() + timedelta(days=1)
+        self.promotion.save()
+        analytics.refresh()
+        self.assertEqual(self.summaries()[('promotion', self.promotion.id)][5], 0.0)
+        self.assertEqual(analytics.rebuild(), 3)
+        self.assertEqual(self.summaries()[('promotion', self.promotion.id)][5], 0.0)
+
+        # The window opens with no write, the schedule job marks what was computed before
+        Promotion.objects.apply_schedule(when=self.promotion.starts_at + timedelta(minutes=1))
+        self.assertEqual(set(PriceSummary.objects.filter(stale=True).values_list('scope', 'scope_id')),
+                         {('category', self.category.id), ('category', self.other.id), ('promotion', self.promotion.id)})
+        with mock.patch('django.utils.timezone.now', return_value=self.promotion.starts_at + timedelta(minutes=1)):
+            analytics.refresh()
+            Promotion.objects.apply_schedule()
+        self.assertEqual(self.summaries()[('promotion', self.promotion.id)][5], 412.0)
+        self.assertFalse(PriceSummary.objects.filter(stale=True).exists())
+
+    def testOnlyDiscountOrWindowChangesRescan(self):
+        self.promotion.name = "Renamed"
+        with CaptureQueriesContext(connection) as queries:
+            self.promotion.save()
+        self.assertFalse([query for query in queries if 'CRUD_product"' in query['sql']])
+        self.assertFalse(PriceSummary.objects.filter(stale=True).exists())
+        self.promotion.ends_at = timezone.now() + timedelta(days=1)
+        self.promotion.save()
+        self.assertEqual(PriceSummary.objects.filter(stale=True).count(), 3)
+
+    def testDeletedScopeDropsItsSummary(self):
+        self.other.delete()
+        analytics.refresh()
+        self.assertNotIn(('category', self.other.id), self.summaries())
+
+    def testEndpointReadsOnlyTheSummary(self):
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/analytics/prices/', {'scope': 'promotion', 'id': self.promotion.id})
+        result = response.json()["results"][0]
+        self.assertEqual(result["product_count"], 2)
+        self.assertEqual(result["histogram"][-1], {"min": 1000, "max": None, "count": 1})
+        self.assertFalse(result["stale"])
+        self.assertEqual(self.client.get('/api/analytics/prices/', {'scope': 'brand'}).status_code, 400)
+
+
+SHARDS = ['shard_0', 'shard_1']
+
+
+@override_settings(CATALOG_SHARD_ALIASES=SHARDS)
+class ShardingTests(TransactionTestCase):
+    @classmethod
+    def setUpClass(cls):
+        # Shards are plain files in a temporary directory, added after the test runner
+        # has set up its databases, so they are flushed by tearDown() here
+        super().setUpClass()
+        cls.directory = tempfile.mkdtemp()
+        for alias in SHARDS:
+            connections.settings[alias] = connections.configure_settings({'default': connections.settings['default'], alias: {
+                'ENGINE': 'django.db.backends.sqlite3', 'NAME': os.path.join(cls.directory, f'{alias}.sqlite3')}})[alias]
+            call_command('migrate', database=alias, verbosity=0)
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        for alias in SHARDS:
+            connections[alias].close()
+            del connections[alias]
+            del connections.settings[alias]
+        shutil.rmtree(cls.directory)
+
+    def setUp(self):
+        cache.clear()
+        reset_index()
+        sharding._reserved_ids.clear()
+        sharding._placements.clear()
+        sharding._relays_queued.clear()
+        self.first = Category.objects.create(name="First", slug="first")
+        self.second = Category.objects.create(name="Second", slug="second")
+        CategoryShard.objects.create(category=self.first, alias='shard_0')
+        CategoryShard.objects.create(category=self.second, alias='shard_1')
+        self.promotion = Promotion.objects.create(name="Test Promotion", slug="test-promotion", discount=10.0)
+
+    def tearDown(self):
+        cache.clear()
+        reset_index()
+        for alias in SHARDS:
+            call_command('flush', database=alias, interactive=False, inhibit_post_migrate=True, verbosity=0)
+
+    def shardOf(self, product_id):
+        return [alias for alias in SHARDS if Product.objects.using(alias).filter(id=product_id).exists()]
+
+    def testSharedRowsAreCopiedToEveryShard(self):
+        for alias in SHARDS:
+            self.assertEqual(Category.objects.using(alias).get(id=self.second.id).name, "Second")
+        self.promotion.delete()
+        for alias in SHARDS:
+            self.assertFalse(Promotion.objects.using(alias).exists())
+
+    def testProductsLiveOnTheirCategoryShard(self):
+        first = Product.objects.create(name="First", price=1.0, stock=1, category=self.first, description="Text")
+        second = Product.objects.create(name="Second", price=2.0, stock=1, category=self.second, image_url="https://example.pl/img=1")
+
+        self.assertNotEqual(first.id, second.id)
+        self.assertEqual(self.shardOf(first.id), ['shard_0'])
+        self.assertEqual(self.shardOf(second.id), ['shard_1'])
+        self.assertFalse(Product.objects.using('default').exists())
+        self.assertEqual(Product.objects.using('shard_0').get(id=first.id).description, "Text")
+        self.assertEqual(Product.objects.using('shard_1').get(id=second.id).image_url, "https://example.pl/img=1")
+
+    def testChangingCategoryMovesTheProduct(self):
+        product = Product.objects.create(name="Product", price=1.0, stock=1, category=self.first, description="Text")
+        product.promotions.add(self.promotion)
+        product.category = self.second
+        product.save()
+
+        self.assertEqual(self.shardOf(product.id), ['shard_1'])
+        moved = Product.objects.using('shard_1').get(id=product.id)
+        self.assertEqual(moved.description, "Text")
+        self.assertEqual(list(moved.promotions.values_list('id', flat=True)), [self.promotion.id])
+
+    def testListingMergesShardsInOrder(self):
+        for price in (5.0, 1.0, 4.0):
+            Product.objects.create(name=f"First {price}", price=price, stock=1, category=self.first)
+        for price in (3.0, 2.0):
+            Product.objects.create(name=f"Second {price}", price=price, stock=1, category=self.second)
+
+        listing = self.client.get('/api/products/', {'sort': 'price', 'fields': 'price', 'limit': 4}).json()['results']
+        self.assertEqual([row['price'] for row in listing], [1.0, 2.0, 3.0, 4.0])
+        listing = self.client.get('/api/products/', {'category': self.second.id, 'fields': 'name'}).json()['results']
+        self.assertEqual([row['name'] for row in listing], ["Second 3.0", "Second 2.0"])
+        self.assertEqual([name for _, name in get_index().search("second")], ["Second 2.0", "Second 3.0"])
+
+    def testBulkPathsReachEveryShard(self):
+        first = Product.objects.create(name="First", price=1.0, stock=1, category=self.first, promotion=self.promotion)
+        second = Product.objects.create(name="Second", price=2.0, stock=1, category=self.second, promotion=self.promotion)
+        second.promotions.add(self.promotion)
+
+        results = Product.objects.batch_update([{"id": first.id, "stock": 7}, {"id": second.id, "stock": 8}])
+        self.assertTrue(all(result['ok'] for result in results))
+        self.assertEqual(Product.objects.using('shard_0').get(id=first.id).stock, 7)
+        self.assertEqual(Product.objects.using('shard_1').get(id=second.id).stock, 8)
+
+        self.promotion.retire(chunk_size=1)
+        self.assertIsNone(Product.objects.using('shard_0').get(id=first.id).promotion_id)
+        self.assertIsNone(Product.objects.using('shard_1').get(id=second.id).promotion_id)
+        self.assertFalse(Promotion.products.through.objects.using('shard_1').exists())
+
+    def testUpsertAndRebalance(self):
+        feed = [{"sku": "SKU-1", "name": "Product 1", "price": 1.0, "stock": 1, "category": "first", "description": "Text"},
+                {"sku": "SKU-2", "name": "Product 2", "price": 2.0, "stock": 1, "category": "second", "description": None}]
+        self.assertEqual(Product.objects.upsert(feed), (2, 0))
+        product = Product.objects.using('shard_0').get(sku="SKU-1")
+        self.assertEqual(Product.objects.using('shard_1').get(sku="SKU-2").name, "Product 2")
+
+        call_command('rebalance_shards', category=self.first.id, to='shard_1', verbosity=0, stdout=open(os.devnull, 'w'))
+        self.assertEqual(self.shardOf(product.id), ['shard_1'])
+        self.assertEqual(Product.objects.using('shard_1').get(id=product.id).description, "Text")
+
+        feed[0]["price"] = 9.0
+        self.assertEqual(Product.objects.upsert(feed), (0, 1))
+        self.assertEqual(Product.objects.using('shard_1').get(id=product.id).price, 9.0)
+
+    def testRebalancePinsAfterTheCopy(self):
+        kept, deleted = [Product.objects.create(name=f"Product {i}", price=1.0, stock=1, category=self.first, description="Text") for i in range(2)]
+        copy_products = sharding.copy_products
+        created = []
+
+        def copy_then_write(ids, source, target):
+            copied = copy_products(ids, source, target)
+            if not created:
+                # Still placed on shard_0 and readable there while the copy runs
+                self.assertEqual(sharding.shard_for_category(self.first.id), 'shard_0')
+                self.assertEqual(Product.objects.using('shard_0').filter(category=self.first).count(), 2)
+                kept.price = 5.0
+                kept.save()
+                deleted.delete()
+                created.append(Product.objects.create(name="Created", price=1.0, stock=1, category=self.first))
+            return copied
+
+        with mock.patch.object(sharding, 'copy_products', side_effect=copy_then_write):
+            self.assertEqual(sharding.rebalance_category(self.first.id, 'shard_1', chunk_size=2), 2)
+        self.assertFalse(Product.objects.using('shard_0').exists())
+        self.assertEqual(sorted(Product.objects.using('shard_1').values_list('id', flat=True)), [kept.id, created[0].id])
+        self.assertEqual(Product.objects.using('shard_1').get(id=kept.id).price, 5.0)
+        self.assertEqual(Product.objects.using('shard_1').get(id=kept.id).description, "Text")
+        self.assertFalse(ProductDetails.objects.using('shard_1').filter(product_id=deleted.id).exists())
+        self.assertEqual(sharding.shard_for_category(self.first.id), 'shard_1')
+
+    def testSideRowsAreWrittenOnTheShardAndRelayed(self):
+        events = ChangeEvent.objects.count()
+        product = Product.objects.create(name="Product", price=1.0, stock=1, category=self.first)
+
+        # Relayed to the default database by a job the shard commit queued
+        self.assertEqual(ChangeEvent.objects.count(), events)
+        with mock.patch('django.utils.timezone.now', return_value=timezone.now() + timedelta(seconds=sharding.RELAY_DELAY)):
+            run_pending()
+        self.assertEqual(ChangeEvent.objects.count(), events + 1)
+        self.assertEqual(ChangeEvent.objects.latest('id').object_id, product.id)
+        self.assertTrue(StockAlert.objects.filter(product_id=product.id, low=True).exists())
+        self.assertTrue(PriceSummary.objects.filter(scope=analytics.CATEGORY, scope_id=self.first.id, stale=True).exists())
+        for alias in SHARDS:
+            self.assertFalse(ChangeEvent.objects.using(alias).exists())
+            self.assertFalse(StockAlert.objects.using(alias).exists())
+            self.assertFalse(PriceSummary.objects.using(alias).exists())
+        # Related product marks are consumed on the shard
+        self.assertTrue(RelatedRefresh.objects.using('shard_0').filter(product_id=product.id).exists())
+        self.assertFalse(RelatedRefresh.objects.using('default').exists())
+        related.refresh()
+        self.assertFalse(RelatedRefresh.objects.using('shard_0').exists())
+
+    def testRelayIsQueuedOncePerDelay(self):
+        with mock.patch.object(sharding, 'queue_relay') as queue_relay:
+            with transaction.atomic(using='shard_0'):
+                ChangeEvent.record(Product, [1], ChangeEvent.UPDATE, 'shard_0')
+                ChangeEvent.record(Product, [2], ChangeEvent.UPDATE, 'shard_0')
+        queue_relay.assert_called_once_with('shard_0')
+
+        # Later commits within RELAY_DELAY are left to the queued job
+        ChangeEvent.record(Product, [3], ChangeEvent.UPDATE, 'shard_0')
+        ChangeEvent.record(Product, [4], ChangeEvent.UPDATE, 'shard_0')
+        ChangeEvent.record(Product, [5], ChangeEvent.UPDATE, 'shard_1')
+        self.assertEqual(sorted(Job.objects.values_list('kwargs', flat=True), key=str), [{"shards": ["shard_0"]}, {"shards": ["shard_1"]}])
+        self.assertFalse(ChangeEvent.objects.filter(model='product').exists())
+        with mock.patch('django.utils.timezone.now', return_value=timezone.now() + timedelta(seconds=sharding.RELAY_DELAY)):
+            run_pending()
+        self.assertEqual(sorted(ChangeEvent.objects.filter(model='product').values_list('object_id', flat=True)), [1, 2, 3, 4, 5])
+
+    def testCachedPlacementIsCheckedOnTheShard(self):
+        product = Product.objects.create(name="Product", price=1.0, stock=1, category=self.first)
+        with CaptureQueriesContext(connections['default']) as queries:
+            product.save()
+        self.assertFalse([query for query in queries if 'CRUD_categoryshard' in query['sql']])
+
+        # Pinned elsewhere by another process, this one still has shard_0 cached
+        pin = CategoryShard.objects.get(category=self.first)
+        pin.alias = 'shard_1'
+        pin.save()
+        self.assertEqual(CategoryShard.objects.using('shard_0').get(category=self.first).alias, 'shard_1')
+        created = Product.objects.create(name="Created", price=1.0, stock=1, category=self.first)
+        product.save()
+        self.assertEqual(self.shardOf(created.id), ['shard_1'])
+        self.assertEqual(self.shardOf(product.id), ['shard_1'])
+        self.assertEqual(Product.objects.using('shard_1').get(id=product.id).version, product.version)
+
+    def testFailedShardWriteLeavesNoSideRows(self):
+        product = Product.objects.create(name="Product", price=1.0, stock=10, category=self.first)
+        sharding.relay('shard_0')
+        events, alerts = ChangeEvent.objects.count(), StockAlert.objects.count()
+        PriceSummary.objects.all().delete()
+
+        def fail(**kwargs):
+            raise RuntimeError("Failed")
+        products_bulk_changed.connect(fail)
+        try:
+            with self.assertRaises(RuntimeError):
+                Product.objects.batch_update([{"id": product.id, "stock": 1, "price": 2.0}])
+        finally:
+            products_bulk_changed.disconnect(fail)
+
+        self.assertEqual(Product.objects.using('shard_0').get(id=product.id).stock, 10)
+        self.assertEqual((ChangeEvent.objects.count(), StockAlert.objects.count()), (events, alerts))
+        self.assertFalse(PriceSummary.objects.exists())
+        self.assertFalse(StockAlert.objects.using('shard_0').exists())
+        self.assertFalse(ChangeEvent.objects.using('shard_0').exists())
+
+    def testRelayJobMovesLeftoverRows(self):
+        # Rows whose relay failed after the commit wait on the shard for the job
+        ChangeEvent.objects.using('shard_1').create(model='product', object_id=7, action=ChangeEvent.UPDATE)
+        enqueue('relay_shard_rows')
+        run_pending()
+        self.assertFalse(ChangeEvent.objects.using('shard_1').exists())
+        self.assertEqual(ChangeEvent.objects.latest('id').object_id, 7)
+
+    def testUnpinnedProductQueriesFanOut(self):
+        first = Product.objects.create(name="First", price=1.0, stock=1, category=self.first)
+        second = Product.objects.create(name="Second", price=2.0, stock=1, category=self.second)
+        self.assertEqual(Product.objects.get(pk=second.id).name, "Second")
+        with self.assertRaises(Product.DoesNotExist):
+            Product.objects.get(pk=second.id + 100)
+        self.assertEqual(list(Product.objects.order_by('-price')), [second, first])
+        self.assertEqual(list(Product.objects.order_by('price').values_list('price', flat=True)[1:]), [2.0])
+        self.assertEqual((Product.objects.count(), Product.objects.filter(price__gt=5).exists()), (2, False))
+        with self.assertRaises(sharding.ShardRoutingError):
+            list(ProductDetails.objects.all())
+        # Through an instance or pinned with using() the shard is known
+        self.assertEqual(list(self.first.product_set.values_list('id', flat=True)), [first.id])
+        self.assertEqual(Product.objects.using('shard_0').get(id=first.id).name, "First")
+
+    def testUnpinnedUpdateAndDeleteReachEveryShard(self):
+        first = Product.objects.create(name="First", price=1.0, stock=1, category=self.first)
+        second = Product.objects.create(name="Second", price=2.0, stock=1, category=self.second)
+        self.assertEqual(Product.objects.filter(stock=1).update(stock=7), 2)
+        self.assertEqual(Product.objects.using('shard_1').get(id=second.id).stock, 7)
+        deleted, _ = Product.objects.filter(id__in=[first.id, second.id]).delete()
+        self.assertEqual(deleted, 2)
+        self.assertEqual(self.shardOf(first.id) + self.shardOf(second.id), [])
+
+    def testSubtreeQueriesReadEveryShard(self):
+        Category.objects.reparent([self.second], self.first)
+        first = Product.objects.create(name="First", price=1.0, stock=1, category=self.first)
+        second = Product.objects.create(name="Second", price=2.0, stock=1, category=self.second)
+        self.assertEqual(list(self.first.subtree_products().order_by('name')), [first, second])
+        self.assertEqual(list(self.second.subtree_products()), [second])
+        counts = dict(Category.objects.with_subtree_product_counts().values_list('slug', 'subtree_product_count'))
+        self.assertEqual(counts, {"first": 2, "second": 1})
+
+    def testPromotionMembersAreWrittenOnTheirShards(self):
+        first = Product.objects.create(name="First", price=1.0, stock=1, category=self.first)
+        second = Product.objects.create(name="Second", price=2.0, stock=1, category=self.second)
+        with self.assertRaises(sharding.ShardRoutingError):
+            self.promotion.products.add(first)
+
+        self.promotion.set_products([first, second])
+        for alias in SHARDS:
+            self.assertEqual(Promotion.products.through.objects.using(alias).count(), 1)
+        self.assertFalse(Promotion.products.through.objects.using('default').exists())
+        self.assertEqual(list(self.promotion.products.order_by('id')), [first, second])
+        self.promotion.set_products([second])
+        self.assertEqual(list(self.promotion.products.all()), [second])
+
+    def testPromotionAdminEditsMembersOnEveryShard(self):
+        first = Product.objects.create(name="First", price=1.0, stock=1, category=self.first)
+        second = Product.objects.create(name="Second", price=2.0, stock=1, category=self.second)
+        self.client.force_login(User.objects.create_superuser("admin", "admin@example.pl", "password"))
+        url = f'/admin/CRUD/promotion/{self.promotion.id}/change/'
+        response = self.client.get(url)
+        self.assertContains(response, f'<option value="{second.id}">')
+
+        form = {"name": "Edited", "slug": "test-promotion", "discount": 5.0, "version": 0, "products": [first.id, second.id]}
+        self.assertEqual(self.client.post(url, form).status_code, 302)
+        self.assertEqual(list(self.promotion.products.order_by('id')), [first, second])
+        self.assertEqual(Promotion.products.through.objects.using('shard_1').get().product_id, second.id)
+
+    def testBulkRenameUpdatesAutocomplete(self):
+        feed = [{"sku": "SKU-1", "name": "Kettle", "price": 1.0, "stock": 1, "category": "second"}]
+        Product.objects.upsert(feed)
+        get_index()
+        feed[0]["name"] = "Teapot"
+        Product.objects.upsert(feed)
+        self.assertEqual([name for _, name in get_index().search("tea")], ["Teapot"])
+        self.assertEqual(get_index().search("kett"), [])
+
+    def testAutocompleteCatchesUpWithShardWrites(self):
+        product = Product.objects.create(name="Kettle", price=1.0, stock=1, category=self.second)
+        index = get_index()
+        Product.objects.using('shard_1').filter(id=product.id).update(name="Teapot")
+        with mock.patch('CRUD.sharding.relay_on_commit'):
+            # Not relayed yet, read on the shard
+            ChangeEvent.record(Product, [product.id], ChangeEvent.UPDATE, 'shard_1')
+        with mock.patch('CRUD.autocomplete.SYNC_INTERVAL', 0):
+            get_index()
+        self.assertEqual(index.search("tea"), [(product.id, "Teapot")])
@@ -0,0 +1,17 @@
+from django.urls import path
+
+from . import views
+
+urlpatterns = [
+    path('products/', views.product_list, name = 'product-list'),
+    path('products/batch/', views.product_batch_update, name = 'product-batch-update'),
+    path('products/autocomplete/', views.autocomplete, name = 'product-autocomplete'),
+    path('products/autocomplete/select/', views.autocomplete_select, name = 'product-autocomplete-select'),
+    path('products/<int:product_id>/related/', views.product_related, name = 'product-related'),
+    path('products/low-stock/', views.low_stock, name = 'product-low-stock'),
+    path('stock/alerts/', views.stock_alerts, name = 'stock-alerts'),
+    path('analytics/prices/', views.price_analytics, name = 'price-analytics'),
+    path('changes/', views.change_list, name = 'change-list'),
+    path('changes/stream/', views.change_stream, name = 'change-stream'),
+    path('cache/stats/', views.cache_stats, name = 'cache-stats'),
+]
@@ -1,3 +1,261 @@
-from django.shortcuts import render
+import json
+import math
+import time
+
+from django.db.models import Q
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.views.decorators.http import require_GET, require_http_methods, require_POST
+
+from .autocomplete import get_index, pick
+from .cache import cached_result, stats
+from .analytics import PRICE_BUCKETS
+from .models import ChangeEvent, PriceSummary, Product, StockAlert
+from .related import RELATED_COUNT
+from .serializers import parse_fields, serialize_product_rows
+from .sharding import shard_for_category
+
+MAX_PAGE_SIZE = 10000
+MAX_BATCH_SIZE = 10000
+MAX_CHANGES_PAGE_SIZE = 1000
+MAX_ALERTS_PAGE_SIZE = 1000
+STREAM_POLL_INTERVAL = 1
+STREAM_DURATION = 5
+STREAM_RETRY = 1 # Seconds the browser waits before reconnecting
+
+
+def int_param(request, name, default = None, min_value = None):
+    value = request.GET.get(name)
+    if value is None or value == '':
+        return default
+    value = int(value)
+    if min_value is not None and value < min_value:
+        raise ValueError(f'{name} must be at least {min_value}')
+    return value
 
 # Create your views here.
+@require_GET
+def autocomplete(request):
+    try:
+        limit = min(int(request.GET.get('limit', 10)), 50)
+    except ValueError:
+        limit = 10
+    results = get_index().search(request.GET.get('q', ''), limit)
+    return JsonResponse({'results': [{'id': product_id, 'name': name} for product_id, name in results]})
+
+
+@require_POST
+def autocomplete_select(request):
+    # The client reports which suggestion was picked (form field id), which feeds the
+    # ranking. A POST, so crawlers and link prefetching cannot inflate it.
+    selected = request.POST.get('id', '')
+    if not selected.isdigit():
+        return JsonResponse({'error': 'id must be a product id'}, status = 400)
+    pick(int(selected))
+    return HttpResponse(status = 204)
+
+
+@require_GET
+def product_list(request):
+    # Keyset pagination: ?after=<last id> when sorted by id, ?after=<last price>:<last id>
+    # with sort=price. Filters: category, min_price, max_price. Sparse fields: fields=id,name
+    try:
+        sort = request.GET.get('sort', 'id')
+        if sort not in ('id', 'price'):
+            raise ValueError('sort must be id or price')
+        params = {
+            'fields': ','.join(parse_fields(request.GET.get('fields'))),
+            'sort': sort,
+            'after': parse_cursor(request.GET.get('after'), sort),
+            'limit': min(int_param(request, 'limit', 100, min_value = 1), MAX_PAGE_SIZE),
+            'category': int_param(request, 'category'),
+            'min_price': float_param(request, 'min_price'),
+            'max_price': float_param(request, 'max_price'),
+        }
+    except ValueError as error:
+        return JsonResponse({'error': str(error)}, status = 400)
+
+    body = cached_result('product_list', params, lambda: render_product_list(**params))
+    return HttpResponse(body, content_type = 'application/json')
+
+
+def parse_cursor(value, sort):
+    if not value:
+        return None
+    if sort == 'id':
+        return int(value)
+    price, product_id = value.split(':')
+    return (finite_float(price, 'after'), int(product_id))
+
+
+def float_param(request, name):
+    value = request.GET.get(name)
+    return finite_float(value, name) if value not in (None, '') else None
+
+
+def finite_float(value, name):
+    # float() also accepts nan and inf, which no price compares sensibly with
+    value = float(value)
+    if not math.isfinite(value):
+        raise ValueError(f'{name} must be a finite number')
+    return value
+
+
+def render_product_list(fields, sort, after, limit, category, min_price, max_price):
+    products = Product.objects.all()
+    if category is not None:
+        # One category lives on one shard, anything else is fanned out by the serializer
+        products = products.using(shard_for_category(category)).filter(category_id = category)
+    if min_price is not None:
+        products = products.filter(price__gte = min_price)
+    if max_price is not None:
+        products = products.filter(price__lte = max_price)
+    if sort == 'price':
+        if after is not None:
+            products = products.filter(Q(price__gt = after[0]) | Q(price = after[0], id__gt = after[1]))
+        products = products.order_by('price', 'id')
+    else:
+        if after is not None:
+            products = products.filter(id__gt = after)
+        products = products.order_by('id')
+    return '{"results":' + serialize_product_rows(products[:limit], fields.split(',')) + '}'
+
+
+@require_GET
+def product_related(request, product_id):
+    # Served from the precomputed table, one indexed query
+    try:
+        fields = parse_fields(request.GET.get('fields'))
+    except ValueError as error:
+        return JsonResponse({'error': str(error)}, status = 400)
+    related = Product.objects.filter(recommended_by__product_id = product_id).order_by('recommended_by__rank')[:RELATED_COUNT]
+    return HttpResponse('{"results":' + serialize_product_rows(related, fields) + '}', content_type = 'application/json')
+
+
+@require_GET
+def low_stock(request):
+    # Lowest stock first. Reads only the partial index on low_stock, so the cost follows
+    # the number of low stock products, not the catalog size
+    try:
+        fields = parse_fields(request.GET.get('fields'))
+        limit = min(int_param(request, 'limit', 100, min_value = 1), MAX_PAGE_SIZE)
+        category = int_param(request, 'category')
+    except ValueError as error:
+        return JsonResponse({'error': str(error)}, status = 400)
+    products = Product.objects.filter(low_stock = True)
+    if category is not None:
+        products = products.using(shard_for_category(category)).filter(category_id = category)
+    products = products.order_by('stock', 'id')[:limit]
+    return HttpResponse('{"results":' + serialize_product_rows(products, fields) + '}', content_type = 'application/json')
+
+
+@require_GET
+def stock_alerts(request):
+    # Threshold crossings in order, pass "next" back as ?since= like the change feed
+    try:
+        since = int_param(request, 'since', 0)
+        limit = min(int_param(request, 'limit', MAX_ALERTS_PAGE_SIZE, min_value = 1), MAX_ALERTS_PAGE_SIZE)
+    except ValueError as error:
+        return JsonResponse({'error': str(error)}, status = 400)
+    alerts = StockAlert.objects.filter(id__gt = since).order_by('id').values('id', 'product_id', 'category_id', 'stock', 'threshold', 'low', 'created_at')[:limit]
+    results = [{'seq': alert.pop('id'), **alert} for alert in alerts]
+    return JsonResponse({'results': results, 'next': results[-1]['seq'] if results else since})
+
+
+@require_GET
+def price_analytics(request):
+    # ?scope=category|promotion, optionally &id=. Reads only the summary table, "stale"
+    # marks figures waiting for the next refresh.
+    scope = request.GET.get('scope', 'category')
+    if scope not in ('category', 'promotion'):
+        return JsonResponse({'error': 'scope must be category or promotion'}, status = 400)
+    try:
+        scope_id = int_param(request, 'id')
+    except ValueError as error:
+        return JsonResponse({'error': str(error)}, status = 400)
+    summaries = PriceSummary.objects.filter(scope = scope).order_by('scope_id')
+    if scope_id is not None:
+        summaries = summaries.filter(scope_id = scope_id)
+    edges = list(PRICE_BUCKETS[1:]) + [None]
+    results = [{
+        'id': summary.scope_id,
+        'product_count': summary.product_count,
+        'min_price': summary.min_price,
+        'max_price': summary.max_price,
+        'avg_price': summary.avg_price,
+        'inventory_value': summary.inventory_value,
+        'discount_value': summary.discount_value,
+        'histogram': [{'min': low, 'max': high, 'count': count} for low, high, count in zip(PRICE_BUCKETS, edges, summary.histogram)],
+        'stale': summary.stale,
+        'updated_at': summary.updated_at,
+    } for summary in summaries]
+    return JsonResponse({'results': results})
+
+
+@require_GET
+def cache_stats(request):
+    return JsonResponse(stats())
+
+
+@require_http_methods(['PATCH'])
+def product_batch_update(request):
+    # Body: [{"id": 1, "price": 9.99, "stock": 3}, ...], price and stock are both optional.
+    # Authenticated by the session, so clients send the CSRF token in X-CSRFToken.
+    if not request.user.has_perm('CRUD.change_product'):
+        return JsonResponse({'error': 'Permission denied'}, status = 403)
+    try:
+        changes = json.loads(request.body)
+    except ValueError:
+        return JsonResponse({'error': 'Body must be valid JSON'}, status = 400)
+    if not isinstance(changes, list):
+        return JsonResponse({'error': 'Body must be a list of changes'}, status = 400)
+    if len(changes) > MAX_BATCH_SIZE:
+        return JsonResponse({'error': f'At most {MAX_BATCH_SIZE} changes per batch'}, status = 400)
+    return JsonResponse({'results': Product.objects.batch_update(changes)})
+
+
+def changes_since(since, limit):
+    events = ChangeEvent.objects.filter(id__gt = since).order_by('id').values_list('id', 'model', 'object_id', 'action')[:limit]
+    return [{'seq': seq, 'model': model, 'id': object_id, 'action': action} for seq, model, object_id, action in events]
+
+
+@require_GET
+def change_list(request):
+    # Consumers keep "next" and pass it back as ?since=. A since older than "oldest" - 1
+    # may have lost expired events and needs a full resync.
+    try:
+        since = int_param(request, 'since', 0)
+        limit = min(int_param(request, 'limit', MAX_CHANGES_PAGE_SIZE, min_value = 1), MAX_CHANGES_PAGE_SIZE)
+    except ValueError as error:
+        return JsonResponse({'error': str(error)}, status = 400)
+    results = changes_since(since, limit)
+    oldest = ChangeEvent.objects.order_by('id').values_list('id', flat = True).first()
+    return JsonResponse({'results': results, 'next': results[-1]['seq'] if results else since, 'oldest': oldest})
+
+
+@require_GET
+def change_stream(request):
+    # Server-sent events. A sync worker serves the stream, so it is held for at most
+    # STREAM_DURATION seconds, busy or not, and the browser reconnects with Last-Event-ID
+    # to resume after the last event it got.
+    try:
+        since = int(request.headers.get('Last-Event-ID') or request.GET.get('since') or 0)
+    except ValueError:
+        return JsonResponse({'error': 'Invalid cursor'}, status = 400)
+
+    def events(since):
+        yield f'retry: {STREAM_RETRY * 1000}\n\n'
+        deadline = time.monotonic() + STREAM_DURATION
+        while True:
+            batch = changes_since(since, MAX_CHANGES_PAGE_SIZE)
+            for change in batch:
+                yield f'id: {change["seq"]}\ndata: {json.dumps(change)}\n\n'
+            if batch:
+                since = batch[-1]['seq']
+            if time.monotonic() >= deadline:
+                return
+            if not batch:
+                time.sleep(min(STREAM_POLL_INTERVAL, max(deadline - time.monotonic(), 0)))
+
+    response = StreamingHttpResponse(events(since), content_type = 'text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    return response
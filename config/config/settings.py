@@ -79,6 +79,43 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Background workers write from several processes, wait for the lock instead of failing
+        'OPTIONS': {'timeout': 20},
+    }
+}
+
+# Products can be partitioned by category across several database files, see
+# CRUD/sharding.py. 0 keeps everything in the default database.
+CATALOG_SHARDS = config('CATALOG_SHARDS', default = 0, cast = int)
+CATALOG_SHARD_ALIASES = [f'shard_{i}' for i in range(CATALOG_SHARDS)]
+for alias in CATALOG_SHARD_ALIASES:
+    DATABASES[alias] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / f'db_{alias}.sqlite3',
+        'OPTIONS': {'timeout': 20},
+    }
+
+DATABASE_ROUTERS = ['CRUD.sharding.ShardRouter']
+
+# Products with stock below this are low on stock, unless their category sets its own
+# threshold (CRUD.StockThreshold)
+LOW_STOCK_THRESHOLD = config('LOW_STOCK_THRESHOLD', default = 5, cast = int)
+
+# Build the product autocomplete index when the app starts instead of on the first
+# search. config/wsgi.py turns it on for serving processes, management commands and
+# tests leave it off.
+AUTOCOMPLETE_WARM = config('AUTOCOMPLETE_WARM', default = False, cast = bool)
+
+
+# Cache
+# Listing results and their generations must be shared by every worker process, so a
+# per-process memory cache is not enough. The backend's add() must be atomic across
+# processes, it guards recomputes (CRUD/filecache.py makes it so for files).
+
+CACHES = {
+    'default': {
+        'BACKEND': 'CRUD.filecache.FileBasedCache',
+        'LOCATION': BASE_DIR / 'cache',
     }
 }
 